@@ -33,11 +33,19 @@ import sys
 sys.path.append(MIRRORDOM_PYTHON_PATH)
 import mirrordom
 import mirrordom.server
+import mirrordom.ingest
 
 
-# Global storage for mirrordom diffs - this means we only have one global
-# mirrordom session for the demo.
-mirrordom_storage = mirrordom.server.create_storage()
+# Global registry of mirrordom sessions. The demo only ever uses one session,
+# which is thrown away if nobody touches it for an hour.
+mirrordom_sessions = mirrordom.server.SessionManager(idle_timeout=3600)
+DEMO_SESSION_ID = "demo"
+
+# Broadcaster updates are parsed and committed on these worker threads, so
+# send_update returns as soon as the update's queued. Stopped (after
+# finishing whatever's queued) when the server shuts down, see the bottom of
+# this file.
+ingest_pipeline = mirrordom.ingest.IngestPipeline(workers=2)
 
 logger = logging.getLogger("mirrordom")
 logger.setLevel(logging.DEBUG)
@@ -67,15 +75,57 @@ def broadcaster():
     this page) """
     return bottle.template('broadcaster', mirrordom_uri=get_mirrordom_uri())
 
+def iter_request_body(environ, chunk_size=65536):
+    """ The request body, a chunk at a time. Stops at Content-Length, as
+    reading wsgi.input past the end can block waiting for the client. """
+    remaining = int(environ.get('CONTENT_LENGTH') or 0)
+    while remaining > 0:
+        chunk = environ['wsgi.input'].read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+@app.route('/mirrordom/html_stream', method='POST')
+def handle_html_stream():
+    """
+    Page HTML uploaded as the raw request body by broadcasters using the
+    stream_html option. It's sanitised as it's read, rather than buffered
+    whole and JSON decoded first. The rest of the message is JSON encoded
+    in the query string.
+    """
+    print "START html_stream"
+    mirrordom_storage = mirrordom_sessions.get_session(DEMO_SESSION_ID,
+            create=True, broadcaster=True)
+    params = dict((k, json.loads(v)) for k,v in
+            bottle.request.query.iteritems())
+    # Updates sent before this one need committing first
+    ingest_pipeline.flush(mirrordom_storage)
+    mirrordom.server.handle_html_stream(mirrordom_storage,
+            chunks=iter_request_body(bottle.request.environ),
+            encoding="utf-8", **params)
+    print "END html_stream"
+
 @app.route('/mirrordom/<name>', method='ANY')
 def handle_mirrordom(name):
     """
     Core mirrordom server functionality
     """
     print "START %s" % (name)
-    global mirrordom_storage
+    mirrordom_storage = mirrordom_sessions.get_session(DEMO_SESSION_ID,
+            create=True, broadcaster=(name == "send_update"))
     query = bottle.request.params
+    if name == "send_update":
+        # The pipeline JSON decodes these itself, off the request thread
+        ingest_pipeline.submit(mirrordom_storage, query["messages"],
+                query["iframes"])
+        print "QUEUED %s" % (name)
+        return
     parsed_query = dict((k, json.loads(v)) for k,v in query.iteritems())
+    if name in ("get_update", "get_frame_snapshot"):
+        # The response is already JSON encoded (and shared between viewers)
+        bottle.response.content_type = "application/json"
+        name += "_encoded"
     result = getattr(mirrordom.server, "handle_" + name)(mirrordom_storage, **parsed_query)
     print "END %s" % (name)
     return result
@@ -83,9 +133,8 @@ def handle_mirrordom(name):
 @app.route('/debug_storage')
 def debug_storage():
     """ Static mirrordom js files """
-    global mirrordom_storage
     from xml.sax.saxutils import escape
-    storage_str = pprint.pformat(mirrordom_storage)
+    storage_str = pprint.pformat(mirrordom_sessions)
     storage_str = escape(storage_str)
     return "<html><body><pre>%s</pre></body></html>"  % (storage_str)
 
@@ -99,4 +148,10 @@ def static(filepath):
     """ Static files """
     return bottle.static_file(filepath, root=STATIC_PATH)
 
-bottle.run(app, host='localhost', port=8079, debug=True)
+try:
+    bottle.run(app, host='localhost', port=8079, debug=True)
+finally:
+    # Commit any updates still queued before exiting. Code that needs an
+    # update visible before carrying on (e.g. tests) can wait for it with
+    # ingest_pipeline.flush(session) instead.
+    ingest_pipeline.stop()
@@ -19,6 +19,9 @@
                     root_url: "{{mirrordom_uri}}/",
                     iframe:   document.getElementById("mirrordom_iframe"),
                     debug:    true,
+                    // Upload page HTML as a raw request body (see
+                    // /mirrordom/html_stream in demo.py)
+                    stream_html: true,
                 });
                 
                 var POLL_INTERVAL = 2000;
@@ -50,6 +50,9 @@ MirrorDom.Broadcaster = function(options, parent_details) {
     // State
     this.cloned_dom = null;
     this.was_new_page_loaded = false;
+    this.upload_snapshots = false;
+    this.stream_html = false;
+    this.last_snapshot = null;
 
     // Polling and comms (top level iframe only)
     this.sending = false;
@@ -77,6 +80,22 @@ MirrorDom.Broadcaster = function(options, parent_details) {
  *                  object.
  *
  *                  Warning: Won't work for cross domain iframes.
+ *
+ *      - upload_snapshots: Send the whole document every poll and let the
+ *                  server work out the diffs, instead of diffing here.
+ *                  Cheaper for the browser on heavy pages, at the cost of
+ *                  bandwidth.
+ *
+ *      - stream_html: Upload page HTML ('new_instance', 'new_page' and
+ *                  'snapshot' messages) as the raw body of a request to
+ *                  root_url + 'html_stream', instead of JSON encoded inside
+ *                  send_update, so the server can sanitise it as it
+ *                  arrives. Needs push_html_method (JQueryXHRPusher, i.e.
+ *                  root_url, provides one).
+ *
+ *      - push_html_method: function(method, params, html, callback) that
+ *                  sends html as the body of a request, with params
+ *                  alongside it. Used with stream_html.
  */
 MirrorDom.Broadcaster.prototype.init_options = function(options) {
     // Transport mechanism
@@ -85,6 +104,10 @@ MirrorDom.Broadcaster.prototype.init_options = function(options) {
     } else if (options.root_url) {
         var pusher = new MirrorDom.JQueryXHRPusher(options.root_url);
         this.push_method = jQuery.proxy(pusher, 'push');
+        this.push_html_method = jQuery.proxy(pusher, 'push_html');
+    }
+    if (options.push_html_method) {
+        this.push_html_method = options.push_html_method;
     }
 
     // Force the poll message to be sent even if no data we need to send
@@ -95,6 +118,11 @@ MirrorDom.Broadcaster.prototype.init_options = function(options) {
 
     // Debug log messages
     this.debug = options.debug ? true : false;
+
+    this.upload_snapshots = options.upload_snapshots ? true : false;
+
+    this.stream_html = (options.stream_html && this.push_html_method) ?
+            true : false;
 };
 
 
@@ -163,18 +191,29 @@ MirrorDom.Broadcaster.prototype.process_and_get_messages = function(messages) {
         return;
     }
 
+    // When uploading snapshots, the server diffs new pages against what it
+    // had before too
     if (this.is_new_frame()) {
         var data = this.start_document();
-        this.add_message(messages, 'new_instance', data);
+        this.add_message(messages,
+                this.upload_snapshots ? 'snapshot' : 'new_instance', data);
         this.log('Sending new instance for document at ' +
                 this.get_frame_path().join(','));
         this.was_new_page_loaded = false;
     } else if (this.was_new_page_loaded) {
         var data = this.start_document();
-        this.add_message(messages, 'new_page', data);
+        this.add_message(messages,
+                this.upload_snapshots ? 'snapshot' : 'new_page', data);
         this.log('Sending new page for document at ' +
                 this.get_frame_path().join(','));
         this.was_new_page_loaded = false;
+    } else if (this.upload_snapshots) {
+        var data = this.snapshot_document();
+        if (data != null) {
+            this.log('Sending snapshot for document at ' +
+                    this.get_frame_path().join(','));
+            this.add_message(messages, 'snapshot', data);
+        }
     } else {
         var diffs = this.get_diff();
         if (diffs.length > 0) {
@@ -254,6 +293,55 @@ MirrorDom.Broadcaster.prototype.start_document = function() {
     };
 };
 
+/**
+ * Dump the document for the server to diff (see the upload_snapshots option).
+ * Unlike start_document, child iframes that are still there are kept.
+ *
+ * @return {object}      Document dump in message format, or null if nothing
+ *                       changed since the last snapshot.
+ */
+MirrorDom.Broadcaster.prototype.snapshot_document = function() {
+    var doc_elem = this.get_document_element();
+    var prop_diffs = [];
+    var seen_iframes = {};
+
+    var dom_iterator = new MirrorDom.DomIterator(doc_elem);
+    dom_iterator.add_handler(
+            jQuery.proxy(this.track_iframes_from_dom_iterator, this),
+            seen_iframes);
+    dom_iterator.add_handler(
+            this.collect_props_from_dom_iterator, prop_diffs);
+    dom_iterator.add_handler(
+            jQuery.proxy(this.rewrite_targets_in_dom_iterator, this));
+    dom_iterator.run();
+
+    // Forget about iframes that have gone away
+    for (var key in this.child_iframes) {
+        if (!(key in seen_iframes)) {
+            this.child_iframes[key]['broadcaster'].destroy();
+            delete this.child_iframes[key];
+        }
+    }
+
+    for (var i = 0; i < prop_diffs.length; i++) {
+        prop_diffs[i].unshift('props');
+    }
+
+    var data = {
+        'html': this.get_document_data(doc_elem),
+        'props': prop_diffs,
+        'url': this.iframe.contentWindow.location.href
+    };
+
+    // Don't bother the server if nothing changed
+    var encoded = JSON.stringify(data);
+    if (encoded == this.last_snapshot) {
+        return null;
+    }
+    this.last_snapshot = encoded;
+    return data;
+};
+
 /**
  * Retrieve the diff and update the cloned dom
  */
@@ -376,9 +464,73 @@ MirrorDom.Broadcaster.prototype.poll = function() {
         // Grab iframes to inform the server which iframes are in fact still
         // active after these latest changes.
         var iframes = this.get_all_iframe_paths();
-        this.push_method('send_update',
-                {'messages': messages, 'iframes': iframes});
+        if (this.stream_html) {
+            this.stream_messages(messages, iframes);
+        } else {
+            this.push_method('send_update',
+                    {'messages': messages, 'iframes': iframes});
+        }
+    }
+};
+
+/**
+ * Message types whose HTML gets streamed (see the stream_html option)
+ */
+MirrorDom.Broadcaster.HTML_MESSAGES = {
+    'new_instance': true,
+    'new_page': true,
+    'snapshot': true
+};
+
+/**
+ * Send messages with stream_html. Page messages go to html_stream and runs of
+ * the rest to send_update, one request at a time so the server gets them in
+ * order. A send_update always goes last, to tell the server which iframes
+ * are still there.
+ */
+MirrorDom.Broadcaster.prototype.stream_messages = function(messages, iframes) {
+    var requests = [];
+    var others = [];
+    for (var i = 0; i < messages.length; i++) {
+        var m = messages[i];
+        if (!MirrorDom.Broadcaster.HTML_MESSAGES[m[1]]) {
+            others.push(m);
+            continue;
+        }
+        if (others.length > 0) {
+            requests.push({'messages': others, 'iframes': iframes});
+            others = [];
+        }
+        requests.push({'html_message': m});
     }
+    requests.push({'messages': others, 'iframes': iframes});
+
+    var self = this;
+    var send_next = function() {
+        if (requests.length == 0) {
+            self.sending = false;
+            return;
+        }
+        var r = requests.shift();
+        if (r['html_message'] == null) {
+            self.push_method('send_update', r, send_next);
+            return;
+        }
+        var path = r['html_message'][0];
+        var data = r['html_message'][2];
+        var params = {
+            'frame_id': path,
+            'update_type': r['html_message'][1],
+            'props': data['props'],
+            'url': data['url']
+        };
+        if (data['iframes'] != null) {
+            params['iframes'] = data['iframes'];
+        }
+        self.push_html_method('html_stream', params, data['html'], send_next);
+    };
+    this.sending = true;
+    send_next();
 };
 
 /**
@@ -1039,6 +1191,25 @@ function(node, base_ipath, ipath) {
     }
 };
 
+/**
+ * Like find_iframes_from_dom_iterator, but only registers iframes we aren't
+ * already tracking.
+ *
+ * @param {object} data         Set of iframe path keys, which we'll populate.
+ */
+MirrorDom.Broadcaster.prototype.track_iframes_from_dom_iterator =
+function(node, base_ipath, ipath, data) {
+    if (node.nodeName.toLowerCase() != 'iframe') {
+        return;
+    }
+    var full_path = base_ipath.concat(ipath);
+    var key = full_path.join(',');
+    data[key] = true;
+    if (!(key in this.child_iframes)) {
+        this.register_new_iframe(node, full_path);
+    }
+};
+
 MirrorDom.Broadcaster.prototype.rewrite_targets_in_dom_iterator =
 function(node, base_ipath, ipath) {
     var node = jQuery(node);
@@ -1063,6 +1234,9 @@ MirrorDom.JQueryXHRPusher = function(root_url) {
 
 /**
  * @param {object or string} args       Either a mapping or a string.
+ * @param {function} callback           Called with the decoded response once
+ *                                      the request finishes, or null if it
+ *                                      failed or there wasn't one.
  */
 MirrorDom.JQueryXHRPusher.prototype.push = function(method, args, callback) {
     for (var k in args) {
@@ -1071,7 +1245,46 @@ MirrorDom.JQueryXHRPusher.prototype.push = function(method, args, callback) {
         }
     }
 
-    jQuery.post(this.root_url + method, args, function(result) {
-        if (callback) callback(JSON.parse(result));
+    jQuery.ajax({
+        url: this.root_url + method,
+        type: 'POST',
+        data: args,
+        dataType: 'text',
+        complete: MirrorDom.JQueryXHRPusher.completer(callback)
+    });
+};
+
+/**
+ * POST html as the request body (UTF-8 encoded), with params JSON encoded in
+ * the query string.
+ *
+ * @param {function} callback           As for push.
+ */
+MirrorDom.JQueryXHRPusher.prototype.push_html = function(method, params, html,
+        callback) {
+    var query = {};
+    for (var k in params) {
+        query[k] = JSON.stringify(params[k]);
+    }
+
+    jQuery.ajax({
+        url: this.root_url + method + '?' + jQuery.param(query),
+        type: 'POST',
+        data: html,
+        processData: false,
+        contentType: 'text/html; charset=utf-8',
+        dataType: 'text',
+        complete: MirrorDom.JQueryXHRPusher.completer(callback)
     });
 };
+
+MirrorDom.JQueryXHRPusher.completer = function(callback) {
+    return function(xhr, status) {
+        if (!callback) return;
+        var result = null;
+        if (status == 'success' && xhr.responseText) {
+            result = JSON.parse(xhr.responseText);
+        }
+        callback(result);
+    };
+};
@@ -331,6 +331,81 @@ MirrorDom.next_text_node = function(node) {
     return node;
 };
 
+// ============================================================================
+// Content hashes
+//
+// Must be kept in agreement with mirrordom/merkle.py, which computes the same
+// hashes from the server's copy of the document.
+// ============================================================================
+MirrorDom.FNV_OFFSET = 0x811c9dc5;
+
+/**
+ * 32 bit FNV-1a hash of a string's UTF-16 code units.
+ */
+MirrorDom.hash_string = function(s) {
+    var h = MirrorDom.FNV_OFFSET;
+    for (var i = 0; i < s.length; i++) {
+        h ^= s.charCodeAt(i);
+        // h * 16777619, without losing the low bits to floating point
+        h = (h + (h << 1) + (h << 4) + (h << 7) + (h << 8) + (h << 24)) >>> 0;
+    }
+    return h;
+};
+
+MirrorDom.to_hex = function(h) {
+    var hex = h.toString(16);
+    while (hex.length < 8) { hex = '0' + hex; }
+    return hex;
+};
+
+/**
+ * Hash of everything about an element except its children: tag, attributes,
+ * the text before its first child and the text after it.
+ */
+MirrorDom.shallow_hash = function(node) {
+    var attribs = [];
+    for (var i = 0; i < node.attributes.length; i++) {
+        var attrib = node.attributes[i];
+        // IE hack for "specified" attributes (see handle_diff_node_attributes)
+        if (attrib.specified === false) { continue; }
+        // Namespaced attributes aren't tracked by the server, and namespace
+        // declarations aren't attributes there
+        if (attrib.name.indexOf(':') != -1) { continue; }
+        if (attrib.name == 'xmlns') { continue; }
+        if (MirrorDom.should_ignore_attribute(node, attrib.name)) { continue; }
+        attribs.push(attrib.name + '=' + attrib.value);
+    }
+    attribs.sort();
+    var name = (node.localName || node.nodeName).toLowerCase();
+    var tail = node === node.ownerDocument.documentElement ? '' :
+        MirrorDom.get_text_node_content(node.nextSibling);
+    var content = [name, attribs.join('\x02'),
+        MirrorDom.get_text_node_content(node.firstChild), tail];
+    return MirrorDom.to_hex(MirrorDom.hash_string(content.join('\x01')));
+};
+
+/**
+ * Hashes of an element's children (see MirrorDom.subtree_hash).
+ */
+MirrorDom.child_hashes = function(node) {
+    var result = [];
+    var child = MirrorDom.next_element(node.firstChild);
+    while (child != null) {
+        result.push(MirrorDom.subtree_hash(child));
+        child = MirrorDom.next_element(child.nextSibling);
+    }
+    return result;
+};
+
+/**
+ * Hash of an element and everything inside it.
+ */
+MirrorDom.subtree_hash = function(node) {
+    var parts = [MirrorDom.shallow_hash(node)].concat(
+            MirrorDom.child_hashes(node));
+    return MirrorDom.to_hex(MirrorDom.hash_string(parts.join('')));
+};
+
 // ============================================================================
 // Node processing
 // ============================================================================
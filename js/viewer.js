@@ -59,6 +59,40 @@ MirrorDom.Viewer.prototype.init_options = function(options) {
     this.blank_page = options['blank_page'] != null ?
         options['blank_page'] : 'about:blank';
     this.debug = options.debug;
+
+    // Long polling: the server holds each poll open for up to this many
+    // seconds waiting for changes, and we poll again as soon as it returns.
+    this.long_poll_timeout = options.long_poll_timeout;
+
+    // WebSocket url of a push server (see mirrordom/push.py). If set, updates
+    // are pushed to us as they happen instead of being polled for.
+    this.push_url = options.push_url;
+    this.socket = null;
+    this.pushed_updates = [];
+
+    // Frames whose documents have diverged from the server's, which we're
+    // repairing a subtree at a time (see repair_frames). Only possible when
+    // the server sends content hashes (see mirrordom/merkle.py).
+    //
+    // If verify_hashes is set, every changeset with a hash is checked, which
+    // means hashing the whole frame document. Otherwise we only find out
+    // when a diff fails to apply.
+    this.verify_hashes = options.verify_hashes;
+    this.repairs = {};
+    this.current_changeset = null;
+
+    // Frames whose diffs we couldn't apply, which we're fetching from scratch
+    // with get_frame_snapshot. Frame path string -> frame path.
+    this.recovering = {};
+
+    // If set, register with the server and tell it how far we've got with
+    // every poll, so it can throw away diffs nobody needs.
+    this.acknowledge = options.acknowledge;
+    this.viewer_id = null;
+
+    // If set, ask the server to collapse the diffs we've missed, so we only
+    // get the latest state of everything (for slow connections)
+    this.conflate = options.conflate;
 };
 
 // ----------------------------------------------------------------------------
@@ -72,7 +106,17 @@ MirrorDom.Viewer.prototype.init_options = function(options) {
  * browser synchronisation.
  */
 MirrorDom.Viewer.prototype.go = function() {
-    this.poll();
+    if (this.push_url && this.next_recovery() == null &&
+            this.error_status != MirrorDom.VIEWER_LOCAL_HTML_ERROR) {
+        this.connect();
+        this.receive_pushed_updates();
+    } else {
+        // Error recovery always polls, since only the poll can wait for a
+        // new page (see poll)
+        this.disconnect();
+        this.poll();
+    }
+    this.repair_frames();
 };
 
 // ----------------------------------------------------------------------------
@@ -108,6 +152,37 @@ MirrorDom.Viewer.prototype.poll = function() {
         params['change_id'] = this.next_change_id;
     }
 
+    if (this.acknowledge) {
+        if (this.viewer_id == null) {
+            this.pull_method('register_viewer', {}, function(result) {
+                if (result) {
+                    self.viewer_id = result['viewer_id'];
+                }
+                self.receiving = false;
+            });
+            return;
+        }
+        params['viewer_id'] = JSON.stringify(this.viewer_id);
+    }
+
+    // Start a broken frame again: this gets its current document along with
+    // the usual update for the other frames
+    var frame_path = this.next_recovery();
+    if (frame_path != null) {
+        params['frame_path'] = JSON.stringify(frame_path);
+        this.log('Polling with change ' + params['change_id'] +
+                ', recovering frame ' + frame_path.join(','));
+        this.pull_method('get_frame_snapshot', params, function(result) {
+            // If the frame has gone, there's nothing to recover
+            delete self.recovering[frame_path.join(',')];
+            if (result) {
+                self.receive_updates(result);
+            }
+            self.receiving = false;
+        });
+        return;
+    }
+
     // Inform the server we only want an update if it contains a main frame
     // init_html (this basically means we wait until the broadcaster visits a
     // new page)
@@ -123,6 +198,15 @@ MirrorDom.Viewer.prototype.poll = function() {
         this.log('Polling with change ' + params['change_id']);
     }
 
+    // The server only waits for changes if we tell it where we're up to
+    var long_poll = this.long_poll_timeout && params['change_id'] != null;
+    if (long_poll) {
+        params['timeout'] = this.long_poll_timeout;
+    }
+    if (this.conflate) {
+        params['conflate'] = 'true';
+    }
+
     // Invoke the remote procedure call
     this.pull_method('get_update', params,
         function(result) {
@@ -130,10 +214,69 @@ MirrorDom.Viewer.prototype.poll = function() {
                 self.receive_updates(result);
             }
             self.receiving = false;
+            // Poll again straight away only if the server held this poll
+            // open, otherwise we'd be hammering it. go() polls again later.
+            if (long_poll && result) {
+                window.setTimeout(function() { self.poll(); }, 0);
+            }
         }
     );
 };
 
+/**
+ * Open a WebSocket to the push server, unless one is already open. The server
+ * sends us the same responses as get_update, starting from next_change_id, so
+ * a dropped connection resumes where it left off when go() reconnects.
+ */
+MirrorDom.Viewer.prototype.connect = function() {
+    if (this.socket != null) {
+        return;
+    }
+    var url = this.push_url;
+    if (this.next_change_id != null) {
+        url += (url.indexOf('?') == -1 ? '?' : '&') +
+            'change_id=' + this.next_change_id;
+    }
+    this.log('Connecting to ' + url);
+
+    var self = this;
+    var socket = new WebSocket(url);
+    socket.onmessage = function(event) {
+        self.pushed_updates.push(JSON.parse(event.data));
+        self.receive_pushed_updates();
+    };
+    socket.onclose = function() {
+        self.log('Push connection closed');
+        if (self.socket === socket) {
+            self.socket = null;
+        }
+    };
+    this.socket = socket;
+};
+
+MirrorDom.Viewer.prototype.disconnect = function() {
+    if (this.socket != null) {
+        this.socket.close();
+        this.socket = null;
+        this.pushed_updates = [];
+    }
+};
+
+/**
+ * Apply the updates pushed to us so far, unless a page is still loading.
+ */
+MirrorDom.Viewer.prototype.receive_pushed_updates = function() {
+    var d = this.get_document_object();
+    if (d.readyState != 'complete') {
+        this.log('Page is loading, deferring pushed updates');
+        return;
+    }
+    while (this.pushed_updates.length > 0 &&
+            this.error_status != MirrorDom.VIEWER_LOCAL_HTML_ERROR) {
+        this.receive_updates(this.pushed_updates.shift());
+    }
+};
+
 /**
  * Callback which expects the response from the python mirrordom server.
  *
@@ -142,24 +285,29 @@ MirrorDom.Viewer.prototype.poll = function() {
  */
 MirrorDom.Viewer.prototype.receive_updates = function(result) {
     if (result['changesets'] == undefined) {
-        //this.log('No changeset returned ' +
-        //      '(this should only happen in error recovery mode)');
+        // Error recovery mode, and the broadcaster hasn't loaded a new page
+        // yet. Wait for changes after these, or the next long poll returns
+        // straight away. A new page starts after them, so we'll still see it.
+        if (result['last_change_id'] != undefined) {
+            this.next_change_id = result['last_change_id'] + 1;
+        }
         return;
     }
 
+    // Only frames that changed are listed, so there may be none
     if (result['changesets'].length > 0) {
         this.apply_all_changesets(result['changesets']);
-        this.next_change_id = result['last_change_id'] + 1;
     }
+    this.next_change_id = result['last_change_id'] + 1;
 };
 
 /**
  * Wraps perform_apply_all_changesets in a try/catch.
  */
 MirrorDom.Viewer.prototype.apply_all_changesets =
-function(changesets, resume_pos) {
+function(changesets, resume_pos, has_loaded) {
     try {
-        this.perform_apply_all_changesets(changesets, resume_pos);
+        this.perform_apply_all_changesets(changesets, resume_pos, has_loaded);
     } catch (e) {
         // Got a diff path error, dump debug info to the console
         if (e instanceof MirrorDom.PathError ||
@@ -168,8 +316,15 @@ function(changesets, resume_pos) {
                 this.log(e.message);
                 this.log('Path analysis: ' + e.describe_path());
             }
-            this.error_status = MirrorDom.VIEWER_LOCAL_HTML_ERROR;
-            this.fire_event('on_error_status', {'status': this.error_status});
+            var pos = this.current_changeset;
+            if ('hash' in changesets[pos][1]) {
+                // The server can help us fix just that frame, carry on with
+                // the others
+                this.start_repair(changesets[pos][0]);
+            } else {
+                this.start_recovery(changesets[pos][0]);
+            }
+            this.apply_all_changesets(changesets, pos + 1, false);
             return;
         }
         else if (e instanceof MirrorDom.ServerError) {
@@ -197,9 +352,12 @@ function(changesets, resume_pos) {
  *
  * @param {array} changesets        Array of [frame_path, changesets].
  * @param {int} resume_pos          Index of changeset to begin processing.
+ * @param {boolean} has_loaded      Whether we're resuming because the frame
+ *                                  at resume_pos loaded (the default when
+ *                                  resume_pos is given).
  */
 MirrorDom.Viewer.prototype.perform_apply_all_changesets =
-function(changesets, resume_pos) {
+function(changesets, resume_pos, has_loaded) {
     // We have a list of changelogs for each iframe in our document.
     // The changelogs are ordered top to bottom, since the higher up frames
     // need to create the lower frames first, before those frame documents can
@@ -225,7 +383,9 @@ function(changesets, resume_pos) {
 
     // If we're resuming, then that means we came here from an event handler
     // callback
-    var has_loaded = resume_pos != undefined;
+    if (has_loaded == undefined) {
+        has_loaded = resume_pos != undefined;
+    }
 
     // This loop is weird...sometimes we have to wait for an iframe to load, at
     // which point we terminate the current loop and resume once the event has
@@ -246,6 +406,12 @@ function(changesets, resume_pos) {
             // Don't bother with this changeset, nothing worth doing
             continue;
         }
+        if (!('init_html' in changes) && this.is_recovering(frame_path)) {
+            // We'll get the whole document soon
+            this.log('Changeset ' + i + ': Frame ' + frame_path_str +
+                    ' is being recovered, skipping');
+            continue;
+        }
         // Locate the iframe
         var iframe = MirrorDom.node_at_framepath(this.iframe, frame_path);
         var iframe_doc = MirrorDom.get_iframe_document(iframe);
@@ -284,9 +450,27 @@ function(changesets, resume_pos) {
             var callback = make_reentry_callback(i);
             jQuery(iframe).load(callback);
             return;
+        } else if (frame_path_str in this.repairs &&
+                !('init_html' in changes)) {
+            // Our copy of this frame is wrong anyway. The repair brings it
+            // up to date, but has to start again.
+            this.log('Changeset ' + i + ': Frame ' + frame_path_str +
+                    ' is being repaired, skipping');
+            this.repairs[frame_path_str].generation++;
+            has_loaded = false;
         } else {
             // Scenario 3: Have diffs, let's proceed
-            this.apply_changeset(iframe_doc.documentElement, changes);
+            delete this.repairs[frame_path_str];
+            delete this.recovering[frame_path_str];
+            this.current_changeset = i;
+            var doc_elem = iframe_doc.documentElement;
+            this.apply_changeset(doc_elem, changes);
+            if (this.verify_hashes && 'hash' in changes &&
+                    MirrorDom.subtree_hash(doc_elem) != changes['hash']) {
+                this.log('Changeset ' + i + ': Frame ' + frame_path_str +
+                        ' has diverged');
+                this.start_repair(frame_path);
+            }
 
             // Reset variable for next loop
             has_loaded = false;
@@ -330,6 +514,176 @@ MirrorDom.Viewer.prototype.apply_changeset = function(doc_elem, changelog) {
     }
 };
 
+// ----------------------------------------------------------------------------
+// Recovery
+// ----------------------------------------------------------------------------
+
+/**
+ * Give up on a frame's document and fetch it again (see poll). Until then,
+ * diffs for it and the frames inside it are skipped.
+ */
+MirrorDom.Viewer.prototype.start_recovery = function(frame_path) {
+    this.log('Recovering frame ' + frame_path.join(','));
+    this.recovering[frame_path.join(',')] = frame_path;
+    if (this.error_status != MirrorDom.VIEWER_LOCAL_HTML_ERROR) {
+        this.error_status = MirrorDom.VIEWER_LOCAL_HTML_ERROR;
+        this.fire_event('on_error_status', {'status': this.error_status});
+    }
+};
+
+/**
+ * Returns the path of a frame waiting to be recovered, or null.
+ */
+MirrorDom.Viewer.prototype.next_recovery = function() {
+    for (var key in this.recovering) {
+        return this.recovering[key];
+    }
+    return null;
+};
+
+/**
+ * Whether frame_path or a frame containing it is being recovered.
+ */
+MirrorDom.Viewer.prototype.is_recovering = function(frame_path) {
+    for (var i = 1; i <= frame_path.length; i++) {
+        if (frame_path.slice(0, i).join(',') in this.recovering) {
+            return true;
+        }
+    }
+    return false;
+};
+
+// ----------------------------------------------------------------------------
+// Repairs
+// ----------------------------------------------------------------------------
+
+/**
+ * Start bringing a frame's document back in line with the server's.
+ */
+MirrorDom.Viewer.prototype.start_repair = function(frame_path) {
+    var key = frame_path.join(',');
+    this.log('Repairing frame ' + key);
+    var repair = this.repairs[key];
+    if (repair == undefined) {
+        repair = this.repairs[key] = {
+            'frame_path': frame_path,
+            'generation': 0,
+            'pending': false
+        };
+    }
+    // Work down from the root, comparing hashes. Each entry is
+    // [ipath, replace] where replace means fetch the HTML and swap it in.
+    repair.queue = [[[], false]];
+};
+
+/**
+ * Make progress on any repairs (called from go()). One request per frame is
+ * outstanding at a time.
+ */
+MirrorDom.Viewer.prototype.repair_frames = function() {
+    if (this.next_change_id == null) {
+        return;
+    }
+    for (var key in this.repairs) {
+        var repair = this.repairs[key];
+        if (!repair.pending) {
+            this.request_subtree(repair);
+        }
+    }
+};
+
+MirrorDom.Viewer.prototype.request_subtree = function(repair) {
+    var key = repair.frame_path.join(',');
+    if (repair.queue.length == 0) {
+        this.log('Repaired frame ' + key);
+        delete this.repairs[key];
+        return;
+    }
+    var entry = repair.queue[0];
+    var generation = repair.generation;
+    var params = {
+        'frame_path': JSON.stringify(repair.frame_path),
+        'ipath': JSON.stringify(entry[0]),
+        'change_id': this.next_change_id - 1,
+        'include_html': entry[1] ? 'true' : 'false'
+    };
+    repair.pending = true;
+    var self = this;
+    this.pull_method('get_subtree', params, function(result) {
+        repair.pending = false;
+        if (self.repairs[key] !== repair) {
+            // Cancelled by a new page
+            return;
+        }
+        if (result == null || result['unavailable']) {
+            // Fall back to fetching the whole frame
+            delete self.repairs[key];
+            self.start_recovery(repair.frame_path);
+            return;
+        }
+        if (result['stale'] || repair.generation != generation) {
+            // The document changed under us, catch up and start again
+            self.start_repair(repair.frame_path);
+            return;
+        }
+        repair.queue.shift();
+        self.repair_subtree(repair, entry[0], entry[1], result);
+    });
+};
+
+/**
+ * Compare (or replace) one subtree of a frame being repaired.
+ *
+ * @param {array} ipath         Path of the subtree's root element.
+ * @param {boolean} replace     Whether result has the HTML to replace it.
+ * @param {object} result       Response to get_subtree.
+ */
+MirrorDom.Viewer.prototype.repair_subtree =
+function(repair, ipath, replace, result) {
+    var iframe = MirrorDom.node_at_framepath(this.iframe, repair.frame_path);
+    var doc_elem = MirrorDom.get_iframe_document(iframe).documentElement;
+    var node = null;
+    try {
+        node = MirrorDom.node_at_path(doc_elem, ipath);
+    } catch (e) {
+        if (!(e instanceof MirrorDom.PathError)) { throw e; }
+    }
+
+    if (node == null) {
+        // Missing altogether, so its parent is wrong
+        repair.queue.push([ipath.slice(0, ipath.length - 1), true]);
+    } else if (replace) {
+        if (ipath.length == 0) {
+            this.apply_document(doc_elem, result['html']);
+            this.apply_diffs(doc_elem, result['props']);
+        } else {
+            var doc = doc_elem.ownerDocument;
+            var parent_node = node.parentNode;
+            var type = MirrorDom.determine_node_doc_type(node);
+            var before = MirrorDom.next_element(node.nextSibling);
+            this.delete_text_nodes(node.nextSibling);
+            parent_node.removeChild(node);
+            this.insert_node(doc, parent_node, before || null,
+                    ['node', type, ipath, result['html'], result['tail'],
+                     result['props']]);
+        }
+    } else if (MirrorDom.subtree_hash(node) != result['hash']) {
+        var children = MirrorDom.child_hashes(node);
+        if (MirrorDom.shallow_hash(node) == result['shallow'] &&
+                children.length == result['children'].length) {
+            // Only some of the children are wrong
+            for (var i = 0; i < children.length; i++) {
+                if (children[i] != result['children'][i]) {
+                    repair.queue.push([ipath.concat([i]), false]);
+                }
+            }
+        } else {
+            repair.queue.push([ipath, true]);
+        }
+    }
+    this.request_subtree(repair);
+};
+
 // ----------------------------------------------------------------------------
 // Internal utility functions
 // ----------------------------------------------------------------------------
@@ -512,6 +866,15 @@ MirrorDom.Viewer.prototype.apply_diffs = function(node, diffs, index) {
         //
         // For 'deleted':
         // nope
+        //
+        // For 'insert' (same as 'node', but keeps the node at the path and
+        // its right siblings, after the new node)
+        // 3) Outer HTML
+        // 4) Tail text
+        // 5) Extra properties to apply
+        //
+        // For 'move'
+        // 3) New position of the node among its siblings
 
         if (diff[0] == 'node') {
             var ipath = diff[2];
@@ -525,38 +888,19 @@ MirrorDom.Viewer.prototype.apply_diffs = function(node, diffs, index) {
                 this.delete_node_and_remaining_siblings(node);
             }
 
-            // Create new element from the cloned node
-            var node_type = diff[1];
-            switch (node_type) {
-                case 'svg':
-                    // TODO: Manage the situation when node corresponds to
-                    // entire XML doc.
-                    var new_elem = MirrorDom.to_svg(doc, diff[3]);
-                    parent_node.appendChild(new_elem);
-                    break;
-                case 'html':
-                case 'vml': // Sigh...
-                    // VML seems to work with jQuery, I guess that's expected
-                    // as it works by dumping into innerHTML
-                    var new_elem = jQuery(diff[3], doc)[0];
-                    parent_node.appendChild(new_elem);
-
-                    // Apply all properties which doesn't get transmitted in
-                    // innerHTML. Properties are in the form
-                    //      [doc_type, path, property_dictionary]
-                    // where the path is relative to the newly added node.
-                    var props = diff[5];
-                    for (var j = 0; j < props.length; j++) {
-                        var prop_path = props[j][1];
-                        var pnode = MirrorDom.node_at_path(new_elem, prop_path);
-                        this.apply_props(props[j][2], null, pnode, prop_path);
-                    }
-                    break;
-            }
+            this.insert_node(doc, parent_node, null, diff);
+
+        } else if (diff[0] == 'insert') {
+            var ipath = diff[2];
+            var parent_node = MirrorDom.node_at_path(
+                    root, ipath.slice(0, ipath.length - 1));
+            var before = MirrorDom.nth_child(parent_node,
+                    ipath[ipath.length - 1]);
+            this.insert_node(doc, parent_node, before || null, diff);
 
-            // Add tail text
-            var text = diff[4];
-            parent_node.appendChild(doc.createTextNode(text));
+        } else if (diff[0] == 'move') {
+            var node = MirrorDom.node_at_path(root, diff[2]);
+            this.move_node(node, diff[3]);
 
         } else if (diff[0] == 'text') {
             var node = MirrorDom.node_at_path(root, diff[2]);
@@ -593,6 +937,73 @@ MirrorDom.Viewer.prototype.apply_diffs = function(node, diffs, index) {
 // Utility functions
 // ----------------------------------------------------------------------------
 
+/**
+ * Create the node described by a 'node' or 'insert' diff, followed by its
+ * tail text.
+ *
+ * @param {node} parent_node    Node to add the new node to.
+ * @param {node} before         Sibling to add it in front of, or null to add
+ *                              it at the end.
+ * @param {array} diff          The diff.
+ */
+MirrorDom.Viewer.prototype.insert_node = function(doc, parent_node, before,
+        diff) {
+    // Create new element from the cloned node
+    var node_type = diff[1];
+    var new_elem = null;
+    switch (node_type) {
+        case 'svg':
+            // TODO: Manage the situation when node corresponds to
+            // entire XML doc.
+            new_elem = MirrorDom.to_svg(doc, diff[3]);
+            parent_node.insertBefore(new_elem, before);
+            break;
+        case 'html':
+        case 'vml': // Sigh...
+            // VML seems to work with jQuery, I guess that's expected
+            // as it works by dumping into innerHTML
+            new_elem = jQuery(diff[3], doc)[0];
+            parent_node.insertBefore(new_elem, before);
+
+            // Apply all properties which doesn't get transmitted in
+            // innerHTML. Properties are in the form
+            //      [doc_type, path, property_dictionary]
+            // where the path is relative to the newly added node.
+            var props = diff[5];
+            for (var j = 0; j < props.length; j++) {
+                var prop_path = props[j][1];
+                var pnode = MirrorDom.node_at_path(new_elem, prop_path);
+                this.apply_props(props[j][2], null, pnode, prop_path);
+            }
+            break;
+    }
+
+    // Add tail text
+    var text = diff[4];
+    parent_node.insertBefore(doc.createTextNode(text), before);
+};
+
+/**
+ * Move a node, along with the text nodes following it, so it's at new_pos
+ * among its siblings (not counting itself).
+ */
+MirrorDom.Viewer.prototype.move_node = function(node, new_pos) {
+    var parent = node.parentNode;
+    var moving = [node];
+    var next = node.nextSibling;
+    while (next != null && next.nodeType == 3) {
+        moving.push(next);
+        next = next.nextSibling;
+    }
+    for (var i = 0; i < moving.length; i++) {
+        parent.removeChild(moving[i]);
+    }
+    var before = MirrorDom.nth_child(parent, new_pos);
+    for (var i = 0; i < moving.length; i++) {
+        parent.insertBefore(moving[i], before || null);
+    }
+};
+
 /**
  * Deletes a node and all its siblings to the right
  */
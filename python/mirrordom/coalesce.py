@@ -0,0 +1,174 @@
+"""
+Shrink a list of diffs (see MirrorDom.Broadcaster.prototype.diff_dom) without
+changing what applying them does.
+
+The broadcaster often sends several 'attribs', 'props' or 'text' diffs for the
+same node, and diffs for nodes that a later 'node' diff throws away (diff_dom
+deletes all the right siblings of a changed node and adds them again). This
+merges the former and drops the latter.
+
+Diff paths are interpreted against the document as it is when each diff is
+applied, so the rules are careful about order:
+
+- 'node' and 'deleted' diffs remove the node at their path and all of its
+  right siblings. Any earlier diff for one of those nodes (or anything inside
+  them) is dropped.
+- 'attribs', 'props' and 'text' diffs for the same node and type are merged
+  into the first one, as long as no 'node' or 'deleted' diff comes between
+  them.
+- Anything else is left alone and nothing before it is touched.
+
+conflate_diffs is for viewers catching up on a whole range of diffs at once,
+where the ranges are long enough that merges are worth carrying on past
+'node' and 'deleted' diffs (for the nodes those leave alone).
+"""
+
+import logging
+
+logger = logging.getLogger("mirrordom.coalesce")
+
+STRUCTURAL_DIFFS = set(["node", "deleted"])
+
+# -----------------------------------------------------------------------------
+# Merging
+# -----------------------------------------------------------------------------
+
+def changed_and_removed(diff):
+    """
+    The changed and removed parts of an 'attribs' or 'props' diff (removed
+    may be omitted)
+    """
+    return diff[3], diff[4] if len(diff) > 4 else None
+
+def merge_dicts(first, second):
+    """
+    Merge the changed and removed parts of two 'attribs' or 'props' diffs.
+
+    Returns (changed, removed). Changes are applied before removals (see
+    mirror.DocumentMirror.apply_attribs), so a value that's changed and
+    then removed only needs removing, but it's left in changed anyway since
+    viewers currently ignore removed properties.
+    """
+    first_changed, first_removed = changed_and_removed(first)
+    second_changed, second_removed = changed_and_removed(second)
+    changed = dict(first_changed)
+    changed.update(second_changed)
+    removed = [name for name in first_removed or [] \
+            if name not in second_changed]
+    for name in second_removed or []:
+        if name not in removed:
+            removed.append(name)
+    return changed, removed
+
+def merge_attribs(first, second):
+    """
+    [1] Type [2] Path [3] Changed attributes [4] Removed attributes
+    """
+    changed, removed = merge_dicts(first, second)
+    return first[:3] + [changed, removed]
+
+def merge_props(first, second):
+    """
+    [1] Type [2] Path [3] Changed properties [4] Removed properties
+    (optional)
+    """
+    changed, removed = merge_dicts(first, second)
+    if len(first) > 4 or len(second) > 4:
+        return first[:3] + [changed, removed]
+    return first[:3] + [changed]
+
+def merge_text(first, second):
+    """
+    [1] Type [2] Path [3] Tail value [4] Child value
+    """
+    tail = second[3] if second[3] is not None else first[3]
+    child = second[4] if second[4] is not None else first[4]
+    return first[:3] + [tail, child]
+
+MERGE_FUNCTIONS = {
+    "attribs": merge_attribs,
+    "props": merge_props,
+    "text": merge_text,
+}
+
+# -----------------------------------------------------------------------------
+# Coalescing
+# -----------------------------------------------------------------------------
+
+def replaces(path, other_path):
+    """
+    True if a 'node' or 'deleted' diff at path removes the node at other_path
+    (i.e. other_path is the node itself, a right sibling, or inside one of
+    those).
+    """
+    depth = len(path) - 1
+    return len(other_path) > depth and \
+            other_path[:depth] == path[:depth] and \
+            other_path[depth] >= path[depth]
+
+def coalesce_diffs(diffs, keep_unaffected=False):
+    """
+    Returns a new list of diffs which has the same effect as diffs. The diffs
+    passed in aren't modified.
+
+    :param keep_unaffected:     Keep merging into diffs for nodes that a
+                                'node' or 'deleted' diff doesn't remove.
+                                Those nodes keep their paths, so it's safe,
+                                but it means looking at every merge target for
+                                every structural diff.
+    """
+    result = []
+
+    # (diff type, path) -> position in result of the diff later ones can be
+    # merged into. Reset by structural diffs.
+    merge_targets = {}
+
+    # Nothing before this position in result can be dropped
+    barrier = 0
+
+    for diff in diffs:
+        diff_type = diff[0]
+        path = diff[2]
+        if diff_type in MERGE_FUNCTIONS:
+            key = (diff_type, tuple(path))
+            pos = merge_targets.get(key)
+            if pos is None:
+                merge_targets[key] = len(result)
+                result.append(diff)
+            else:
+                result[pos] = MERGE_FUNCTIONS[diff_type](result[pos], diff)
+        elif diff_type in STRUCTURAL_DIFFS and path:
+            for i in xrange(barrier, len(result)):
+                earlier = result[i]
+                if earlier is None or not replaces(path, earlier[2]):
+                    continue
+                # A 'deleted' diff needs its node to exist, and an earlier
+                # 'node' diff at the same path might be what created it
+                if diff_type == "deleted" and earlier[0] == "node" and \
+                        earlier[2] == path:
+                    continue
+                result[i] = None
+            if keep_unaffected:
+                merge_targets = dict((key, pos) \
+                        for key, pos in merge_targets.iteritems() \
+                        if not replaces(path, list(key[1])))
+            else:
+                merge_targets = {}
+            result.append(diff)
+        else:
+            merge_targets = {}
+            result.append(diff)
+            barrier = len(result)
+
+    coalesced = [d for d in result if d is not None]
+    if len(coalesced) != len(diffs):
+        logger.debug("Coalesced %s diffs into %s", len(diffs), len(coalesced))
+    return coalesced
+
+def conflate_diffs(diffs):
+    """
+    Collapse a viewer's whole backlog of diffs, so that only the last value of
+    each attribute, property and text survives, and nothing is sent for
+    nodes that are later replaced (see handle_get_update's conflate).
+    """
+    return coalesce_diffs(diffs, keep_unaffected=True)
@@ -0,0 +1,227 @@
+"""
+Server side port of MirrorDom.Broadcaster.prototype.diff_dom.
+
+Compares two lxml trees (e.g. two mirror.DocumentMirror documents made from
+the output of sanitise.sanitise_html) and produces the list of diffs that
+turns the first into the second, in the same format the broadcaster sends.
+This lets broadcasters upload whole documents and leave the diffing to the
+server (see handle_send_snapshot in server.py).
+
+The path and text semantics need to be kept in agreement with diff_dom and
+MirrorDom.get_text_node_content in common.js. Like diff_dom, a node whose tag
+changed is treated as an insertion or deletion: it and all of its right
+siblings are deleted and added again.
+"""
+
+import logging
+
+import lxml
+import lxml.etree
+
+from . import mirror
+
+logger = logging.getLogger("mirrordom.differ")
+
+# Equivalent of MirrorDom.IGNORE_ALL_ATTRIBS and MirrorDom.IGNORE_ATTRIBS.
+# Styles are sent as properties (style.cssText) rather than attributes.
+IGNORE_ALL_ATTRIBS = set(["style"])
+IGNORE_ATTRIBS = {
+    "html": {"src": set(["iframe"])},
+}
+
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
+
+def should_ignore_attribute(node, doc_type, name):
+    """
+    See MirrorDom.should_ignore_attribute
+    """
+    if name in IGNORE_ALL_ATTRIBS:
+        return True
+    ignore = IGNORE_ATTRIBS.get(doc_type)
+    return ignore is not None and node.tag in ignore.get(name, ())
+
+def text_after(node):
+    """
+    Text between node and the next interesting element (see
+    MirrorDom.get_text_node_content)
+    """
+    text = [node.tail or ""]
+    for s in node.itersiblings():
+        if not mirror.should_ignore_node(s):
+            break
+        text.append(s.tail or "")
+    return "".join(text)
+
+def text_before_children(node):
+    """
+    Text between the start of node and its first interesting child
+    """
+    text = [node.text or ""]
+    for c in node:
+        if not mirror.should_ignore_node(c):
+            break
+        text.append(c.tail or "")
+    return "".join(text)
+
+def outer_html(node):
+    return lxml.etree.tostring(node, with_tail=False)
+
+def collect_props(node, props):
+    """
+    Properties of node and everything inside it, with paths relative to node,
+    in the format 'node' diffs carry them (see
+    MirrorDom.Broadcaster.prototype.collect_props_from_dom_iterator)
+
+    :param props:   Element -> (doc type, property dictionary)
+    """
+    result = []
+    stack = [(node, [])]
+    while stack:
+        elem, ipath = stack.pop()
+        try:
+            doc_type, values = props[elem]
+        except KeyError:
+            pass
+        else:
+            if values:
+                result.append([doc_type, ipath, dict(values)])
+        children = mirror.child_elements(elem)
+        for i in xrange(len(children) - 1, -1, -1):
+            stack.append((children[i], ipath + [i]))
+    return result
+
+# -----------------------------------------------------------------------------
+# Diffing
+# -----------------------------------------------------------------------------
+
+def diff_documents(old, new):
+    """
+    Diffs which turn one mirror.DocumentMirror into another, properties
+    included
+    """
+    return diff_trees(old.root, new.root, old.props, new.props)
+
+def diff_trees(old_root, new_root, old_props=None, new_props=None):
+    """
+    Returns the list of diffs which turns the tree at old_root into the tree
+    at new_root. Neither tree is modified.
+
+    :param old_root:    Root (<html>) element of the previous document
+    :param new_root:    Root element of the current document
+    :param old_props:   Element -> (doc type, property dictionary) for the
+                        previous document (see DocumentMirror.props)
+    :param new_props:   Same for the current document
+    """
+    differ = TreeDiffer(old_props or {}, new_props or {})
+    if old_root.tag != new_root.tag:
+        raise ValueError("Can't diff a <%s> document against a <%s> one" % \
+                (old_root.tag, new_root.tag))
+    differ.compare(old_root, new_root, [])
+    logger.debug("Found %s diffs", len(differ.diffs))
+    return differ.diffs
+
+class TreeDiffer(object):
+    """
+    Walks two trees in lockstep, collecting diffs
+    """
+
+    def __init__(self, old_props, new_props):
+        self.old_props = old_props
+        self.new_props = new_props
+        self.diffs = []
+
+    def compare(self, cnode, node, ipath):
+        """
+        Compare two nodes with the same tag, then their children.
+
+        Named after diff_dom: cnode is the previous ("cloned") node and node
+        the current one.
+        """
+        doc_type = mirror.get_doc_type(node)
+        self.diff_attribs(cnode, node, doc_type, ipath)
+        self.diff_props(cnode, node, doc_type, ipath)
+        self.diff_text(cnode, node, doc_type, ipath)
+
+        cchildren = mirror.child_elements(cnode)
+        children = mirror.child_elements(node)
+        for i, child in enumerate(children):
+            child_ipath = ipath + [i]
+            if i >= len(cchildren):
+                # New nodes on the end
+                self.add_nodes(children[i:], child_ipath)
+                return
+            cchild = cchildren[i]
+            if cchild.tag != child.tag:
+                # Something was inserted or deleted here
+                self.delete_nodes(cchild, child_ipath)
+                self.add_nodes(children[i:], child_ipath)
+                return
+            self.compare(cchild, child, child_ipath)
+        if len(cchildren) > len(children):
+            self.delete_nodes(cchildren[len(children)],
+                    ipath + [len(children)])
+
+    def diff_attribs(self, cnode, node, doc_type, ipath):
+        changed = {}
+        removed = []
+        for name, value in node.items():
+            if should_ignore_attribute(node, doc_type, name):
+                continue
+            if cnode.get(name) != value:
+                changed[name] = value
+        for name in cnode.keys():
+            if should_ignore_attribute(node, doc_type, name):
+                continue
+            if name not in node.attrib:
+                removed.append(name)
+        if changed or removed:
+            self.diffs.append(['attribs', doc_type, ipath[:], changed,
+                removed])
+
+    def diff_props(self, cnode, node, doc_type, ipath):
+        cprops = self.old_props.get(cnode, (None, {}))[1]
+        props = self.new_props.get(node, (None, {}))[1]
+        changed = {}
+        removed = []
+        for name, value in props.iteritems():
+            if name not in cprops:
+                # Same as the broadcaster, empty properties don't count
+                if value != '':
+                    changed[name] = value
+            elif cprops[name] != value:
+                changed[name] = value
+        for name in cprops:
+            if name not in props:
+                removed.append(name)
+        if changed or removed:
+            self.diffs.append(['props', doc_type, ipath[:], changed,
+                removed])
+
+    def diff_text(self, cnode, node, doc_type, ipath):
+        tail = text_after(node)
+        if tail == text_after(cnode):
+            tail = None
+        child = text_before_children(node)
+        if child == text_before_children(cnode):
+            child = None
+        if tail is not None or child is not None:
+            self.diffs.append(['text', doc_type, ipath[:], tail, child])
+
+    def add_nodes(self, nodes, ipath):
+        """
+        See MirrorDom.Broadcaster.prototype.handle_diff_add_node
+        """
+        ipath = ipath[:]
+        for node in nodes:
+            self.diffs.append(['node', mirror.get_doc_type(node), ipath[:],
+                outer_html(node), text_after(node),
+                collect_props(node, self.new_props)])
+            ipath[-1] += 1
+
+    def delete_nodes(self, cnode, ipath):
+        """
+        Deletes cnode and all its right siblings
+        """
+        self.diffs.append(['deleted', mirror.get_doc_type(cnode), ipath[:]])
@@ -0,0 +1,150 @@
+"""
+Frame paths identify a frame by how to get to it from the main window, e.g.
+('m', 1, 2, 'i') is the document of the iframe at node [1, 2] of the main
+frame (see handle_send_update in server.py).
+
+FrameTrie stores something per frame, keyed by path component, so everything
+about a frame's subtree (its child frames) is in one place.
+"""
+
+# Marks trie nodes that are only there to lead to deeper frames
+NO_VALUE = object()
+
+class FrameTrie(object):
+    """
+    Persistent trie mapping frame paths to values.
+
+    Tries are never modified: set() and the remove methods return a new trie
+    which shares every untouched branch with the old one. Updates only copy
+    the nodes along one path, and anyone still holding the old trie (e.g.
+    viewers reading a session snapshot) is unaffected.
+
+    Iteration is pre-order, so a frame always comes before the frames inside
+    it.
+    """
+
+    def __init__(self, value=NO_VALUE, children=None, size=None):
+        self.value = value
+        self.children = children if children is not None else {}
+        if size is None:
+            size = (value is not NO_VALUE) + \
+                    sum(len(c) for c in self.children.itervalues())
+        # Number of values in this subtree
+        self.size = size
+
+    def __repr__(self):
+        return "<FrameTrie: %r>" % (dict(self.iteritems()))
+
+    def __len__(self):
+        return self.size
+
+    def __nonzero__(self):
+        return self.size > 0
+
+    # -------------------------------------------------------------------------
+    # Lookup
+    # -------------------------------------------------------------------------
+
+    def find(self, path):
+        """
+        Returns the node at path, or None
+        """
+        node = self
+        for component in path:
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node
+
+    def get(self, path, default=None):
+        node = self.find(path)
+        if node is None or node.value is NO_VALUE:
+            return default
+        return node.value
+
+    def __getitem__(self, path):
+        value = self.get(path, NO_VALUE)
+        if value is NO_VALUE:
+            raise KeyError(path)
+        return value
+
+    def __contains__(self, path):
+        return self.get(path, NO_VALUE) is not NO_VALUE
+
+    def iteritems(self, prefix=()):
+        """
+        (path, value) pairs, parents before children
+        """
+        if self.value is not NO_VALUE:
+            yield prefix, self.value
+        for component in sorted(self.children):
+            for item in self.children[component].iteritems(
+                    prefix + (component,)):
+                yield item
+
+    def iterkeys(self):
+        return (path for path, value in self.iteritems())
+
+    def itervalues(self):
+        return (value for path, value in self.iteritems())
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    # -------------------------------------------------------------------------
+    # Updates
+    # -------------------------------------------------------------------------
+
+    def set(self, path, value):
+        """
+        Returns a new trie with value stored at path
+        """
+        return self.replace(path, lambda node: FrameTrie(value, node.children,
+                node.size + (node.value is NO_VALUE)))
+
+    def remove(self, path):
+        """
+        Returns a new trie without the value at path. Frames inside it are
+        kept.
+        """
+        if path not in self:
+            raise KeyError(path)
+        return self.replace(path, lambda node: FrameTrie(NO_VALUE,
+                node.children, node.size - 1))
+
+    def remove_children(self, path):
+        """
+        Returns a new trie without any of the frames inside the frame at path
+        """
+        node = self.find(path)
+        if node is None or not node.children:
+            return self
+        return self.replace(path, lambda node: FrameTrie(node.value))
+
+    def replace(self, path, update):
+        """
+        Returns a new trie with the node at path (or an empty one) replaced by
+        update(node). Empty branches are pruned.
+        """
+        if not path:
+            return update(self)
+        component = path[0]
+        old = self.children.get(component, EMPTY)
+        new = old.replace(path[1:], update)
+        children = dict(self.children)
+        if new.size:
+            children[component] = new
+        else:
+            children.pop(component, None)
+        return FrameTrie(self.value, children,
+                self.size - old.size + new.size)
+
+EMPTY = FrameTrie()
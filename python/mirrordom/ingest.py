@@ -0,0 +1,295 @@
+"""
+Handle broadcaster updates off the request thread.
+
+handle_send_update (see server.py) parses and sanitises every message inside
+the broadcaster's request, which for a big page takes a while. An
+IngestPipeline does the same work in stages on a pool of worker threads:
+
+- decode:   JSON decode the messages, if they're still encoded
+- parse:    sanitise.parse_sanitised on each page or 'node'/'insert'
+            fragment, which sanitises as it parses
+- sanitise: serialising the result
+- commit:   server.commit_message for each message, then
+            Session.update_frames, all in one Session.batch
+
+The first three stages run on whichever worker picks the update up, so
+several updates can be on their way at once. Commits happen strictly in the
+order updates were submitted to each session (a later update that's ready
+first waits for the earlier ones), and change ids are handed out as updates
+are committed, so they're in arrival order too.
+
+Timings for each stage, along with the time updates spend queued for a
+worker ("queue") and waiting for earlier updates to commit ("reorder"), are
+kept in `timings` (see StageTimings).
+
+Note that Python threads only run Python code one at a time, so most of the
+benefit is that broadcasters don't wait for their updates to be handled.
+Usage (demo/demo.py does this for its send_update route):
+
+    pipeline = mirrordom.ingest.IngestPipeline(workers=4)
+    pipeline.submit(session, messages, iframes)
+
+submit returns before the update's committed, so viewers can briefly miss
+it. Use pipeline.flush(session) to wait until everything submitted for a
+session is visible, and pipeline.stop() on shutdown, which commits what's
+still queued before the workers exit (they're daemon threads, so anything
+left is lost otherwise).
+"""
+
+import json
+import time
+import logging
+import threading
+import weakref
+import Queue
+
+import lxml
+import lxml.etree
+
+from . import parser
+from . import sanitise
+from . import server
+
+logger = logging.getLogger("mirrordom.ingest")
+
+STAGES = ["queue", "decode", "parse", "sanitise", "reorder", "commit"]
+
+# -----------------------------------------------------------------------------
+# Stages
+# -----------------------------------------------------------------------------
+
+def parse_and_sanitise(html, timings, retain_case=False, is_fragment=False):
+    """
+    sanitise.sanitise_html, timing parsing and serialising. Goes through
+    sanitise.cache, so nothing's recorded for HTML that's been seen before.
+    """
+    def build():
+        start = time.time()
+        tree = sanitise.parse_sanitised(html, retain_case=retain_case)
+        parsed = time.time()
+        result = lxml.etree.tostring(tree)
+        timings.record("parse", parsed - start)
+        timings.record("sanitise", time.time() - parsed)
+        return result
+    return sanitise.cache.get(html, build, retain_case=retain_case,
+            is_fragment=is_fragment)
+
+def prepare_message(update_type, update_data, timings):
+    """
+    Everything about handling a message that doesn't involve the session.
+    Returns a copy of update_data for server.commit_message.
+    """
+    data = dict(update_data)
+    try:
+        if update_type == "diffs":
+            # Same as sanitise.sanitise_diffs
+            diffs = []
+            for diff in data["diffs"]:
+                if diff[0] in ("node", "insert"):
+                    diff = list(diff)
+                    diff[3] = parse_and_sanitise(diff[3], timings,
+                            retain_case=(diff[1] == "svg"), is_fragment=True)
+                diffs.append(diff)
+            data["diffs"] = diffs
+        else:
+            data["html"] = parse_and_sanitise(data["html"], timings)
+    except parser.HTMLParseError, e:
+        data = {"error": str(e)}
+    return data
+
+# -----------------------------------------------------------------------------
+# Pipeline
+# -----------------------------------------------------------------------------
+
+class StageTimings(object):
+    """
+    Count, total and maximum seconds spent in each stage
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = dict((stage, [0, 0.0, 0.0]) for stage in STAGES)
+
+    def __repr__(self):
+        return "<StageTimings: %r>" % (self.summary())
+
+    def record(self, stage, seconds):
+        with self.lock:
+            entry = self.stages[stage]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def summary(self):
+        """
+        stage -> {"count", "total", "mean", "max"}
+        """
+        with self.lock:
+            return dict((stage, {"count": count, "total": total,
+                "mean": total / count if count else 0.0, "max": longest}) \
+                for stage, (count, total, longest) in self.stages.iteritems())
+
+class SessionIngest(object):
+    """
+    Keeps one session's updates in order: each gets a sequence number when
+    it's submitted, and prepared updates wait in `ready` until everything
+    before them has been committed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        self.committed = threading.Condition(self.lock)
+        self.next_seq = 0
+        self.next_commit = 0
+        self.ready = {}
+
+    def __repr__(self):
+        return "<SessionIngest: %s of %s committed>" % (self.next_commit,
+                self.next_seq)
+
+class IngestUpdate(object):
+    def __init__(self, storage, state, seq, messages, iframes):
+        self.storage = storage
+        self.state = state
+        self.seq = seq
+        self.messages = messages
+        self.iframes = iframes
+        self.submitted = time.time()
+        self.ready = None
+        self.prepared = None
+
+class IngestPipeline(object):
+    """
+    See the module docstring.
+
+    :param workers:     Number of worker threads
+    """
+
+    def __init__(self, workers=4):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # Session -> SessionIngest
+        self.sessions = weakref.WeakKeyDictionary()
+        self.timings = StageTimings()
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.run,
+                    name="mirrordom-ingest-%s" % (i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def __repr__(self):
+        return "<IngestPipeline: %s workers, %s queued>" % (len(self.threads),
+                self.queue.qsize())
+
+    def submit(self, storage, messages, iframes):
+        """
+        Queue a handle_send_update for storage (a Session) and return
+        straight away. messages and iframes may still be JSON encoded.
+        """
+        with self.lock:
+            state = self.sessions.get(storage)
+            if state is None:
+                state = self.sessions[storage] = SessionIngest()
+        with state.lock:
+            seq = state.next_seq
+            state.next_seq += 1
+        self.queue.put(IngestUpdate(storage, state, seq, messages, iframes))
+
+    def flush(self, storage, timeout=None):
+        """
+        Wait until everything submitted for storage so far has been
+        committed. Returns False if that took longer than timeout seconds.
+        """
+        with self.lock:
+            state = self.sessions.get(storage)
+        if state is None:
+            return True
+        deadline = time.time() + timeout if timeout is not None else None
+        with state.lock:
+            target = state.next_seq
+            while state.next_commit < target:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                state.committed.wait(remaining)
+        return True
+
+    def stop(self):
+        """
+        Finish the updates already queued, then stop the workers
+        """
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def run(self):
+        while True:
+            update = self.queue.get()
+            if update is None:
+                return
+            self.timings.record("queue", time.time() - update.submitted)
+            try:
+                self.prepare(update)
+            except Exception:
+                # Commit it anyway (as nothing), so later updates go through
+                logger.exception("Couldn't prepare update %s", update.seq)
+                update.prepared = None
+            self.commit_ready(update)
+
+    def prepare(self, update):
+        start = time.time()
+        messages, iframes = update.messages, update.iframes
+        if isinstance(messages, basestring):
+            messages = json.loads(messages)
+        if isinstance(iframes, basestring):
+            iframes = json.loads(iframes)
+        self.timings.record("decode", time.time() - start)
+
+        prepared = []
+        for frame_path, update_type, update_data in messages:
+            prepared.append((tuple(frame_path), update_type,
+                prepare_message(update_type, update_data, self.timings)))
+        update.prepared = (prepared, iframes)
+
+    def commit_ready(self, update):
+        """
+        Commit update, and anything after it that's ready, if it's next
+        """
+        state = update.state
+        update.ready = time.time()
+        with state.lock:
+            state.ready[update.seq] = update
+        with state.commit_lock:
+            while True:
+                with state.lock:
+                    update = state.ready.pop(state.next_commit, None)
+                if update is None:
+                    return
+                self.timings.record("reorder", time.time() - update.ready)
+                start = time.time()
+                try:
+                    self.commit(update)
+                except Exception:
+                    logger.exception("Couldn't commit update %s", update.seq)
+                self.timings.record("commit", time.time() - start)
+                with state.lock:
+                    state.next_commit += 1
+                    state.committed.notify_all()
+
+    def commit(self, update):
+        if update.prepared is None:
+            return
+        messages, iframes = update.prepared
+        storage = update.storage
+        with storage.batch():
+            for frame_id, update_type, update_data in messages:
+                server.commit_message(storage, frame_id, update_type,
+                        update_data)
+            storage.update_frames(iframes)
@@ -0,0 +1,83 @@
+"""
+Content hashes of document subtrees, for viewers to check their copy of a
+document against the server's.
+
+Every element gets a hash of its subtree, built from a "shallow" hash of the
+element itself (tag, attributes, leading child text and tail text) and the
+hashes of its children, so a viewer that finds its root hash doesn't match
+can work down the tree to the subtrees that differ and fetch just those (see
+handle_get_subtree in server.py).
+
+The hashes need to be kept in agreement with MirrorDom.shallow_hash and
+MirrorDom.subtree_hash in common.js, which compute the same thing from the
+viewer's DOM. They're 32 bit FNV-1a over UTF-16 code units, since that's what
+JavaScript strings are made of.
+
+Properties aren't included: they're not part of the HTML.
+"""
+
+import sys
+import array
+
+from . import mirror
+from . import differ
+
+FNV_OFFSET = 0x811c9dc5
+FNV_PRIME = 0x01000193
+
+def hash_string(s, h=FNV_OFFSET):
+    if isinstance(s, str):
+        s = s.decode("utf-8")
+    units = array.array("H", s.encode("utf-16-le"))
+    if sys.byteorder == "big":
+        units.byteswap()
+    for c in units:
+        h = ((h ^ c) * FNV_PRIME) & 0xffffffff
+    return h
+
+def to_hex(h):
+    return "%08x" % (h)
+
+def local_name(tag):
+    """
+    Tag or attribute name without any namespace, lowercased like the viewer's
+    nodeName
+    """
+    if tag.startswith("{"):
+        tag = tag.split("}", 1)[1]
+    return tag.lower()
+
+def shallow_hash(elem):
+    """
+    Hash of everything about elem except its children
+    """
+    doc_type = mirror.get_doc_type(elem)
+    # Namespaced attributes are skipped, whether lxml resolved the prefix
+    # ({...}href) or not (xlink:href), as the viewer skips them
+    attribs = sorted("%s=%s" % (name, value) for name, value in elem.items() \
+            if not name.startswith("{") and ":" not in name and \
+            not differ.should_ignore_attribute(elem, doc_type, name))
+    # The root element's tail isn't part of the document
+    tail = differ.text_after(elem) if elem.getparent() is not None else ""
+    content = u"\x01".join([local_name(elem.tag), u"\x02".join(attribs),
+        differ.text_before_children(elem), tail])
+    return to_hex(hash_string(content))
+
+def subtree_hash(elem, cache):
+    """
+    Hash of elem and everything inside it.
+
+    :param cache:   Element -> subtree hash, for subtrees that haven't changed
+                    (see mirror.DocumentMirror.hashes)
+    """
+    try:
+        return cache[elem]
+    except KeyError:
+        pass
+    parts = [shallow_hash(elem)]
+    parts.extend(subtree_hash(c, cache) for c in mirror.child_elements(elem))
+    result = cache[elem] = to_hex(hash_string("".join(parts)))
+    return result
+
+def child_hashes(elem, cache):
+    return [subtree_hash(c, cache) for c in mirror.child_elements(elem)]
@@ -0,0 +1,205 @@
+"""
+Rewrite the sibling re-adds in a diff list into 'insert' and 'move' diffs.
+
+When diff_dom (see MirrorDom.Broadcaster.prototype.diff_dom) finds a changed
+node it deletes it and all of its right siblings, then sends every one of
+them again as a 'node' diff. Prepending an item to a long list sends the
+whole list. Given the document the diffs apply to, the re-added nodes that
+are identical to ones already there can be kept where they are:
+
+- ['insert', type, ipath, html, tail, props]: like 'node', but the node at
+  ipath and its right siblings are kept, after the new node.
+- ['move', type, ipath, new_index]: take the node at ipath (and its tail
+  text) out and put it back so it's at new_index among its siblings.
+
+Nodes that aren't wanted any more are moved to the end and removed with one
+'deleted' diff.
+
+A run is only rewritten when that's smaller, and when it's simple: HTML
+nodes only, with nothing ignored (see mirror.should_ignore_node) between the
+siblings. Otherwise, or if the rewritten diffs don't leave the document as
+expected, the original diffs are used.
+"""
+
+import json
+import hashlib
+import logging
+
+from . import mirror
+from . import differ
+
+logger = logging.getLogger("mirrordom.minimise")
+
+# -----------------------------------------------------------------------------
+# Runs
+# -----------------------------------------------------------------------------
+
+def find_run(diffs, pos):
+    """
+    Returns the end of the run of sibling re-adds starting at pos, or None if
+    there isn't one there. A run is an optional 'deleted' diff followed by
+    'node' diffs for consecutive siblings, starting at the same path.
+    """
+    diff = diffs[pos]
+    if diff[0] not in ("deleted", "node") or diff[1] != "html" or \
+            not diff[2]:
+        return None
+    path = diff[2]
+    end = pos + 1 if diff[0] == "deleted" else pos
+    index = path[-1]
+    while end < len(diffs):
+        d = diffs[end]
+        if d[0] != "node" or d[1] != "html" or \
+                d[2] != path[:-1] + [index]:
+            break
+        end += 1
+        index += 1
+    if end == pos or (end == pos + 1 and diff[0] == "deleted"):
+        return None
+    return end
+
+def node_key(html, tail, props):
+    """
+    Identifies a node by everything a 'node' diff would say about it
+    """
+    h = hashlib.sha1()
+    h.update(html)
+    h.update("\0")
+    h.update((tail or "").encode("utf-8"))
+    h.update("\0")
+    h.update(json.dumps(props, sort_keys=True))
+    return h.digest()
+
+def element_key(document, elem):
+    return node_key(differ.outer_html(elem), elem.tail,
+            differ.collect_props(elem, document.props))
+
+def diff_key(diff):
+    html = diff[3]
+    if isinstance(html, unicode):
+        html = html.encode("utf-8")
+    return node_key(html, diff[4], diff[5])
+
+# -----------------------------------------------------------------------------
+# Rewriting
+# -----------------------------------------------------------------------------
+
+def plan_run(document, run):
+    """
+    Work out the 'insert'/'move'/'deleted' equivalent of a run.
+
+    Returns (diffs, parent, start, expected) where expected is the elements
+    which should end up at the run's path and after it (None for inserted
+    ones), or None if the run should be left alone.
+    """
+    path = run[0][2]
+    parent_path, start = path[:-1], path[-1]
+    try:
+        parent = mirror.node_at_path(document.root, parent_path)
+    except mirror.PathError:
+        return None
+    siblings = mirror.child_elements(parent)
+    old = siblings[start:]
+    if not old:
+        return None
+    if list(parent)[parent.index(old[0]):] != old:
+        # Something ignored in amongst them
+        return None
+    if any(mirror.get_doc_type(e) != "html" for e in old):
+        return None
+
+    # Pair up each new node with an identical old one, in order
+    available = {}
+    for i, elem in enumerate(old):
+        available.setdefault(element_key(document, elem), []).append(i)
+    for indexes in available.itervalues():
+        indexes.reverse()
+    new = [d for d in run if d[0] == "node"]
+    matches = []
+    for d in new:
+        indexes = available.get(diff_key(d))
+        matches.append(indexes.pop() if indexes else None)
+    if all(m is None for m in matches):
+        return None
+
+    diffs = []
+    current = range(len(old))
+
+    # Move the old nodes nobody wants to the end, then drop them
+    kept = set(m for m in matches if m is not None)
+    end = len(current)
+    for i in xrange(len(old) - 1, -1, -1):
+        if i in kept:
+            continue
+        pos = current.index(i)
+        if pos != end - 1:
+            diffs.append(['move', 'html', parent_path + [start + pos],
+                start + end - 1])
+            current.pop(pos)
+            current.insert(end - 1, i)
+        end -= 1
+    if end < len(current):
+        diffs.append(['deleted', 'html', parent_path + [start + end]])
+        del current[end:]
+
+    # Put everything in order, inserting the new nodes
+    for j, (d, m) in enumerate(zip(new, matches)):
+        if m is None:
+            diffs.append(['insert', 'html', parent_path + [start + j]] + \
+                    d[3:6])
+            current.insert(j, None)
+            continue
+        pos = current.index(m, j)
+        if pos != j:
+            diffs.append(['move', 'html', parent_path + [start + pos],
+                start + j])
+            current.pop(pos)
+            current.insert(j, m)
+
+    if len(json.dumps(diffs)) >= len(json.dumps(run)):
+        return None
+    expected = [old[i] if i is not None else None for i in current]
+    return diffs, parent, start, expected
+
+def apply_run(document, run):
+    """
+    Apply a run to document, returning the diffs that were actually used
+    """
+    plan = plan_run(document, run)
+    if plan is None:
+        document.apply_diffs(run)
+        return run
+    diffs, parent, start, expected = plan
+    document.apply_diffs(diffs)
+
+    result = mirror.child_elements(parent)[start:]
+    if len(result) != len(expected) or any(e is not None and r is not e \
+            for r, e in zip(result, expected)):
+        # The node diffs rebuild everything from the start of the run, so
+        # they put right whatever went wrong
+        logger.warn("Minimised diffs didn't apply as expected, using the "
+                "originals")
+        document.apply_diffs(run)
+        return run
+    logger.debug("Minimised %s diffs into %s", len(run), len(diffs))
+    return diffs
+
+def minimise_diffs(document, diffs):
+    """
+    Apply diffs to document (a mirror.DocumentMirror), returning a list of
+    diffs with the same effect, with sibling re-adds rewritten where that
+    makes them smaller. Raises what DocumentMirror.apply_diffs raises, in
+    which case the document is no good any more.
+    """
+    result = []
+    pos = 0
+    while pos < len(diffs):
+        end = find_run(diffs, pos)
+        if end is None:
+            document.apply_diffs(diffs[pos:pos + 1])
+            result.append(diffs[pos])
+            pos += 1
+        else:
+            result.extend(apply_run(document, diffs[pos:end]))
+            pos = end
+    return result
@@ -0,0 +1,440 @@
+"""
+Server side replica of a frame document.
+
+Applies the diffs produced by the broadcaster (see
+MirrorDom.Broadcaster.prototype.diff_dom) to an lxml tree, replicating what
+MirrorDom.Viewer.prototype.apply_diffs does to the viewer's DOM. This lets the
+server work out what a document currently looks like without replaying the
+diffs in a browser.
+
+The path semantics need to be kept in agreement with MirrorDom.node_at_path,
+MirrorDom.nth_child and MirrorDom.should_ignore_node in common.js.
+"""
+
+import logging
+from xml.sax.saxutils import escape
+
+import lxml
+import lxml.etree
+
+logger = logging.getLogger("mirrordom.mirror")
+
+SVG_NAMESPACE = "http://www.w3.org/2000/svg"
+
+# Equivalent of MirrorDom.IGNORE_NODES and MirrorDom.ACCEPT_HTML_NODES
+IGNORE_NODES = set(["meta", "script", "title"])
+ACCEPT_HTML_NODES = set(["body", "head"])
+
+# Same escaping as libxml2 uses for attribute values
+ATTRIBUTE_ENTITIES = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;",
+        "\t": "&#9;"}
+
+# Exceptions
+class PathError(Exception):
+    def __init__(self, path):
+        msg = "Couldn't retrieve path %r" % (path,)
+        Exception.__init__(self, msg)
+
+class DiffError(Exception):
+    def __init__(self, diff, msg):
+        msg = "Couldn't apply diff %r: %s" % (diff[:3], msg)
+        Exception.__init__(self, msg)
+
+# -----------------------------------------------------------------------------
+# Parsing
+# -----------------------------------------------------------------------------
+
+def parse_xml(html):
+    """
+    Parse the output of sanitise.sanitise_html.
+
+    The sanitised HTML is XML, except VML elements have namespace prefixes
+    that are never declared (e.g. <v:rect>). Recovery mode keeps these as
+    literal tag names.
+    """
+    parser = lxml.etree.XMLParser(recover=True, resolve_entities=False,
+            huge_tree=True)
+    try:
+        root = lxml.etree.fromstring(html, parser)
+    except lxml.etree.XMLSyntaxError, e:
+        raise ValueError(str(e))
+    if root is None:
+        raise ValueError("No XML element found")
+    return root
+
+# -----------------------------------------------------------------------------
+# Traversal
+# -----------------------------------------------------------------------------
+
+def is_element(node):
+    # Comments and processing instructions have a function for a tag
+    return isinstance(node.tag, basestring)
+
+def should_ignore_node(node):
+    """
+    See MirrorDom.should_ignore_node
+    """
+    if not is_element(node):
+        return True
+    tag = node.tag
+    if tag in IGNORE_NODES:
+        return True
+    parent = node.getparent()
+    if parent is not None and parent.tag == "html" and \
+            tag not in ACCEPT_HTML_NODES:
+        return True
+    return False
+
+def child_elements(node):
+    """
+    Returns the children that count towards ipath offsets
+    """
+    return [c for c in node if not should_ignore_node(c)]
+
+def nth_child(node, pos):
+    """
+    See MirrorDom.nth_child. Returns None if pos is past the last child.
+    """
+    for c in node:
+        if should_ignore_node(c):
+            continue
+        if pos == 0:
+            return c
+        pos -= 1
+    return None
+
+def node_at_path(root, ipath):
+    """
+    See MirrorDom.node_at_path
+    """
+    node = root
+    for pos in ipath:
+        node = nth_child(node, pos)
+        if node is None:
+            raise PathError(ipath)
+    return node
+
+def get_ipath(root, node):
+    """
+    Inverse of node_at_path
+    """
+    ipath = []
+    while node is not root:
+        parent = node.getparent()
+        if parent is None:
+            raise PathError(ipath)
+        pos = 0
+        for c in parent:
+            if c is node:
+                break
+            if not should_ignore_node(c):
+                pos += 1
+        ipath.append(pos)
+        node = parent
+    ipath.reverse()
+    return ipath
+
+def get_doc_type(node):
+    """
+    Rough equivalent of MirrorDom.determine_node_doc_type
+    """
+    tag = node.tag
+    if tag.startswith("{%s}" % (SVG_NAMESPACE)):
+        return "svg"
+    elif tag.startswith("v:"):
+        return "vml"
+    return "html"
+
+def start_tag(elem):
+    """
+    Opening tag of elem, for the elements tostring() serialises by hand
+    """
+    attribs = "".join(' %s="%s"' % (name, escape(value, ATTRIBUTE_ENTITIES)) \
+            for name, value in elem.items())
+    return "<%s%s>" % (elem.tag, attribs)
+
+# -----------------------------------------------------------------------------
+# Mirror
+# -----------------------------------------------------------------------------
+
+class DocumentMirror(object):
+    """
+    An lxml tree that diffs can be applied to.
+
+    Properties (e.g. the value of an <input>) never make it into the HTML, so
+    they're tracked separately against each element.
+
+    Serialising is incremental: the HTML of each child of <head> and <body>
+    (a "chunk") is cached until a diff touches something inside it, so
+    tostring() only has to serialise what changed since last time.
+    """
+
+    def __init__(self, html):
+        """
+        :param html:    Sanitised HTML (see sanitise.sanitise_html)
+        """
+        self.root = parse_xml(html)
+
+        # Element -> (doc type, property dictionary). lxml keeps the same
+        # proxy object alive for as long as we hold a reference, so elements
+        # are safe to use as keys.
+        self.props = {}
+
+        # Chunk element -> serialised chunk (including its tail)
+        self.chunks = {}
+
+        # Element -> subtree hash (see merkle.py), for subtrees nothing has
+        # touched since they were hashed
+        self.hashes = {}
+
+    def tostring(self):
+        """
+        Serialise the document, reusing the chunks that haven't changed
+        """
+        parts = []
+        self.serialise_container(self.root, parts, 0)
+        return "".join(parts)
+
+    def serialise_container(self, elem, parts, depth):
+        """
+        Serialise <html>, <head> or <body> around their (cached) children
+        """
+        tag = start_tag(elem)
+        if not elem.text and not len(elem):
+            parts.append(tag[:-1] + "/>")
+        else:
+            parts.append(tag)
+            if elem.text:
+                parts.append(escape(elem.text))
+            for child in elem:
+                if depth == 0 and is_element(child):
+                    self.serialise_container(child, parts, 1)
+                    continue
+                try:
+                    chunk = self.chunks[child]
+                except KeyError:
+                    chunk = self.chunks[child] = lxml.etree.tostring(child)
+                parts.append(chunk)
+            parts.append("</%s>" % (elem.tag))
+        if depth > 0 and elem.tail:
+            parts.append(escape(elem.tail))
+
+    def invalidate(self, node):
+        """
+        Throw away the cached chunk containing node, and the hashes of node
+        and everything above it
+        """
+        if node is not None and should_ignore_node(node):
+            # Text after ignored nodes counts as the tail of the element
+            # before them
+            prev = node.getprevious()
+            while prev is not None and should_ignore_node(prev):
+                prev = prev.getprevious()
+            if prev is not None:
+                self.hashes.pop(prev, None)
+        chunk_found = False
+        while node is not None:
+            self.hashes.pop(node, None)
+            parent = node.getparent()
+            if parent is None:
+                return
+            if not chunk_found and (parent.getparent() is self.root or \
+                    (parent is self.root and not is_element(node))):
+                self.chunks.pop(node, None)
+                chunk_found = True
+            node = parent
+
+    def get_prop_diffs(self):
+        """
+        Returns the tracked properties in the same format as the initial
+        'props' diffs sent by the broadcaster with a new page.
+        """
+        result = []
+        for elem in self.root.iter():
+            try:
+                doc_type, props = self.props[elem]
+            except KeyError:
+                continue
+            if props:
+                ipath = get_ipath(self.root, elem)
+                result.append(['props', doc_type, ipath, dict(props)])
+        return result
+
+    # -------------------------------------------------------------------------
+    # Diff application
+    # -------------------------------------------------------------------------
+
+    def apply_diffs(self, diffs):
+        for diff in diffs:
+            try:
+                handler = getattr(self, "apply_" + diff[0])
+            except AttributeError:
+                raise DiffError(diff, "Unknown diff type")
+            try:
+                handler(diff)
+            except PathError:
+                raise
+            except (ValueError, IndexError, TypeError), e:
+                raise DiffError(diff, str(e))
+
+    def apply_node(self, diff):
+        """
+        [1] Type [2] Path [3] Outer HTML [4] Tail text [5] Properties
+        """
+        ipath = diff[2]
+        parent = node_at_path(self.root, ipath[:-1])
+        node = nth_child(parent, ipath[-1])
+        if node is not None:
+            # The diff contains a reconstruction of ALL remaining siblings
+            self.delete_node_and_remaining_siblings(node)
+        self.insert_node(parent, None, diff)
+
+    def apply_insert(self, diff):
+        """
+        [1] Type [2] Path [3] Outer HTML [4] Tail text [5] Properties
+
+        Like 'node', but the node at the path and its right siblings are
+        kept, after the new node (see minimise.py)
+        """
+        ipath = diff[2]
+        parent = node_at_path(self.root, ipath[:-1])
+        before = nth_child(parent, ipath[-1])
+        if before is None and len(child_elements(parent)) != ipath[-1]:
+            raise PathError(ipath)
+        self.insert_node(parent, before, diff)
+
+    def apply_move(self, diff):
+        """
+        [1] Type [2] Path [3] New position
+
+        The node (and its tail text) is taken out and put back in so that it
+        ends up at the new position among its siblings.
+        """
+        node = node_at_path(self.root, diff[2])
+        new_pos = diff[3]
+        parent = node.getparent()
+        siblings = [c for c in child_elements(parent) if c is not node]
+        if new_pos > len(siblings):
+            raise ValueError("Position %s is past the end" % (new_pos))
+        # Text following ignored siblings counts as the tail of the element
+        # before them, wherever the node goes
+        self.invalidate(node)
+        self.invalidate(node.getprevious())
+        if new_pos < len(siblings):
+            siblings[new_pos].addprevious(node)
+        else:
+            parent.append(node)
+        self.invalidate(node)
+        self.invalidate(node.getprevious())
+
+    def apply_text(self, diff):
+        """
+        [1] Type [2] Path [3] Tail value [4] Child value
+        """
+        node = node_at_path(self.root, diff[2])
+        tail_text, child_text = diff[3:5]
+        if tail_text is not None:
+            node.tail = tail_text
+            self.invalidate(node)
+            self.clear_tails(node.itersiblings())
+        if child_text is not None:
+            node.text = child_text
+            self.invalidate(node)
+            self.clear_tails(iter(node))
+
+    def apply_attribs(self, diff):
+        """
+        [1] Type [2] Path [3] Changed attributes [4] Removed attributes
+        """
+        node = node_at_path(self.root, diff[2])
+        self.invalidate(node)
+        changed = diff[3]
+        removed = diff[4] if len(diff) > 4 else None
+        for name, value in changed.iteritems():
+            try:
+                node.set(name, value if value is not None else "")
+            except ValueError:
+                # e.g. namespace prefixed attributes such as xlink:href
+                logger.debug("Skipping attribute %r on %s", name, node.tag)
+        for name in removed or []:
+            node.attrib.pop(name, None)
+
+    def apply_props(self, diff):
+        """
+        [1] Type [2] Path [3] Changed properties [4] Removed properties
+        """
+        node = node_at_path(self.root, diff[2])
+        removed = diff[4] if len(diff) > 4 else None
+        self.set_props(node, diff[1], diff[3], removed)
+
+    def apply_deleted(self, diff):
+        """
+        [1] Type [2] Path
+        """
+        node = node_at_path(self.root, diff[2])
+        self.delete_node_and_remaining_siblings(node)
+
+    # -------------------------------------------------------------------------
+    # Helpers
+    # -------------------------------------------------------------------------
+
+    def insert_node(self, parent, before, diff):
+        """
+        Create the node described by a 'node' or 'insert' diff and put it
+        before `before` (or at the end if that's None)
+        """
+        doc_type, ipath, html, tail_text, props = diff[1:6]
+        new = parse_xml(html)
+        if doc_type == "svg":
+            self.inherit_namespace(parent, new)
+        new.tail = tail_text
+        if before is None:
+            parent.append(new)
+        else:
+            before.addprevious(new)
+        self.invalidate(new)
+
+        for prop_doc_type, prop_path, prop_values in props:
+            pnode = node_at_path(new, prop_path)
+            self.set_props(pnode, prop_doc_type, prop_values, None)
+
+    def set_props(self, node, doc_type, changed, removed):
+        current = self.props.get(node, (doc_type, {}))[1]
+        current.update(changed)
+        for name in removed or []:
+            current.pop(name, None)
+        self.props[node] = (doc_type, current)
+
+    def delete_node_and_remaining_siblings(self, node):
+        parent = node.getparent()
+        self.invalidate(parent)
+        pos = parent.index(node)
+        for removed in parent[pos:]:
+            self.chunks.pop(removed, None)
+            for elem in removed.iter():
+                self.props.pop(elem, None)
+                self.hashes.pop(elem, None)
+        del parent[pos:]
+
+    def clear_tails(self, siblings):
+        """
+        Wipe text up until the next interesting element (see
+        MirrorDom.Viewer.prototype.delete_text_nodes)
+        """
+        for s in siblings:
+            if not should_ignore_node(s):
+                break
+            s.tail = None
+            self.invalidate(s)
+
+    def inherit_namespace(self, parent, new):
+        """
+        SVG fragments don't carry the xmlns attribute of the parent <svg>
+        element (see MirrorDom.to_svg)
+        """
+        if not parent.tag.startswith("{"):
+            return
+        namespace = parent.tag[1:].split("}", 1)[0]
+        for elem in new.iter():
+            if is_element(elem) and not elem.tag.startswith("{"):
+                elem.tag = "{%s}%s" % (namespace, elem.tag)
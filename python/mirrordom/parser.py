@@ -7,10 +7,12 @@ We'll try using lxml.html.Elements.
 
 import re
 import logging
+import collections
 from HTMLParser import HTMLParser, HTMLParseError
-from HTMLParser import tagfind, endendtag, endtagfind  # For HTMLParser hacks
+from HTMLParser import endendtag, endtagfind  # For HTMLParser hacks
 
 from lxml.html import Element
+import lxml.etree
 import lxml.html
 
 logger = logging.getLogger("mirrordom.parser")
@@ -64,12 +66,16 @@ class OuterHTMLParser(HTMLParser):
         "col", "tbody", "thead", "tfoot", "colgroup",
     ])
 
+    # Past this many, elements are made with all their attributes at once
+    MANY_ATTRIBUTES = 16
+
     # Override standard CDATA handling
     CDATA_CONTENT_ELEMENTS = ()
     CDATA_CONTENT_ELEMENTS_V2 = set(['script', 'style'])
 
     def __init__(self, retain_case=False):
         self.stack = []
+        self.starttag_span = None
         self.root = None
 
         # These two variables determine case sensitivity
@@ -105,9 +111,13 @@ class OuterHTMLParser(HTMLParser):
         """
         Handle a new tag. Performs autoclose checks.
         """
-        new = Element(tag)
-        attrs = ((k, v or "") for k, v in attrs)
-        new.attrib.update(attrs)
+        attrs = [(k, v or "") for k, v in attrs]
+        if len(attrs) > self.MANY_ATTRIBUTES:
+            # Setting attributes one at a time is much slower in lxml
+            new = Element(tag, collections.OrderedDict(attrs))
+        else:
+            new = Element(tag)
+            new.attrib.update(attrs)
 
         if self.root is None:
             self.root = new
@@ -181,126 +191,126 @@ class OuterHTMLParser(HTMLParser):
         elem.append(comment)
 
     # -------------------------------------------------------------------------
-    # HACK check_for_whole_start_tag to tolerate bad attributes (sigh)
+    # HACK parse_starttag to tolerate bad attributes (sigh)
     # -------------------------------------------------------------------------
 
     def should_retain_case(self, tag=None):
         return self.retain_case or self.in_svg or tag == "svg"
 
-    LOCATESTARTTAGEND = re.compile(r"""
-      <[a-zA-Z][-.a-zA-Z0-9:_]*          # tag name
-      (?:\s+                             # whitespace before attribute name
-        (?:[a-zA-Z_][-.:a-zA-Z0-9_]*     # attribute name
-          (?:\s*=\s*                     # value indicator
-            (?:'[^']*'                   # LITA-enclosed value
-              |\"[^\"]*\"                # LIT-enclosed value
-              |[^'\">\s]+                # bare value
-             )
-           )?
-              | (\?)                     # IE Hack (single question mark)
-              | (\"=\"\")                # Chrome Hack ( "="" )
-         )
-       )*
-      \s*                                # trailing whitespace
+    # Start tags are scanned once, left to right, with these (matched in place,
+    # and none has nested repetition, so scanning is linear in the length of
+    # the tag). They accept the same tags as HTMLParser's locatestarttagend
+    # with two additions:
+    #
+    #   IE:     <a href="hello""> becomes <a href="hello" ?>
+    #   Chrome: <a href="hello""> becomes <a href="hello" "="">
+    #
+    # The extra attributes are ignored.
+    TAGNAME = re.compile(r"[a-zA-Z][-.a-zA-Z0-9:_]*")
+    SPACE = re.compile(r"\s*")
+    ATTRIBUTE = re.compile(r"""
+      \s+                                # whitespace before attribute
+      (?:([a-zA-Z_][-.:a-zA-Z0-9_]*)     # attribute name
+        (?:\s*=\s*                       # value indicator
+          ('[^']*'                       # LITA-enclosed value
+          |"[^"]*"                       # LIT-enclosed value
+          |[^'">\s]+                     # bare value
+          )
+        )?
+      | \?                               # IE Hack (single question mark)
+      | "=""                             # Chrome Hack ( "="" )
+      )
     """, re.VERBOSE)
 
-    # Internal -- check to see if we have a complete starttag; return end
-    # or -1 if incomplete.
-    def check_for_whole_start_tag(self, i):
+    # Characters HTMLParser won't accept in an unquoted value
+    BAD_BARE_VALUE = re.compile(r"[=<`]")
+
+    def scan_starttag(self, i):
+        """
+        Find the end of the start tag at i, and its attributes.
+
+        Returns (end, tag name end, attributes, self closing) where
+        attributes is a list of (name start, name end, value start, value
+        end), or None where the start tag isn't all there yet. Value
+        positions are -1 for attributes without values.
+        """
         rawdata = self.rawdata
-        m = self.LOCATESTARTTAGEND.match(rawdata, i)          # Hacked line
-        if m:
-            j = m.end()
-            next = rawdata[j:j+1]
-            if next == ">":
-                return j + 1
-            if next == "/":
-                if rawdata.startswith("/>", j):
-                    return j + 2
-                if rawdata.startswith("/", j):
-                    # buffer boundary
-                    return -1
-                # else bogus input
-                self.updatepos(i, j + 1)
-                self.error("malformed empty start tag")
-            if next == "":
-                # end of input
-                return -1
-            # HACK GOES HERE: Adding ? and " characters.
-            # IE tends to add a single question mark e.g. <a href="hello""> becomes <a href="hello" ?>
-            # Chrome tends to add a weird thing e.g. <a href="hello""> becomes <a href="hello" "="">
-            if next in ("abcdefghijklmnopqrstuvwxyz=/"
-                        "ABCDEFGHIJKLMNOPQRSTUVWXYZ"):
-                # end of input in or before attribute value, or we have the
-                # '/' from a '/>' ending
-                return -1
-            self.updatepos(i, j)
-            self.error("malformed start tag")
-        raise AssertionError("we should not get here!")
-
-    # Hacks: Search for solo question marks (IE) OR "="" (Chrome) e.g.
-    #   IE:     <a href="hello""> becomes <a href="hello" ?>
-    #   Chrome: <a href="hello""> becomes <a href="hello" "="">
-    ATTRFIND = re.compile(                                      # Hacked line
-        r'\s*([a-zA-Z_][-.:a-zA-Z_0-9]*|\?|\")(\s*=\s*'          # Hacked line
-        r'(\'[^\']*\'|"[^"]*"|[^\s"\'=<>`]*))?')                # Hacked line
+        pos = self.TAGNAME.match(rawdata, i + 1).end()
+        tag_end = pos
+        attrs = []
+        match = self.ATTRIBUTE.match
+        m = match(rawdata, pos)
+        while m is not None:
+            if m.start(1) >= 0:
+                attrs.append(m.span(1) + m.span(2))
+            pos = m.end()
+            m = match(rawdata, pos)
+        j = self.SPACE.match(rawdata, pos).end()
+
+        next = rawdata[j:j+1]
+        if next == ">":
+            return j + 1, tag_end, attrs, False
+        if next == "/":
+            if rawdata.startswith("/>", j):
+                return j + 2, tag_end, attrs, True
+            # buffer boundary
+            return None
+        if next == "":
+            # end of input
+            return None
+        if next in ("abcdefghijklmnopqrstuvwxyz=/"
+                    "ABCDEFGHIJKLMNOPQRSTUVWXYZ"):
+            # end of input in or before attribute value, or we have the
+            # '/' from a '/>' ending
+            return None
+        self.updatepos(i, j)
+        self.error("malformed start tag")
+
+    def get_starttag_text(self):
+        # Only sliced out if someone asks for it
+        if self.starttag_span is None:
+            return None
+        start, end = self.starttag_span
+        return self.rawdata[start:end]
 
     # Internal -- handle starttag, return end or -1 if not terminated
     def parse_starttag(self, i):
-        self._HTMLParser__starttag_text = None
-        endpos = self.check_for_whole_start_tag(i)
-        if endpos < 0:
-            return endpos
+        self.starttag_span = None
+        scanned = self.scan_starttag(i)
+        if scanned is None:
+            return -1
+        endpos, tag_end, spans, self_closing = scanned
         rawdata = self.rawdata
-        self._HTMLParser__starttag_text = rawdata[i:endpos]
+        self.starttag_span = (i, endpos)
 
-        # Now parse the data between i+1 and j into a tag and attrs
-        attrs = []
-        match = tagfind.match(rawdata, i+1)
-        assert match, 'unexpected call to parse_starttag()'
-        k = match.end()
-        self.lasttag = tag = rawdata[i+1:k].lower()
+        self.lasttag = tag = rawdata[i+1:tag_end].lower()
 
         # Case hack
         if self.should_retain_case():
-            final_tag = rawdata[i+1:k]
+            final_tag = rawdata[i+1:tag_end]
         else:
             final_tag = tag
+        lower_names = not self.should_retain_case(final_tag)
 
-        while k < endpos:
-            m = self.ATTRFIND.match(rawdata, k)                 # Hacked line
-            if not m:
-                break
-            attrname, rest, attrvalue = m.group(1, 2, 3)
-            # IE and Chrome hack                                # Hacked line
-            if attrname == "?" or attrname == '"':              # Hacked line
-                k = m.end()                                     # Hacked line
-                continue                                        # Hacked line
-            elif not rest:
+        attrs = []
+        for name_start, name_end, value_start, value_end in spans:
+            attrname = rawdata[name_start:name_end]
+            if lower_names:
+                attrname = attrname.lower()
+            if value_start < 0:
                 attrvalue = None
-            elif attrvalue[:1] == '\'' == attrvalue[-1:] or \
-                 attrvalue[:1] == '"' == attrvalue[-1:]:
-                attrvalue = attrvalue[1:-1]
-                attrvalue = self.unescape(attrvalue)
-
-            if not self.should_retain_case(final_tag):          # Hacked
-                attrname = attrname.lower()                     # Hacked
-
-            attrs.append((attrname, attrvalue))                 # Hacked line
-            k = m.end()
-
-        end = rawdata[k:endpos].strip()
-        if end not in (">", "/>"):
-            lineno, offset = self.getpos()
-            if "\n" in self._HTMLParser__starttag_text:
-                lineno = lineno + self._HTMLParser__starttag_text.count("\n")
-                offset = len(self._HTMLParser__starttag_text) \
-                         - self._HTMLParser__starttag_text.rfind("\n")
+            elif rawdata[value_start] in "'\"":
+                attrvalue = self.unescape(rawdata[value_start+1:value_end-1])
             else:
-                offset = offset + len(self._HTMLParser__starttag_text)
-            self.error("junk characters in start tag: %r"
-                       % (rawdata[k:endpos][:20],))
-        if end.endswith('/>'):
+                attrvalue = rawdata[value_start:value_end]
+                bad = self.BAD_BARE_VALUE.search(attrvalue)
+                if bad is not None:
+                    k = value_start + bad.start()
+                    self.error("junk characters in start tag: %r"
+                               % (rawdata[k:min(k + 20, endpos)],))
+            attrs.append((attrname, attrvalue))
+
+        if self_closing:
             # XHTML-style empty tag: <span attr="value" />
             self.handle_startendtag(final_tag, attrs)
         else:
@@ -329,12 +339,144 @@ class OuterHTMLParser(HTMLParser):
         return j
 
 
-def parse_html(html, is_fragment=False, retain_case=False):
+# -----------------------------------------------------------------------------
+# Fast path: lxml's (libxml2's) HTML parser
+# -----------------------------------------------------------------------------
+
+# Start tags, as OuterHTMLParser.LOCATESTARTTAGEND sees them
+STARTTAG = re.compile(r"<([a-zA-Z][-.a-zA-Z0-9:_]*)")
+ENDTAG = re.compile(r"</[a-zA-Z]")
+
+# Entities in text. OuterHTMLParser ignores them, libxml2 decodes them.
+TEXT_ENTITY = re.compile(r">[^<]*&")
+
+# Unquoted attribute values with characters OuterHTMLParser treats
+# differently: it keeps entities literal where libxml2 decodes them, and it
+# rejects the rest (BAD_BARE_VALUE) where libxml2 accepts them. Quoted values
+# that happen to match just take the slow path.
+BARE_VALUE_SPECIAL = re.compile(r"=\s*[^\s\"'>]*[&=<`]")
+
+# Attributes without values that libxml2 gives a value (htmlIsBooleanAttr):
+# OuterHTMLParser gives them ""
+BARE_BOOLEAN_ATTRIB = re.compile(r"""\s(?:checked|compact|declare|defer|
+        disabled|ismap|multiple|nohref|noresize|noshade|nowrap|readonly|
+        selected)(?=[\s/>])""", re.IGNORECASE | re.VERBOSE)
+
+# Characters XML doesn't allow. libxml2 drops them without an error,
+# OuterHTMLParser fails on them (lxml won't put them in the tree).
+CONTROL_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+# Elements libxml2 adds around fragments
+IMPLIED_TAGS = set(["html", "head", "body"])
+
+class FastPathRejected(Exception):
+    pass
+
+def check_fast_path(html):
+    """
+    Raises FastPathRejected if html has anything parse_html_fast can't parse
+    the way OuterHTMLParser does
+    """
+    if isinstance(html, str):
+        try:
+            html.decode("ascii")
+        except UnicodeDecodeError:
+            # OuterHTMLParser leaves these as bytes
+            raise FastPathRejected("non-ascii bytes")
+    if CONTROL_CHARS.search(html):
+        raise FastPathRejected("control characters")
+    if TEXT_ENTITY.search(html):
+        raise FastPathRejected("entities in text")
+    if BARE_VALUE_SPECIAL.search(html):
+        raise FastPathRejected("special characters in an unquoted value")
+    if BARE_BOOLEAN_ATTRIB.search(html):
+        raise FastPathRejected("boolean attribute without a value")
+
+def find_source_root(tree, tag):
+    """
+    The element libxml2 made for the first tag in the source, skipping the
+    <html>, <head> and <body> it adds around fragments
+    """
+    elem = tree
+    while elem.tag != tag:
+        if elem.tag not in IMPLIED_TAGS:
+            return None
+        children = [c for c in elem if isinstance(c.tag, basestring)]
+        if len(children) != 1:
+            return None
+        elem = children[0]
+    return elem
+
+def parse_html_fast(html):
+    """
+    Same as OuterHTMLParser, but with lxml's HTML parser, which is written in
+    C. Raises FastPathRejected for HTML it can't be trusted with: SVG and
+    anything else libxml2 reports an error for (including the IE and Chrome
+    attribute hacks, unknown tags and unexpected close tags), and anything
+    where libxml2 added or dropped elements. parse_html falls back to
+    OuterHTMLParser for those.
+    """
+    check_fast_path(html)
+    first = STARTTAG.search(html)
+    if first is None:
+        raise FastPathRejected("no tags")
+    first_tag = first.group(1).lower()
+
+    html_parser = lxml.html.HTMLParser(default_doctype=False)
+    try:
+        tree = lxml.etree.fromstring(html, html_parser)
+    except lxml.etree.XMLSyntaxError, e:
+        raise FastPathRejected(str(e))
+    if tree is None:
+        raise FastPathRejected("empty document")
+    if len(html_parser.error_log):
+        raise FastPathRejected(str(html_parser.error_log[0]))
+
+    root = find_source_root(tree, first_tag)
+    if root is None:
+        raise FastPathRejected("couldn't find <%s>" % (first_tag))
+    # Every element has to be in the source, and every element that isn't
+    # void has to be closed explicitly (libxml2 closes them for us, and
+    # OuterHTMLParser doesn't always)
+    count = 0
+    closed = 0
+    for e in root.iter():
+        if not isinstance(e.tag, basestring):
+            continue
+        count += 1
+        if e.tag not in OuterHTMLParser.VOID_TAGS:
+            closed += 1
+        elif len(e) or e.text:
+            raise FastPathRejected("content in <%s>" % (e.tag))
+    if count != len(STARTTAG.findall(html)):
+        raise FastPathRejected("elements added or dropped")
+    if closed != len(ENDTAG.findall(html)):
+        raise FastPathRejected("elements closed implicitly")
+
+    if root.getparent() is not None:
+        root.getparent().remove(root)
+    # OuterHTMLParser ignores anything after the root
+    root.tail = None
+    return root
+
+# -----------------------------------------------------------------------------
+# Parsing
+# -----------------------------------------------------------------------------
+
+def parse_html(html, is_fragment=False, retain_case=False, fast_path=True):
     """ See docstring for OuterHTMLParser.
     Returns None if no HTML detected.
 
     :param is_fragment:     Unused, but may come into play later with fallback parsers.
+
+    :param fast_path:       Try parse_html_fast first. Never used when
+                            retaining case.
     """
+    if fast_path and not retain_case:
+        try:
+            return parse_html_fast(html)
+        except FastPathRejected, e:
+            logger.debug("Using OuterHTMLParser: %s", e)
     parser = OuterHTMLParser(retain_case=retain_case)
     try:
         parser.feed(html)
@@ -0,0 +1,447 @@
+"""
+Push updates to viewers over WebSockets instead of having them poll.
+
+Broadcasters keep using handle_send_update. Each change made to a session is
+turned into a get_update response (see server.handle_get_update) which is JSON
+encoded once and queued for every viewer subscribed to the session. Viewers
+connect with the change id they're up to and receive the same responses they
+would have got from polling, so they can drop the connection and resume where
+they left off.
+
+Python 2 doesn't have asyncio, so the server uses a thread per connection,
+like the rest of mirrordom. Usage:
+
+    sessions = mirrordom.server.SessionManager()
+    server = mirrordom.push.PushServer(("", 8081), sessions)
+    server.serve_forever()
+
+Viewers connect to ws://host:8081/?session_id=<id>&change_id=<id> (see the
+push_url option of MirrorDom.Viewer).
+"""
+
+import base64
+import hashlib
+import logging
+import struct
+import threading
+import collections
+import urlparse
+import SocketServer
+
+from . import server
+
+logger = logging.getLogger("mirrordom.push")
+
+# Exceptions
+class WebSocketError(Exception):
+    pass
+
+# Constants
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+# Viewers only ever send control frames
+MAX_INCOMING_PAYLOAD = 65536
+
+# -----------------------------------------------------------------------------
+# Fan-out
+# -----------------------------------------------------------------------------
+
+class Subscriber(object):
+    """
+    A viewer's queue of encoded updates.
+
+    The queue is bounded. A viewer that can't keep up stops being sent
+    updates until it has drained its queue, then catches up with a single
+    update covering everything it missed (see PushHub.catch_up).
+
+    :param next_change_id:      The first change id the viewer hasn't seen,
+                                or None if it needs the whole document.
+    """
+
+    def __init__(self, hub, next_change_id, max_queue):
+        self.hub = hub
+        self.next_change_id = next_change_id
+        self.max_queue = max_queue
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    @property
+    def full(self):
+        return len(self.queue) >= self.max_queue
+
+    def put(self, encoded):
+        """
+        Returns False if the queue is full
+        """
+        with self.condition:
+            if self.full:
+                return False
+            self.queue.append(encoded)
+            self.condition.notify()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Returns the next encoded update, or None if the timeout expires or the
+        subscriber has been closed.
+        """
+        with self.condition:
+            if not self.queue and not self.closed:
+                self.condition.wait(timeout)
+            if self.closed or not self.queue:
+                return None
+            encoded = self.queue.popleft()
+            drained = not self.queue
+        if drained:
+            self.hub.catch_up(self)
+        return encoded
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class PushHub(object):
+    """
+    Fans out a session's updates to its subscribers.
+
+    Subscribers that are up to the same change id are sent the same response,
+    which Session.response_cache only builds and encodes once.
+
+    Session listeners are called by the broadcaster's request with the
+    session's write lock held, so the listener only wakes the hub's sender
+    thread, which builds the responses and queues them.
+    """
+
+    def __init__(self, session, max_queue=16):
+        self.session = session
+        self.max_queue = max_queue
+        self.subscribers = []
+        self.lock = threading.Lock()
+        # Set by publish, cleared by the sender thread
+        self.wakeup = threading.Condition()
+        self.changed = False
+        self.stopped = False
+        self.sender = None
+
+    def start(self):
+        self.sender = threading.Thread(target=self.run,
+                name="mirrordom-push-sender")
+        self.sender.daemon = True
+        self.sender.start()
+        self.session.add_listener(self.publish)
+
+    def stop(self):
+        self.session.remove_listener(self.publish)
+        with self.wakeup:
+            self.stopped = True
+            self.wakeup.notify()
+        if self.sender is not None and \
+                self.sender is not threading.current_thread():
+            self.sender.join()
+        with self.lock:
+            subscribers, self.subscribers = self.subscribers, []
+        for s in subscribers:
+            s.close()
+
+    def subscribe(self, change_id=None):
+        """
+        :param change_id:   The first change id the viewer hasn't seen (same
+                            as handle_get_update). The viewer is sent
+                            everything from there on straight away.
+        """
+        s = Subscriber(self, change_id, self.max_queue)
+        with self.lock:
+            self.send_update(s)
+            self.subscribers.append(s)
+        return s
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            try:
+                self.subscribers.remove(subscriber)
+            except ValueError:
+                pass
+        subscriber.close()
+
+    def publish(self, session):
+        """
+        Session listener, called whenever something changes
+        """
+        with self.wakeup:
+            self.changed = True
+            self.wakeup.notify()
+
+    def run(self):
+        """
+        Sender thread: queue updates for subscribers whenever the session
+        changes. Changes that arrive while it's busy go out together.
+        """
+        while True:
+            with self.wakeup:
+                while not self.changed and not self.stopped:
+                    self.wakeup.wait()
+                if self.stopped:
+                    return
+                self.changed = False
+            try:
+                self.send_updates()
+            except Exception:
+                logger.exception("Couldn't send updates")
+
+    def send_updates(self):
+        """
+        Queue everything new for every subscriber
+        """
+        with self.lock:
+            for s in self.subscribers:
+                self.send_update(s)
+
+    def catch_up(self, subscriber):
+        """
+        Called when a subscriber has emptied its queue, in case it was skipped
+        while its queue was full.
+        """
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.send_update(subscriber)
+
+    def send_update(self, subscriber):
+        """
+        Queue everything the subscriber hasn't seen yet. Must hold self.lock.
+        """
+        last_change_id = self.session.last_change_id
+        if subscriber.next_change_id is not None and \
+                subscriber.next_change_id > last_change_id:
+            return
+        if last_change_id < 0:
+            # Nothing's been broadcast yet
+            return
+        if subscriber.full:
+            logger.debug("Subscriber queue full, skipping change %s",
+                    last_change_id)
+            return
+        response, encoded = server.get_cached_update(self.session,
+                subscriber.next_change_id, False)
+        if subscriber.put(encoded):
+            subscriber.next_change_id = response["last_change_id"] + 1
+
+# -----------------------------------------------------------------------------
+# WebSocket transport
+# -----------------------------------------------------------------------------
+
+def websocket_accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+def encode_frame(opcode, payload):
+    """
+    Server to client frames are never masked
+    """
+    if isinstance(payload, unicode):
+        payload = payload.encode("utf-8")
+    length = len(payload)
+    header = chr(0x80 | opcode)
+    if length < 126:
+        header += chr(length)
+    elif length < 65536:
+        header += chr(126) + struct.pack("!H", length)
+    else:
+        header += chr(127) + struct.pack("!Q", length)
+    return header + payload
+
+def read_exactly(rfile, length):
+    data = rfile.read(length)
+    if len(data) != length:
+        raise EOFError()
+    return data
+
+def read_frame(rfile):
+    """
+    Returns (opcode, payload)
+    """
+    b0, b1 = [ord(c) for c in read_exactly(rfile, 2)]
+    opcode = b0 & 0x0f
+    masked = b1 & 0x80
+    length = b1 & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", read_exactly(rfile, 2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", read_exactly(rfile, 8))[0]
+    if length > MAX_INCOMING_PAYLOAD:
+        raise WebSocketError("Frame too big: %s bytes" % (length))
+    mask = bytearray(read_exactly(rfile, 4)) if masked else None
+    payload = bytearray(read_exactly(rfile, length))
+    if mask:
+        for i in xrange(length):
+            payload[i] ^= mask[i % 4]
+    return opcode, str(payload)
+
+class PushRequestHandler(SocketServer.StreamRequestHandler):
+    """
+    One viewer connection. The handler thread writes updates to the socket;
+    a second thread reads (and mostly ignores) what the viewer sends.
+
+    Writes block when the viewer's socket buffer is full, which is what
+    fills up the subscriber's queue (see Subscriber).
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+
+    def handle(self):
+        try:
+            path, headers = self.read_request()
+        except (EOFError, WebSocketError), e:
+            logger.debug("Bad WebSocket request: %s", e)
+            return
+        query = dict(urlparse.parse_qsl(urlparse.urlsplit(path).query))
+        session_id = query.get("session_id", self.server.default_session_id)
+        change_id = query.get("change_id")
+        change_id = int(change_id) if change_id else None
+
+        try:
+            session = self.server.sessions.get_session(session_id)
+        except server.SessionNotFound:
+            self.send_http_error("404 Not Found")
+            return
+
+        key = headers.get("sec-websocket-key")
+        if key is None or "websocket" not in \
+                headers.get("upgrade", "").lower():
+            self.send_http_error("400 Bad Request")
+            return
+        self.wfile.write("HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                "Sec-WebSocket-Accept: %s\r\n\r\n" % \
+                (websocket_accept_key(key)))
+        self.wfile.flush()
+
+        hub, subscriber = self.server.subscribe(session_id, session,
+                change_id)
+        reader = threading.Thread(target=self.read_loop, args=(subscriber,))
+        reader.daemon = True
+        reader.start()
+        try:
+            self.write_loop(session_id, session, subscriber)
+        finally:
+            self.server.unsubscribe(session_id, hub, subscriber)
+            try:
+                self.send_frame(OPCODE_CLOSE, "")
+            except IOError:
+                pass
+
+    def read_request(self):
+        request_line = self.rfile.readline(65537)
+        if not request_line:
+            raise EOFError()
+        parts = request_line.split()
+        if len(parts) != 3 or parts[0] != "GET":
+            raise WebSocketError("Unexpected request %r" % (request_line))
+        headers = {}
+        while True:
+            line = self.rfile.readline(65537)
+            if not line:
+                raise EOFError()
+            line = line.strip()
+            if not line:
+                break
+            name, sep, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return parts[1], headers
+
+    def send_http_error(self, status):
+        self.wfile.write("HTTP/1.1 %s\r\nContent-Length: 0\r\n"
+                "Connection: close\r\n\r\n" % (status))
+
+    def send_frame(self, opcode, payload):
+        with self.write_lock:
+            self.wfile.write(encode_frame(opcode, payload))
+            self.wfile.flush()
+
+    def write_loop(self, session_id, session, subscriber):
+        while True:
+            encoded = subscriber.get(self.server.ping_interval)
+            if subscriber.closed:
+                return
+            try:
+                if encoded is None:
+                    # Quiet: keep the session alive and check it still exists
+                    if self.server.sessions.get_session(session_id) \
+                            is not session:
+                        return
+                    self.send_frame(OPCODE_PING, "")
+                else:
+                    self.send_frame(OPCODE_TEXT, encoded)
+            except server.SessionNotFound:
+                return
+            except IOError, e:
+                logger.debug("Viewer went away: %s", e)
+                return
+
+    def read_loop(self, subscriber):
+        try:
+            while True:
+                opcode, payload = read_frame(self.rfile)
+                if opcode == OPCODE_CLOSE:
+                    break
+                elif opcode == OPCODE_PING:
+                    self.send_frame(OPCODE_PONG, payload)
+        except (EOFError, IOError, WebSocketError), e:
+            logger.debug("Viewer connection closed: %s", e)
+        finally:
+            subscriber.close()
+
+class PushServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    WebSocket server pushing updates for the sessions in a SessionManager.
+
+    :param sessions:            server.SessionManager
+    :param default_session_id:  Session used when viewers don't give one
+    :param max_queue:           Updates buffered per viewer (see Subscriber)
+    :param ping_interval:       Seconds between pings on quiet connections
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, sessions, default_session_id=None,
+            max_queue=16, ping_interval=30.0):
+        self.sessions = sessions
+        self.default_session_id = default_session_id
+        self.max_queue = max_queue
+        self.ping_interval = ping_interval
+
+        # session id -> PushHub, for sessions with viewers connected
+        self.hubs = {}
+        self.hubs_lock = threading.Lock()
+        SocketServer.TCPServer.__init__(self, address, PushRequestHandler)
+
+    def subscribe(self, session_id, session, change_id):
+        """
+        Returns (hub, subscriber)
+        """
+        with self.hubs_lock:
+            hub = self.hubs.get(session_id)
+            if hub is not None and hub.session is not session:
+                # The session was replaced since the hub was made
+                hub.stop()
+                hub = None
+            if hub is None:
+                hub = self.hubs[session_id] = PushHub(session, self.max_queue)
+                hub.start()
+            return hub, hub.subscribe(change_id)
+
+    def unsubscribe(self, session_id, hub, subscriber):
+        with self.hubs_lock:
+            hub.unsubscribe(subscriber)
+            if not hub.subscribers and self.hubs.get(session_id) is hub:
+                hub.stop()
+                del self.hubs[session_id]
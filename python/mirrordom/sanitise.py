@@ -4,43 +4,202 @@ HTML Parsing and sanitising
 
 import logging
 import re
+import hashlib
+import threading
+import collections
+import codecs
 from cStringIO import StringIO
 
 import lxml
 import lxml.etree
 import lxml.html
-import lxml.html.clean
 
 from . import parser
 
 logger = logging.getLogger("mirrordom.sanitise")
 
-def _get_html_cleaner():
-    cleaner = lxml.html.clean.Cleaner(
-        frames = False,
-        links = False,
-        forms = False,
-        style = False,
-        page_structure = False,
-        scripts = True,
-        embedded = False,
-        safe_attrs_only = False,
+# Most sanitised HTML that's kept around by SanitiseCache. Only what's stored
+# counts: the sanitised HTML (or the parse error's message) and the key.
+DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
 
-        # Setting title elements have some issues in IE
-        kill_tags = ['title'],
+# Rough size of a SanitiseCache key and entry, on top of the HTML
+CACHE_ENTRY_OVERHEAD = 100
 
-        # Hmm...we want to keep SVG and VML tags
-        remove_unknown_tags = False,
+# -----------------------------------------------------------------------------
+# Cache
+# -----------------------------------------------------------------------------
 
-        # If True, the cleaner will wipe out <link> elements. We do want to clean
-        # javascript but we can't use the cleaner's handling, so we'll have to do
-        # our own javascript cleaning later on.
-        javascript = False,
-    )
+class SanitiseCache(object):
+    """
+    Sanitised HTML, keyed on a hash of the raw HTML and the options it was
+    sanitised with. Broadcasters send the same HTML over and over (the same
+    widget after a re-render, the same page after a reload), so this saves
+    parsing and cleaning it again each time.
+
+    HTML that doesn't parse is remembered too, and raises the same
+    HTMLParseError again.
+
+    Least recently used entries are evicted once the entries add up to more
+    than max_bytes. hits, misses and evictions count what happened.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        # key -> (sanitised html or HTMLParseError, size)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return "<SanitiseCache: %s entries, %s bytes, %s hits, %s misses>" % \
+                (len(self.entries), self.bytes, self.hits, self.misses)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.bytes,
+                    "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
 
-    cleaner.remove_unknown_tags = False
+    def get(self, html, build, retain_case=False, is_fragment=False):
+        """
+        Sanitised html, calling build() to make it on a miss. build may raise
+        parser.HTMLParseError.
+        """
+        raw = html.encode("utf-8") if isinstance(html, unicode) else html
+        key = (hashlib.sha1(raw).digest(), isinstance(html, unicode),
+                retain_case, is_fragment)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # Back on the end, as the most recently used
+                self.entries[key] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            result = entry[0]
+            if isinstance(result, parser.HTMLParseError):
+                raise result
+            return result
+
+        try:
+            result = build()
+        except parser.HTMLParseError, e:
+            self.add(key, e, CACHE_ENTRY_OVERHEAD + len(str(e)))
+            raise
+        self.add(key, result, CACHE_ENTRY_OVERHEAD + len(result))
+        return result
+
+    def add(self, key, result, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (result, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
 
-    return cleaner
+# Shared by everything that sanitises (see sanitise_html)
+cache = SanitiseCache()
+
+# -----------------------------------------------------------------------------
+# Sanitising
+# -----------------------------------------------------------------------------
+
+# What lxml.html.clean.Cleaner used to do for us (scripts, comments, meta and
+# title elements are dropped along with everything in them, blink and marquee
+# elements are replaced with what's in them)
+KILL_TAGS = set(["script", "title", "meta", lxml.etree.Comment,
+    lxml.etree.ProcessingInstruction])
+REMOVE_TAGS = set(["blink", "marquee"])
+
+class SanitisingParser(parser.OuterHTMLParser):
+    """
+    OuterHTMLParser that sanitises the tree as it builds it (see
+    sanitise_tree), so there's no need to walk the tree afterwards.
+
+    Attributes are sanitised before the element's made. Everything else
+    happens as each element closes, once everything in it has been
+    sanitised. Call finish() after feeding all the HTML to sanitise any
+    elements that were never closed.
+    """
+
+    def open_tag(self, tag, attrs):
+        parser.OuterHTMLParser.open_tag(self, tag,
+                sanitise_attributes(tag, attrs))
+
+    def close_tag(self, tag, check_autoclose=False, force=False):
+        elem = self.stack[-1] if self.stack else None
+        parser.OuterHTMLParser.close_tag(self, tag,
+                check_autoclose=check_autoclose, force=force)
+        sanitise_element(elem, elem is self.root)
+
+    def handle_comment(self, data):
+        # Comments are dropped anyway
+        pass
+
+    def finish(self):
+        while self.stack:
+            elem = self.stack.pop()
+            sanitise_element(elem, elem is self.root)
+        return self.root
+
+def sanitise_attributes(tag, attrs):
+    """
+    attrs (a list of (name, value)) without event handlers or iframe
+    sources, and with anchors pointing nowhere
+    """
+    result = []
+    for name, value in attrs:
+        if name.startswith('on'):
+            continue
+        elif tag == "iframe" and name == "src":
+            continue
+        elif tag == "a" and name == "href":
+            value = "#"
+        result.append((name, value))
+    return result
+
+def sanitise_element(elem, is_root=False):
+    """
+    Sanitise elem, which has to be done after everything in it. Drops elem
+    if it shouldn't be there at all, or replaces it with its content.
+
+    :param is_root:     elem is the root, so can't be dropped. It's cleared
+                        instead (and turned into a <div>).
+    """
+    tag = elem.tag
+    if tag == "image":
+        # As lxml.html.clean.Cleaner does
+        elem.tag = tag = "img"
+    if tag in KILL_TAGS:
+        if is_root:
+            if tag != "html":
+                elem.tag = "div"
+            elem.clear()
+        else:
+            elem.drop_tree()
+    elif tag in REMOVE_TAGS:
+        if is_root:
+            elem.tag = "div"
+            elem.attrib.clear()
+        else:
+            elem.drop_tag()
+    elif tag == "table":
+        insert_tbody(elem)
 
 def sanitise_diffs(diffs):
     # For now, we'll just sanitise in place
@@ -52,7 +211,7 @@ def sanitise_diffs(diffs):
         # casing. For HTML, we need to discard casing (everything goes to
         # lowercase)
         retain_case = (diff_doctype == "svg")
-        if diff_type == "node":
+        if diff_type in ("node", "insert"):
             # [0] Type [1] Path [2] type [3] outer html ...
             d[3] = sanitise_html(d[3], is_fragment=True,
                     retain_case=retain_case)
@@ -68,24 +227,135 @@ def force_insert_tbody(html_tree):
     """
     tables = html_tree.iter('table')
     for table in tables:
-        tbody = None
-        children = list(table)
-        for c in children:
-            if not isinstance(c.tag, basestring):
-                continue
-            elif c.tag.lower() == "colgroup":
-                continue
-            elif c.tag.lower() in ("tbody", "tfoot", "thead"):
-                tbody = None
-            else:
-                if tbody is None:
-                    tbody = lxml.html.Element('tbody')
-                    c.addprevious(tbody)
-                tbody.append(c)
+        insert_tbody(table)
     return html_tree
 
+def insert_tbody(table):
+    """ force_insert_tbody for one table """
+    tbody = None
+    children = list(table)
+    for c in children:
+        if not isinstance(c.tag, basestring):
+            continue
+        elif c.tag.lower() == "colgroup":
+            continue
+        elif c.tag.lower() in ("tbody", "tfoot", "thead"):
+            tbody = None
+        else:
+            if tbody is None:
+                tbody = lxml.html.Element('tbody')
+                c.addprevious(tbody)
+            tbody.append(c)
+
+def parse_sanitised(html, retain_case=False, fast_path=True):
+    """
+    parser.parse_html and sanitise_tree in one go. HTML the fast path
+    (parser.parse_html_fast) can't take is parsed with SanitisingParser,
+    otherwise the tree is sanitised afterwards.
+
+    Returns None if no HTML detected.
+    """
+    if fast_path and not retain_case:
+        try:
+            tree = parser.parse_html_fast(html)
+        except parser.FastPathRejected, e:
+            logger.debug("Using SanitisingParser: %s", e)
+        else:
+            return sanitise_tree(tree)
+    html_parser = SanitisingParser(retain_case=retain_case)
+    try:
+        html_parser.feed(html)
+    except parser.HTMLParseError, e:
+        logger.debug("Couldn't parse HTML: %s", e)
+        raise
+    return html_parser.finish()
+
+class SanitiseStream(object):
+    """
+    Parse and sanitise HTML as it arrives, e.g. as an upload's body is read,
+    rather than waiting for all of it. Each completed element is sanitised
+    as it closes (see SanitisingParser), and HTMLParser only keeps the HTML
+    it hasn't got to yet, so there's never more than one copy of the page.
+
+    feed() raises HTMLParseError as soon as the HTML stops making sense, so
+    the rest of it doesn't have to be read. close() returns the sanitised
+    tree.
+
+    There's no fast path or caching here, as both need all the HTML first.
+
+    :param encoding:    Decode chunks (which are bytes) with this. Chunks are
+                        fed as they are if None.
+    """
+
+    def __init__(self, retain_case=False, encoding=None):
+        self.parser = SanitisingParser(retain_case=retain_case)
+        self.decoder = None
+        if encoding is not None:
+            self.decoder = codecs.getincrementaldecoder(encoding)()
+        # Data after the last '>' so far
+        self.pending = []
+        self.fed = 0
+
+    def __repr__(self):
+        return "<SanitiseStream: %s fed>" % (self.fed)
+
+    def feed(self, chunk):
+        if self.decoder is not None:
+            chunk = self.decoder.decode(chunk)
+        # Only feed up to a '>', so HTMLParser never sees a chunk end in the
+        # middle of "</script" (it would take it as text)
+        end = chunk.rfind(">")
+        if end < 0:
+            self.pending.append(chunk)
+            return
+        self.pending.append(chunk[:end + 1])
+        data = "".join(self.pending)
+        self.pending = [chunk[end + 1:]]
+        self.feed_parser(data)
+
+    def close(self):
+        """
+        Returns the sanitised tree, or None if no HTML detected
+        """
+        if self.decoder is not None:
+            self.pending.append(self.decoder.decode("", final=True))
+        data = "".join(self.pending)
+        self.pending = []
+        if data:
+            self.feed_parser(data)
+        return self.parser.finish()
+
+    def feed_parser(self, data):
+        self.fed += len(data)
+        try:
+            self.parser.feed(data)
+        except parser.HTMLParseError, e:
+            logger.debug("Couldn't parse HTML after %s characters: %s",
+                    self.fed, e)
+            raise
+
+def sanitise_stream(chunks, return_etree=False, retain_case=False,
+        encoding=None):
+    """
+    sanitise_html for HTML that's still arriving, as an iterable of chunks
+    (see SanitiseStream). Stops reading chunks if the HTML doesn't parse.
+
+    e.g. for a WSGI request body:
+
+        chunks = iter(lambda: environ['wsgi.input'].read(65536), '')
+        html = sanitise_stream(chunks, encoding="utf-8")
+    """
+    stream = SanitiseStream(retain_case=retain_case, encoding=encoding)
+    for chunk in chunks:
+        stream.feed(chunk)
+    tree = stream.close()
+    if return_etree:
+        return tree
+    else:
+        return lxml.etree.tostring(tree)
+
 def sanitise_html(html, return_etree=False, is_fragment=False,
-        retain_case=False):
+        retain_case=False, use_cache=True):
     """
     Strip out nasties such as <meta>, <script> and other useless bits of
     information.
@@ -102,9 +372,16 @@ def sanitise_html(html, return_etree=False, is_fragment=False,
 
     :param retain_case:         Retain element and attr casing. This can be bad for HTML,
                                 but is needed for SVG.
+
+    :param use_cache:           Look the result up in (and add it to) the
+                                shared SanitiseCache. Only applies to strings.
     """
-    tree = parser.parse_html(html, retain_case=retain_case)
-    sanitise_tree(tree)
+    if use_cache and not return_etree:
+        return cache.get(html, lambda: sanitise_html(html,
+            is_fragment=is_fragment, retain_case=retain_case,
+            use_cache=False), retain_case=retain_case,
+            is_fragment=is_fragment)
+    tree = parse_sanitised(html, retain_case=retain_case)
     if return_etree:
         return tree
     else:
@@ -112,31 +389,29 @@ def sanitise_html(html, return_etree=False, is_fragment=False,
 
 def sanitise_tree(tree):
     """
-    :param tree:    lxml.etree.ElementTree instance
-    """
-    cleaner = _get_html_cleaner()
-    cleaner(tree)
+    Strip scripts, event handlers and links from tree, in place, and insert
+    <tbody>s. Everything's done in one walk, children before their parents.
+    Returns tree.
 
-    force_insert_tbody(tree)
-
-    # Find iframes and strip src
-    for iframe in tree.iter('iframe'):
-        try:
-            iframe.attrib.pop("src")
-        except KeyError:
-            pass
-
-    # Find anchors and strip hrefs        
-    for anchor in tree.iter('a'):
-        if "href" in anchor.attrib:
-            anchor.attrib["href"] = "#"
-
-    # Strip javascript (copied from lxml.html.clean.Cleaner code, but that does
-    # more than we want)
-    # safe_attrs handles events attributes itself
-    for el in tree.iter():
-        attrib = el.attrib
-        for aname in attrib.keys():
-            if aname.startswith('on'):
-                del attrib[aname]
+    :param tree:    lxml.etree.ElementTree instance or element
+    """
+    try:
+        root = tree.getroot()
+    except AttributeError:
+        root = tree
+    for elem in reversed(list(root.iter())):
+        if isinstance(elem.tag, basestring):
+            sanitise_element_attributes(elem)
+        sanitise_element(elem, elem is root)
+    return tree
 
+def sanitise_element_attributes(elem):
+    """ sanitise_attributes for an element that's already been made """
+    attrib = elem.attrib
+    if elem.tag == "iframe":
+        attrib.pop("src", None)
+    elif elem.tag == "a" and "href" in attrib:
+        attrib["href"] = "#"
+    for aname in attrib.keys():
+        if aname.startswith('on'):
+            del attrib[aname]
@@ -1,10 +1,21 @@
 import time
+import bisect
 import logging
 import pprint
 import uuid
+import json
+import threading
+import contextlib
+import collections
 
 from . import sanitise
 from . import parser
+from . import mirror
+from . import coalesce
+from . import differ
+from . import minimise
+from . import merkle
+from .frames import FrameTrie
 
 logger = logging.getLogger("mirrordom.server")
 
@@ -14,40 +25,220 @@ class ChangelogNotFound(Exception):
         msg = "Frame id: %r" % (frame_id)
         Exception.__init__(self, msg)
 
+class SessionNotFound(Exception):
+    def __init__(self, session_id):
+        msg = "Session id: %r" % (session_id)
+        Exception.__init__(self, msg)
+
+class SessionExists(Exception):
+    def __init__(self, session_id):
+        msg = "Session id: %r" % (session_id)
+        Exception.__init__(self, msg)
+
+class StaleSnapshot(Exception):
+    pass
+
 # Constants
 ERROR_INVALID_HTML = "invalid_html"
 
+# See Session's snapshot_ratio
+DEFAULT_SNAPSHOT_RATIO = 4
+
+# See ChangeIndex
+DEFAULT_INDEX_CAPACITY = 10000
+
+# What applying diffs to a mirror.DocumentMirror can raise
+MIRROR_ERRORS = (mirror.PathError, mirror.DiffError, ValueError)
+
 class Session(object):
     """
     Track changelogs for each frame individually, but keep a universal id
     counter for the diffs.
+
+    Threading: broadcaster writes are serialised by write_lock. Every change
+    publishes a new SessionSnapshot (immutable snapshots of each frame's
+    changelog) with a single assignment, and viewer reads only ever look at
+    the current snapshot, so they never wait for the writer.
+
+    The exception is a frame's LiveMirrors, which viewers serialise the
+    current and base documents from. Viewers only try their locks: if the
+    writer (or another viewer) has the current document's, they build the
+    document from init_html and the diffs instead, and if it has the base
+    document's, they take a new snapshot and try again. The writer does wait
+    for a viewer that's part way through serialising one.
+
+    Changelogs (and their snapshots) are kept in FrameTries, so removing a
+    frame's children doesn't involve looking at every other frame, and
+    iterating over them visits parent frames before their children. The
+    tries are replaced rather than modified, so iterating them is safe.
+
+    The ChangeIndex records which frame every change id went to, so a
+    viewer's update only looks at the frames that changed since its change
+    id.
+
+    :param compact_threshold:   If set, a frame's accumulated diff sets are
+                                folded into its init_html once there are more
+                                than this many of them (see
+                                Changelog.compact).
+
+    :param capacity:            If set, each frame keeps a ring buffer of at
+                                most this many diff sets (see Changelog).
+
+    :param coalesce_diffs:      Shrink each incoming diff set with
+                                coalesce.coalesce_diffs before storing it.
+
+    :param live_mirror:         Keep a replica of each frame's current
+                                document, so new viewers get a snapshot
+                                rather than every diff (see Changelog).
+
+    :param minimise_diffs:      Rewrite re-added siblings in incoming diff
+                                sets into 'insert' and 'move' diffs (see
+                                minimise.py and Changelog).
+
+    :param content_hashes:      Send viewers a hash of each frame's document
+                                with every changeset, and let them fetch
+                                subtrees to repair their copy (see merkle.py
+                                and handle_get_subtree).
+
+    :param snapshot_ratio:      Viewers that are so far behind that their
+                                diffs would be more than this many times the
+                                size of the current document get the document
+                                instead (see Changelog). None turns this off.
+
+    :param collect_acknowledged: Fold the diffs every viewer has acknowledged
+                                into each frame's base document (see
+                                acknowledge and Changelog.compact). Viewers
+                                that don't send a viewer id aren't tracked,
+                                so they'll often find themselves starting
+                                again from init_html.
+
+    :param viewer_timeout:      Viewers that haven't polled for this many
+                                seconds stop holding diffs back. If they come
+                                back, they get init_html.
     """
 
-    def __init__(self):
-        self.changelogs = {}
-        self.last_change_id = -1
+    def __init__(self, compact_threshold=None, capacity=None,
+            coalesce_diffs=True, live_mirror=False, minimise_diffs=False,
+            content_hashes=False, snapshot_ratio=DEFAULT_SNAPSHOT_RATIO,
+            collect_acknowledged=False, viewer_timeout=60):
+        self.changelogs = FrameTrie()
+        self.frames = FrameTrie()
+        self.next_change_id = 0
+        self.index = ChangeIndex()
+        self.snapshot = SessionSnapshot(-1, self.frames, self.index.view())
+        self.compact_threshold = compact_threshold
+        self.capacity = capacity
+        self.coalesce_diffs = coalesce_diffs
+        self.live_mirror = live_mirror
+        self.minimise_diffs = minimise_diffs
+        self.content_hashes = content_hashes
+        self.snapshot_ratio = snapshot_ratio
+        self.collect_acknowledged = collect_acknowledged
+        self.viewer_timeout = viewer_timeout
+        self.write_lock = threading.RLock()
+        self.batch_depth = 0
+        self.batch_changed = False
+        self.response_cache = ResponseCache()
+        self.change_condition = threading.Condition()
+        self.listeners = []
+
+        # viewer id -> ViewerCursor, written by viewers (so not under
+        # write_lock)
+        self.viewers = {}
+        self.viewer_lock = threading.Lock()
+        self.clock = time.time
 
     def __repr__(self):
         return pprint.pformat(vars(self))
 
+    @property
+    def last_change_id(self):
+        """
+        Last change id viewers can see
+        """
+        return self.snapshot.last_change_id
+
     def clear(self):
-        self.changelogs = {}
+        with self.write_lock:
+            self.changelogs = FrameTrie()
+            self.frames = FrameTrie()
+            self.index = ChangeIndex()
+            self.commit()
 
     def get_next_change_id(self):
-        self.last_change_id += 1
-        x = self.last_change_id
-        return x
+        with self.write_lock:
+            x = self.next_change_id
+            self.next_change_id += 1
+            return x
+
+    def commit(self):
+        """
+        Publish changes made under write_lock, unless we're in the middle of
+        a batch (which publishes everything when it finishes).
+        """
+        if self.batch_depth:
+            self.batch_changed = True
+        else:
+            self.publish()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Hold the write lock for a group of changes which viewers should only
+        see all at once (e.g. all the messages in a send_update)
+        """
+        with self.write_lock:
+            self.batch_depth += 1
+            try:
+                yield
+            finally:
+                self.batch_depth -= 1
+                if not self.batch_depth and self.batch_changed:
+                    self.batch_changed = False
+                    self.publish()
+
+    def publish(self):
+        """
+        Make the current state of the changelogs visible to viewers. Must
+        hold write_lock.
+        """
+        self.snapshot = SessionSnapshot(self.next_change_id - 1, self.frames,
+                self.index.view())
+        self.response_cache.invalidate()
+        self.notify_change()
     
     def new_changelog(self, frame_id, *args, **kwargs):
         """
-        Wrapper around Changelog object instantiation.
+        Wrapper around Changelog object instantiation. Viewers won't see the
+        new changelog until the next publish().
 
         See Changelog.__init__ for arguments.
         """
-        next_id = self.get_next_change_id()
-        c = Changelog(next_id, *args, **kwargs)
-        self.changelogs[frame_id] = c
-        return c
+        with self.write_lock:
+            next_id = self.get_next_change_id()
+            kwargs.setdefault("capacity", self.capacity)
+            kwargs.setdefault("live_mirror", self.live_mirror)
+            kwargs.setdefault("minimise_diffs", self.minimise_diffs)
+            kwargs.setdefault("content_hashes", self.content_hashes)
+            kwargs.setdefault("snapshot_ratio", self.snapshot_ratio)
+            c = Changelog(next_id, *args, **kwargs)
+            self.changelogs = self.changelogs.set(frame_id, c)
+            self.update_snapshot(frame_id, c)
+            self.index.add(next_id, frame_id)
+            return c
+
+    def update_snapshot(self, frame_id, changelog):
+        """
+        Pick up changes to a changelog at the next publish()
+        """
+        self.frames = self.frames.set(frame_id, changelog.snapshot)
+
+    @property
+    def approx_size(self):
+        """
+        Rough number of bytes held by all changelogs
+        """
+        return sum(c.approx_size for c in self.snapshot.frames.itervalues())
 
     def fetch_changelog(self, frame_id):
         try:
@@ -56,74 +247,934 @@ class Session(object):
             raise ChangelogNotFound(frame_id)
 
     def init_html(self, frame_id, html, props, url=None):
-        c = self.new_changelog(frame_id, html, url)
-        next_id = self.get_next_change_id()
-        c.add_diff_set(next_id, props)
+        with self.write_lock:
+            c = self.new_changelog(frame_id, html, url)
+            next_id = self.get_next_change_id()
+            c.add_diff_set(next_id, props)
+            self.update_snapshot(frame_id, c)
+            self.commit()
 
     def add_diff(self, frame_id, diffs):
-        c = self.fetch_changelog(frame_id)
-        next_id = self.get_next_change_id()
-        c.add_diff_set(next_id, diffs)
+        if self.coalesce_diffs:
+            diffs = coalesce.coalesce_diffs(diffs)
+        with self.write_lock:
+            c = self.fetch_changelog(frame_id)
+            next_id = self.get_next_change_id()
+            c.add_diff_set(next_id, diffs)
+            self.index.add(next_id, frame_id)
+            # Only add_snapshot knows whether the upload is still current
+            c.upload = None
+            if self.compact_threshold is not None and \
+                    c.num_diff_sets > self.compact_threshold:
+                # Keep the diff set we just added so viewers that were up to
+                # date before it don't get bumped onto init_html
+                c.compact(keep=1)
+            self.update_snapshot(frame_id, c)
+            if self.collect_acknowledged:
+                self.collect()
+            self.commit()
+
+    def add_snapshot(self, frame_id, html, props, url=None):
+        """
+        Record a whole document uploaded by the broadcaster, diffing it
+        against the previous upload for the frame.
+
+        Returns True if the snapshot started a new page (there was nothing to
+        diff it against, or the URL changed).
+
+        :param html:    Sanitised HTML
+        :param props:   List of property diffs, as sent with a new page
+        """
+        document = mirror.DocumentMirror(html)
+        document.apply_diffs(props)
+        with self.write_lock:
+            c = self.changelogs.get(frame_id)
+            if c is None or c.upload is None or c.bad_state is not None or \
+                    c.url != url:
+                self.init_html(frame_id, html, props, url=url)
+                self.fetch_changelog(frame_id).upload = document
+                return True
+            diffs = differ.diff_documents(c.upload, document)
+            if diffs:
+                self.add_diff(frame_id, diffs)
+            c.upload = document
+            return False
 
     def set_bad_state(self, frame_id, state, msg):
-        try:
-            c = self.fetch_changelog(frame_id)
-        except ChangelogNotFound:
-            # Create a dummy changelog with a bad state
-            c = self.new_changelog(frame_id, init_html=None)
-        c.set_bad_state(state, msg)
+        with self.write_lock:
+            try:
+                c = self.fetch_changelog(frame_id)
+            except ChangelogNotFound:
+                # Create a dummy changelog with a bad state
+                c = self.new_changelog(frame_id, init_html=None)
+            c.set_bad_state(state, msg)
+            self.update_snapshot(frame_id, c)
+            # A change of its own, so viewers that are up to date hear about
+            # it (and long polls and push subscribers are woken)
+            self.index.add(self.get_next_change_id(), frame_id)
+            self.commit()
+
+    # -------------------------------------------------------------------------
+    # Viewers
+    # -------------------------------------------------------------------------
+
+    def register_viewer(self):
+        """
+        Returns a new viewer id, for the viewer to send with get_update
+        """
+        viewer_id = uuid.uuid4().hex
+        with self.viewer_lock:
+            self.viewers[viewer_id] = ViewerCursor(None, self.clock())
+        return viewer_id
+
+    def acknowledge(self, viewer_id, change_id):
+        """
+        Record that a viewer has everything before change_id (the change id
+        it asked for). Viewers that were aged out are registered again.
+        """
+        with self.viewer_lock:
+            cursor = self.viewers.get(viewer_id)
+            if cursor is None:
+                cursor = self.viewers[viewer_id] = ViewerCursor(None, 0)
+            cursor.change_id = change_id
+            cursor.last_seen = self.clock()
+
+    def min_viewer_change_id(self):
+        """
+        Oldest change id a live viewer still needs, or None if there are no
+        viewers that need any. Ages out viewers that have gone quiet.
+        """
+        with self.viewer_lock:
+            now = self.clock()
+            result = None
+            for viewer_id, cursor in self.viewers.items():
+                if self.viewer_timeout is not None and \
+                        now - cursor.last_seen > self.viewer_timeout:
+                    logger.info("Viewer %s went quiet at change id %s",
+                            viewer_id, cursor.change_id)
+                    del self.viewers[viewer_id]
+                elif cursor.change_id is not None and \
+                        (result is None or cursor.change_id < result):
+                    result = cursor.change_id
+            return result
+
+    def collect(self):
+        """
+        Fold the diffs no live viewer needs into each frame's base document.
+        Must hold write_lock.
+        """
+        change_id = self.min_viewer_change_id()
+        if change_id is None:
+            # Nobody's watching, but someone may be about to poll for the
+            # diff set we just added
+            change_id = self.next_change_id - 1
+        for frame_id, c in self.changelogs.items():
+            if c.compact_before(change_id):
+                self.update_snapshot(frame_id, c)
+
+    def viewer_lag(self):
+        """
+        How far behind each viewer is, worst first: a list of dicts with
+        the viewer's id, the change id it asked for, the number of change ids
+        and encoded diff bytes it hasn't acknowledged yet, and the seconds
+        since it last polled.
+        """
+        snapshot = self.snapshot
+        now = self.clock()
+        with self.viewer_lock:
+            viewers = [(viewer_id, cursor.change_id, cursor.last_seen) \
+                    for viewer_id, cursor in self.viewers.iteritems()]
+        result = []
+        for viewer_id, change_id, last_seen in viewers:
+            if change_id is None:
+                lag, lag_bytes = 0, 0
+            else:
+                lag = max(snapshot.last_change_id + 1 - change_id, 0)
+                lag_bytes = sum(c.bytes_since(change_id) \
+                        for c in snapshot.frames.itervalues())
+            result.append({"viewer_id": viewer_id, "change_id": change_id,
+                "lag": lag, "lag_bytes": lag_bytes,
+                "idle": now - last_seen})
+        result.sort(key=lambda v: (v["lag_bytes"], v["lag"]), reverse=True)
+        return result
+
+    def add_listener(self, listener):
+        """
+        listener(session) is called after every change to the session
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def notify_change(self):
+        """
+        Wake up any viewers waiting in wait_for_change and tell the listeners
+        """
+        with self.change_condition:
+            self.change_condition.notify_all()
+        for listener in list(self.listeners):
+            listener(self)
+
+    def wait_for_change(self, change_id, timeout):
+        """
+        Block until the session has reached change_id, or timeout seconds
+        have passed. Returns True if the change id was reached.
+        """
+        deadline = time.time() + timeout
+        with self.change_condition:
+            while self.last_change_id < change_id:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.change_condition.wait(remaining)
+        return True
 
     def update_frames(self, frame_paths):
         frame_paths = set(tuple(f) for f in frame_paths)
-        removed = set(self.changelogs) - frame_paths
-        if removed:
+        with self.write_lock:
+            removed = [f for f in self.changelogs if f not in frame_paths]
+            if not removed:
+                return
             frame_str = ", ".join('(' + ",".join(str(x)) + ')' for x in removed)
             logger.debug("We've lost frames: %s", frame_str)
-        for r in removed:
-            del self.changelogs[r]
+            for f in removed:
+                self.changelogs = self.changelogs.remove(f)
+                self.frames = self.frames.remove(f)
+            self.commit()
 
     def remove_frame_children(self, frame_path):
         """
         TODO: This may no longer be needed now that we're sending a big list of
         iframe paths
         """
-        for f in self.changelogs.keys():
-            if len(f) <= len(frame_path):
-                continue
-            if frame_path == f[:len(frame_path)]:
-                logger.debug("Removing frame child %s as parent %s was restarted",
-                        f, frame_path)
-                del self.changelogs[f]
+        with self.write_lock:
+            changelogs = self.changelogs.remove_children(frame_path)
+            if changelogs is not self.changelogs:
+                logger.debug("Removing frame children of %s as it was "
+                        "restarted", frame_path)
+                self.changelogs = changelogs
+                self.frames = self.frames.remove_children(frame_path)
+                self.commit()
+
+class ViewerCursor(object):
+    """
+    :param change_id:   The change id the viewer last asked for, i.e. it has
+                        everything before it. None if it hasn't asked for a
+                        change id (it gets init_html).
+    """
+    def __init__(self, change_id, now):
+        self.change_id = change_id
+        self.last_seen = now
+
+    def __repr__(self):
+        return "<ViewerCursor: %s>" % (self.change_id)
+
+class SessionSnapshot(object):
+    """
+    What viewers see of a Session: the last change id, a FrameTrie of
+    ChangelogSnapshots for each frame and a ChangeIndexView. Never modified
+    once published.
+    """
+    def __init__(self, last_change_id, frames, index=None):
+        self.last_change_id = last_change_id
+        self.frames = frames
+        self.index = index
+
+    def __repr__(self):
+        return pprint.pformat(vars(self))
+
+    def changed_frames(self, change_id):
+        """
+        (frame path, ChangelogSnapshot) for each frame that has changed from
+        change_id onwards, parents before children
+        """
+        paths = None
+        if change_id is not None and self.index is not None:
+            paths = self.index.frames_since(change_id)
+        if paths is None:
+            return self.frames.items()
+        # Callers expect the main frame in every update, changed or not
+        paths.add(('m',))
+        result = []
+        # Tuples sort the same way FrameTrie iterates
+        for path in sorted(paths):
+            c = self.frames.get(path)
+            if c is not None:
+                result.append((path, c))
+        return result
+
+    def descendants(self, frame_path):
+        """
+        (frame path, ChangelogSnapshot) for the frames inside a frame
+        """
+        node = self.frames.find(frame_path)
+        if node is None:
+            return []
+        return [(path, c) for path, c in node.iteritems(frame_path) \
+                if path != frame_path]
+
+class ChangeIndex(object):
+    """
+    Which frame each change id went to, in change id order. Only the session's
+    writer adds to it. Like Changelog, the lists are shared with viewers'
+    ChangeIndexViews, so they're only appended to, and trimming replaces
+    them.
+
+    Once there are more than capacity entries, the oldest half are dropped.
+    Viewers asking about change ids before first_change_id have to look at
+    every frame.
+    """
+
+    def __init__(self, capacity=DEFAULT_INDEX_CAPACITY):
+        self.capacity = capacity
+        self.change_ids = []
+        self.frame_ids = []
+        self.first_change_id = 0
+
+    def __repr__(self):
+        return "<ChangeIndex: %s entries from %s>" % (len(self.change_ids),
+                self.first_change_id)
+
+    def add(self, change_id, frame_id):
+        self.change_ids.append(change_id)
+        self.frame_ids.append(frame_id)
+        if len(self.change_ids) > self.capacity:
+            self.trim()
+
+    def trim(self):
+        # Don't split up the entries for a change id
+        pos = len(self.change_ids) // 2
+        pos = bisect.bisect_left(self.change_ids, self.change_ids[pos])
+        if pos == 0:
+            return
+        self.first_change_id = self.change_ids[pos]
+        self.change_ids = self.change_ids[pos:]
+        self.frame_ids = self.frame_ids[pos:]
+
+    def view(self):
+        return ChangeIndexView(self)
+
+class ChangeIndexView(object):
+    """
+    A ChangeIndex as of one point in time
+    """
+    def __init__(self, index):
+        self.change_ids = index.change_ids
+        self.frame_ids = index.frame_ids
+        self.end = len(index.change_ids)
+        self.first_change_id = index.first_change_id
+
+    def frames_since(self, change_id):
+        """
+        Set of frame paths with changes from change_id onwards, or None if
+        the index doesn't go back that far
+        """
+        if change_id < self.first_change_id:
+            return None
+        pos = bisect.bisect_left(self.change_ids, change_id, 0, self.end)
+        return set(self.frame_ids[pos:self.end])
+
+class ResponseCache(object):
+    """
+    Shared cache of get_update responses for a session, keyed on
+    (change_id, init_html_required, conflate). Most viewers poll with the
+    same change id, so they can all share one response (and its JSON
+    encoding).
+
+    The whole cache is thrown away whenever the session changes. Only one
+    thread builds any given response; anyone else asking for it in the
+    meantime waits for that result rather than building their own.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def __repr__(self):
+        return "<ResponseCache: %s entries>" % (len(self.entries))
+
+    def invalidate(self):
+        with self.lock:
+            self.entries = {}
+
+    def get(self, key, build):
+        """
+        :param build:   Function returning (response, encoded response),
+                        called on a miss.
+        :returns        (response, encoded response)
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            is_builder = entry is None
+            if is_builder:
+                entry = self.entries[key] = ResponseCacheEntry()
+
+        if is_builder:
+            try:
+                response, encoded = build()
+                entry.set_result(response, encoded)
+            except Exception, e:
+                with self.lock:
+                    if self.entries.get(key) is entry:
+                        del self.entries[key]
+                entry.set_error(e)
+                raise
+        return entry.wait()
+
+class ResponseCacheEntry(object):
+    def __init__(self):
+        self.ready = threading.Event()
+        self.response = None
+        self.encoded = None
+        self.error = None
+
+    def set_result(self, response, encoded):
+        self.response = response
+        self.encoded = encoded
+        self.ready.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.ready.set()
+
+    def wait(self):
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response, self.encoded
 
 class Changelog(object):
     """
     Changes for an individual frame.
+
+    Diff sets are indexed so that any viewer's catch-up is a binary search
+    plus a slice:
+
+    - change_ids:   Change id of each diff set (ascending, so we can bisect)
+    - diff_sets:    The diff sets themselves
+    - offsets:      Position in flat_diffs where each diff set starts
+    - flat_diffs:   Every diff, flattened in order
+    - encoded_diffs: JSON encoding of each diff in flat_diffs, done once when
+                    the diff set arrives so responses are just joins
+    - byte_offsets: Encoded size of all diffs before each diff set (so the
+                    size of any range is a subtraction)
+
+    Entries before `start` have been evicted: they've been folded into the
+    base document (init_html) which is now at first_change_id. The lists are
+    only physically trimmed every so often so eviction stays cheap.
+
+    To decide whether a viewer that's far behind should get the current
+    document instead of the diffs (see ChangelogSnapshot.snapshot_cost), we
+    also keep the size of the document as last measured (doc_bytes) and the
+    index of the first diff set after that (doc_pos). The diffs since then
+    bound how much it can have grown.
+
+    Only the session's writer touches a Changelog. Viewers read the
+    ChangelogSnapshot in `snapshot`, which is replaced after every change.
+    The lists above are only ever appended to (trimming replaces them), so
+    snapshots can share them.
+
+    :param capacity:    If set, keep at most this many diff sets, evicting
+                        the oldest. Viewers that ask for an evicted change id
+                        get init_html instead.
+
+    :param live_mirror: If set, keep a DocumentMirror of the current document
+                        up to date as diff sets arrive. Viewers that need
+                        init_html get a snapshot of the current document
+                        rather than the base document and every diff since.
+
+    :param minimise_diffs: If set, incoming diff sets are rewritten against
+                        the current document (see minimise.py), which needs
+                        the same replica as live_mirror.
+
+    :param content_hashes: If set, keep the hash of the current document
+                        (see merkle.py) in head_hash. Also needs the replica.
+
+    :param snapshot_ratio: Send the current document rather than diffs that
+                        are more than this many times its size. Starting
+                        again reloads the viewer's frame, so it should only
+                        win by a clear margin.
     """
-    def __init__(self, start_id, init_html, url=None):
-        self.init_html = init_html
-        self.diffs = []
+    def __init__(self, start_id, init_html, url=None, capacity=None,
+            live_mirror=False, minimise_diffs=False, content_hashes=False,
+            snapshot_ratio=None):
         self.first_change_id = start_id
         self.url = url
+        self.capacity = capacity
+        self.minimise_diffs = minimise_diffs
+        self.content_hashes = content_hashes
+        self.snapshot_ratio = snapshot_ratio
+
+        self.change_ids = []
+        self.diff_sets = []
+        self.offsets = []
+        self.flat_diffs = []
+        self.encoded_diffs = []
+        self.byte_offsets = []
+        self.total_bytes = 0
+        self.start = 0
 
         # will be a tuple of (ERROR_*, msg)
         self.bad_state = None
 
+        # Replica of the document at first_change_id, created when the first
+        # diff set is evicted so we never need to re-parse init_html. The HTML
+        # and properties are only serialised out when a viewer needs them, or
+        # before more diffs are folded in (see MirrorDocument and compact).
+        self.base = MirrorDocument(init_html)
+        self.base_live = None
+        self.base_bytes = len(init_html) if init_html is not None else 0
+        self.compaction_failed = False
+        self.doc_bytes = self.base_bytes
+        self.doc_pos = 0
+
+        # Last document uploaded by a broadcaster that sends snapshots rather
+        # than diffs (see Session.add_snapshot)
+        self.upload = None
+
+        # Replica of the document at last_change_id, and its hash
+        self.head = None
+        self.head_hash = None
+        if (live_mirror or minimise_diffs or content_hashes) and \
+                init_html is not None:
+            try:
+                self.head = LiveMirror(init_html, start_id)
+            except ValueError, e:
+                logger.warn("Couldn't create live mirror: %s", e)
+        self.update_head_hash()
+
+        self.publish()
+
+    def publish(self):
+        self.snapshot = ChangelogSnapshot(self)
+
     def set_bad_state(self, state, msg):
         self.bad_state = (state, msg)
+        self.publish()
 
     def add_diff_set(self, next_id, diff):
         """
         :param diff:    List of diffs
         """
-        self.diffs.append((next_id, diff))
+        if self.head is not None:
+            previous = self.head.document
+            if previous is not None and previous.ready:
+                # A viewer serialised the document before these diffs
+                self.doc_bytes = previous.size
+                self.doc_pos = len(self.change_ids)
+            try:
+                if self.minimise_diffs:
+                    diff = self.head.minimise_diffs(diff, next_id)
+                else:
+                    self.head.apply_diff_sets([diff], next_id)
+            except MIRROR_ERRORS, e:
+                logger.warn("Couldn't apply diffs to live mirror, dropping "
+                        "it: %s", e)
+                self.head = None
+            self.update_head_hash()
+
+        # Work out the new entries before appending anything, and append the
+        # diffs before the index entries that point at them
+        encoded = [json.dumps(d) for d in diff]
+        offset = len(self.flat_diffs)
+        self.flat_diffs.extend(diff)
+        self.encoded_diffs.extend(encoded)
+        self.diff_sets.append(diff)
+        self.offsets.append(offset)
+        self.byte_offsets.append(self.total_bytes)
+        self.total_bytes += sum(len(e) for e in encoded)
+        self.change_ids.append(next_id)
         #logger.debug("Adding %s diffs to change id %s", len(diff), next_id)
+        if self.capacity is not None:
+            self.compact(keep=self.capacity)
+        self.publish()
+
+    def update_head_hash(self):
+        if self.content_hashes and self.head is not None:
+            self.head_hash = self.head.root_hash()
+        else:
+            self.head_hash = None
+
+    def compact(self, keep=0):
+        """
+        Fold all but the newest `keep` diff sets into init_html, dropping the
+        folded history.
+
+        The last folded change id becomes the new first_change_id, so viewers
+        that are already past it continue to receive just the remaining diffs,
+        and everyone else gets the new init_html. Properties can't be
+        represented in the HTML, so they're sent as the first diffs after
+        init_html (just like a new page).
+
+        Returns True if anything was folded.
+        """
+        num_fold = self.num_diff_sets - keep
+        if num_fold < 1 or self.bad_state is not None or \
+                self.compaction_failed or \
+                (self.base_live is None and self.base.html is None):
+            return False
+
+        end = self.start + num_fold
+
+        # Published snapshots still have the current base, so serialise it
+        # before the mirror changes under it. That way viewers never need the
+        # mirror while we fold (see ChangelogSnapshot.base_document).
+        previous = self.base
+        previous.serialise()
+        try:
+            if self.base_live is None:
+                self.base_live = LiveMirror(previous.html)
+            self.base = self.base_live.apply_diff_sets(
+                    self.diff_sets[self.start:end])
+        except MIRROR_ERRORS, e:
+            logger.warn("Couldn't compact changelog, keeping history: %s", e)
+            self.base_live = None
+            self.compaction_failed = True
+            return False
+
+        # Until the base is serialised again, assume it grew by the size of
+        # the diffs we folded into it
+        self.base_bytes = previous.size + \
+                self.bytes_from(self.start) - self.bytes_from(end)
+        self.first_change_id = self.change_ids[end - 1]
+        self.start = end
+        self.trim()
+        self.publish()
+        return True
+
+    def compact_before(self, change_id):
+        """
+        Fold the diff sets before change_id (see compact)
+        """
+        pos = bisect.bisect_left(self.change_ids, change_id, self.start)
+        return self.compact(keep=len(self.change_ids) - pos)
+
+    def trim(self):
+        """
+        Physically drop evicted diff sets once they make up half the index.
+        Snapshots may still be using the old lists, so these are copies.
+        """
+        if self.start < 32 or self.start * 2 < len(self.change_ids):
+            return
+        flat_start = self.offsets[self.start] if self.num_diff_sets \
+                else len(self.flat_diffs)
+        self.change_ids = self.change_ids[self.start:]
+        self.diff_sets = self.diff_sets[self.start:]
+        self.flat_diffs = self.flat_diffs[flat_start:]
+        self.encoded_diffs = self.encoded_diffs[flat_start:]
+        self.offsets = [o - flat_start for o in self.offsets[self.start:]]
+        bytes_start = self.total_bytes - self.bytes_from(self.start)
+        self.byte_offsets = [b - bytes_start \
+                for b in self.byte_offsets[self.start:]]
+        self.total_bytes -= bytes_start
+        self.doc_pos = max(self.doc_pos - self.start, 0)
+        self.start = 0
+
+    @property
+    def init_html(self):
+        """
+        Only for the writer, viewers use the snapshot (see
+        ChangelogSnapshot.base_document)
+        """
+        self.base.serialise()
+        return self.base.html
+
+    @property
+    def init_props(self):
+        """
+        Property diffs for the base document (only populated once something
+        has been folded into it)
+        """
+        self.base.serialise()
+        return self.base.props
+
+    def bytes_from(self, pos):
+        """
+        Encoded size of the diffs from the diff set at index pos onwards
+        """
+        if pos >= len(self.byte_offsets):
+            return 0
+        return self.total_bytes - self.byte_offsets[pos]
+
+    @property
+    def num_diff_sets(self):
+        return len(self.change_ids) - self.start
+
+    @property
+    def diffs(self):
+        """
+        List of (change id, diff set) for the diff sets we still hold
+        """
+        return zip(self.change_ids[self.start:], self.diff_sets[self.start:])
 
     def __repr__(self):
         return pprint.pformat(vars(self))
 
     @property
     def last_change_id(self):
-        return self.diffs[-1][0] if self.diffs else self.first_change_id
+        return self.change_ids[-1] if self.num_diff_sets \
+                else self.first_change_id
+
+    def diffs_since_change_id(self, since_change_id):
+        """
+        See ChangelogSnapshot.diffs_since_change_id
+        """
+        return self.changes_since_change_id(since_change_id)[0]
+
+    def encoded_diffs_since_change_id(self, since_change_id):
+        """
+        See ChangelogSnapshot.encoded_diffs_since_change_id
+        """
+        return self.changes_since_change_id(since_change_id)[1]
+
+    def changes_since_change_id(self, since_change_id):
+        # The snapshot is always current for the writer, so it only goes
+        # stale while a viewer is serialising the base document
+        while True:
+            try:
+                return self.snapshot.changes_since_change_id(since_change_id)
+            except StaleSnapshot:
+                logger.debug("Base document busy, retrying")
+
+class LiveMirror(object):
+    """
+    A mirror.DocumentMirror that diffs keep being applied to, shared between
+    the session's writer and viewers who want to serialise it. `document` is
+    the MirrorDocument for its current state. lock is held while the mirror
+    is in use. Viewers don't wait for it (see Session).
+    """
+
+    def __init__(self, html, change_id=None):
+        self.mirror = mirror.DocumentMirror(html)
+        self.lock = threading.Lock()
+        self.document = MirrorDocument(None, self)
+
+        # Change id of the last diffs applied, if the caller says
+        self.change_id = change_id
+
+    def __repr__(self):
+        return "<LiveMirror: %r>" % (self.document)
+
+    def apply_diff_sets(self, diff_sets, change_id=None):
+        """
+        Returns the new current MirrorDocument. If this raises, the mirror is
+        no good any more.
+        """
+        with self.lock:
+            self.document = None
+            self.change_id = None
+            for diffs in diff_sets:
+                self.mirror.apply_diffs(diffs)
+            self.document = MirrorDocument(None, self)
+            self.change_id = change_id
+            return self.document
+
+    def minimise_diffs(self, diffs, change_id=None):
+        """
+        Like apply_diff_sets for one diff set, but returns the diffs
+        rewritten by minimise.minimise_diffs
+        """
+        with self.lock:
+            self.document = None
+            self.change_id = None
+            diffs = minimise.minimise_diffs(self.mirror, diffs)
+            self.document = MirrorDocument(None, self)
+            self.change_id = change_id
+            return diffs
+
+    def root_hash(self):
+        with self.lock:
+            return merkle.subtree_hash(self.mirror.root, self.mirror.hashes)
+
+    def get_subtree(self, ipath, change_id, include_html=False):
+        """
+        Hashes (and optionally the HTML and properties) of the subtree at
+        ipath, for a viewer that's up to change_id. Returns None if the
+        mirror has moved on since change_id.
+
+        Also returns None if the mirror is busy, since the writer is probably
+        moving it on.
+
+        Raises mirror.PathError if there's nothing at ipath.
+        """
+        if not self.lock.acquire(False):
+            return None
+        try:
+            if self.document is None or self.change_id is None or \
+                    self.change_id > change_id:
+                return None
+            hashes = self.mirror.hashes
+            node = mirror.node_at_path(self.mirror.root, ipath)
+            result = {
+                "hash": merkle.subtree_hash(node, hashes),
+                "shallow": merkle.shallow_hash(node),
+                "children": merkle.child_hashes(node, hashes),
+            }
+            if include_html:
+                if node is self.mirror.root:
+                    result["html"] = self.mirror.tostring()
+                    result["props"] = self.mirror.get_prop_diffs()
+                else:
+                    result["html"] = differ.outer_html(node)
+                    result["tail"] = differ.text_after(node)
+                    result["props"] = differ.collect_props(node,
+                            self.mirror.props)
+            return result
+        finally:
+            self.lock.release()
+
+class MirrorDocument(object):
+    """
+    A document to send to viewers as init_html, along with the property
+    diffs that go with it.
+
+    Documents taken from a LiveMirror are only serialised the first time a
+    viewer needs them. If the mirror has changed since then, the document
+    can't be serialised any more and serialise() raises StaleSnapshot.
+    """
+
+    def __init__(self, html, live=None):
+        self.html = html
+        self.props = []
+        self.encoded_props = []
+        self._encoded_html = None
+
+        # Set until the document has been serialised from the mirror
+        self.live = live
+
+    def __repr__(self):
+        return "<MirrorDocument: %s>" % ("ready" if self.ready else "pending")
+
+    @property
+    def ready(self):
+        return self.live is None
+
+    @property
+    def size(self):
+        """
+        Rough number of bytes once serialised (only accurate when ready)
+        """
+        html_size = len(self.html) if self.html is not None else 0
+        return html_size + sum(len(e) for e in self.encoded_props)
+
+    def serialise(self, wait=True):
+        """
+        :param wait:    If False, raise StaleSnapshot rather than wait for
+                        the mirror if someone else is using it
+        """
+        live = self.live
+        if live is None:
+            return
+        if wait:
+            live.lock.acquire()
+        elif not live.lock.acquire(False):
+            raise StaleSnapshot()
+        try:
+            if self.ready:
+                return
+            if live.document is not self:
+                raise StaleSnapshot()
+            html = live.mirror.tostring()
+            self.props = live.mirror.get_prop_diffs()
+            self.encoded_props = [json.dumps(d) for d in self.props]
+            self.html = html
+            self.live = None
+        finally:
+            live.lock.release()
+
+    @property
+    def encoded_html(self):
+        self.serialise()
+        if self._encoded_html is None:
+            self._encoded_html = json.dumps(self.html)
+        return self._encoded_html
+
+class ChangelogSnapshot(object):
+    """
+    A Changelog as of one point in time, for viewers. Shares the changelog's
+    lists but only looks at the entries that existed when it was taken.
+    """
+
+    def __init__(self, changelog):
+        self.url = changelog.url
+        self.bad_state = changelog.bad_state
+        self.first_change_id = changelog.first_change_id
+        self.last_change_id = changelog.last_change_id
+        self.base = changelog.base
+        self.base_bytes = changelog.base_bytes
+        self.head = changelog.head.document \
+                if changelog.head is not None else None
+        self.hash = changelog.head_hash
+        self.start = changelog.start
+        self.end = len(changelog.change_ids)
+        self.flat_end = len(changelog.flat_diffs)
+        self.change_ids = changelog.change_ids
+        self.offsets = changelog.offsets
+        self.flat_diffs = changelog.flat_diffs
+        self.encoded_diffs = changelog.encoded_diffs
+        self.byte_offsets = changelog.byte_offsets
+        self.total_bytes = changelog.total_bytes
+        self.doc_bytes = changelog.doc_bytes
+        self.doc_pos = changelog.doc_pos
+        self.snapshot_ratio = changelog.snapshot_ratio
+
+        # MirrorDocument for last_change_id, see current_document
+        self.current = None
+
+    def __repr__(self):
+        return "<ChangelogSnapshot: %s-%s>" % (self.first_change_id,
+                self.last_change_id)
+
+    def bytes_from(self, pos):
+        """
+        Encoded size of the diffs from the diff set at index pos onwards
+        """
+        if pos >= self.end:
+            return 0
+        return self.total_bytes - self.byte_offsets[pos]
+
+    def bytes_since(self, change_id):
+        """
+        Encoded size of the diffs from change_id onwards
+        """
+        pos = bisect.bisect_left(self.change_ids, change_id, self.start,
+                self.end)
+        return self.bytes_from(pos)
+
+    @property
+    def approx_size(self):
+        """
+        Rough number of bytes held by the changelog
+        """
+        base_bytes = self.base.size if self.base.ready else self.base_bytes
+        return base_bytes + self.bytes_from(self.start)
+
+    @property
+    def num_diff_sets(self):
+        return self.end - self.start
+
+    def snapshot_cost(self):
+        """
+        Rough number of bytes it takes to send the current document: exact
+        if it's already been serialised, otherwise its last measured size
+        plus the diffs since (an overestimate, so we err towards diffs).
+        """
+        for document in (self.head, self.current):
+            if document is not None and document.ready:
+                return document.size
+        return self.doc_bytes + self.bytes_from(self.doc_pos)
+
+    def flat_diffs_from(self, pos):
+        """
+        All diffs from the diff set at index pos onwards, as a pair of
+        (diffs, JSON encoded diffs)
+        """
+        if pos >= self.end:
+            return [], []
+        offset = self.offsets[pos]
+        return self.flat_diffs[offset:self.flat_end], \
+                self.encoded_diffs[offset:self.flat_end]
 
     def diffs_since_change_id(self, since_change_id):
         """
@@ -133,47 +1184,367 @@ class Changelog(object):
         Update: If we're in a bad state (e.g. due to one of the incoming HTML
         messages not being parsable) then send an error message.
         """
+        return self.changes_since_change_id(since_change_id)[0]
+
+    def encoded_diffs_since_change_id(self, since_change_id):
+        """
+        JSON encoded version of diffs_since_change_id
+        """
+        return self.changes_since_change_id(since_change_id)[1]
+
+    def changes_since_change_id(self, since_change_id, conflate=False):
+        """
+        Returns (changes, JSON encoded changes), see diffs_since_change_id
+
+        :param conflate:    Collapse the diffs (see handle_get_update)
+
+        Raises StaleSnapshot if init_html is needed but is no longer
+        available, or its mirror is busy (take a new snapshot and try
+        again).
+        """
         if self.bad_state is not None:
             state, msg = self.bad_state
-            return { "last_change_id": self.last_change_id, "error": state,
+            changes = { "last_change_id": self.last_change_id, "error": state,
                     "error_msg": msg }
+            return changes, json.dumps(changes)
 
         if since_change_id > self.last_change_id:
-            return { "last_change_id": self.last_change_id, }
+            changes = { "last_change_id": self.last_change_id, }
+            self.add_hash(changes)
+            return changes, json.dumps(changes)
 
         logger.debug("Since change id: %r, First change id: %r, Last change id: %r",
                 since_change_id, self.first_change_id, self.last_change_id)
 
 
         if since_change_id is None or since_change_id <= self.first_change_id:
+            if self.head is not None:
+                try:
+                    logger.debug("returning snapshot of current document")
+                    self.head.serialise(wait=False)
+                    return self.document_changes(self.head, [], [])
+                except StaleSnapshot:
+                    # The live mirror has moved on, go back to the base
+                    pass
             logger.debug("returning init_html")
-            return {
-                "init_html": self.init_html,
-                "url": self.url,
-                "diffs": [i for (change_id, s) in self.diffs for i in s], # flatten
-                "last_change_id": self.last_change_id,
-            }
+            diffs, encoded_diffs = self.flat_diffs_from(self.start)
+            if conflate:
+                diffs, encoded_diffs = conflate_diffs(diffs, encoded_diffs)
+            return self.document_changes(self.base_document(), diffs,
+                    encoded_diffs)
         else:
             # Find the starting position of the changesets to return
-            for pos, (change_id, d) in enumerate(self.diffs):
-                if change_id >= since_change_id:
-                    break
-            diffs = self.diffs[pos:]
+            pos = bisect.bisect_left(self.change_ids, since_change_id,
+                    self.start, self.end)
+
+            # Viewers a long way behind are better off starting again
+            if self.snapshot_ratio is not None and self.bytes_from(pos) > \
+                    self.snapshot_ratio * self.snapshot_cost():
+                document = self.current_document()
+                if document is not None:
+                    logger.debug("returning snapshot rather than %s bytes "
+                            "of diffs", self.bytes_from(pos))
+                    return self.document_changes(document, [], [])
+
+            diffs, encoded_diffs = self.flat_diffs_from(pos)
             logger.debug("getting diffs since [%s:] (len is %s)",
                     since_change_id, len(diffs))
-            return {
-                "diffs": [i for (change_id, s) in diffs for i in s], # flatten
+            if conflate and pos + 1 < self.end:
+                diffs, encoded_diffs = conflate_diffs(diffs, encoded_diffs)
+            changes = {
                 "last_change_id": self.last_change_id,
             }
+            self.add_hash(changes)
+            encoded = encode_changes(changes, encoded_diffs)
+            changes["diffs"] = diffs
+        return changes, encoded
+
+    def document_changes(self, document, diffs, encoded_diffs):
+        """
+        Changes which start from init_html (a MirrorDocument, which must
+        already be serialised)
+        """
+        changes = {
+            "url": self.url,
+            "last_change_id": self.last_change_id,
+        }
+        self.add_hash(changes)
+        encoded = encode_changes(changes,
+                document.encoded_props + encoded_diffs, document.encoded_html)
+        changes["init_html"] = document.html
+        changes["diffs"] = document.props + diffs
+        return changes, encoded
+
+    def current_changes(self):
+        """
+        Changes giving the document as of last_change_id as init_html, with
+        no diffs after it (see handle_get_frame_snapshot)
+        """
+        if self.bad_state is not None:
+            return self.changes_since_change_id(None)
+        document = self.current_document()
+        if document is None:
+            logger.debug("couldn't fold diffs, returning init_html")
+            return self.changes_since_change_id(None)
+        return self.document_changes(document, [], [])
+
+    def current_document(self):
+        """
+        MirrorDocument for last_change_id, taken from the live mirror if
+        there is one, otherwise built by applying the diffs to init_html. The
+        result is kept, so it's only built once per change id. Returns None if
+        the diffs don't apply.
+        """
+        if self.head is not None:
+            try:
+                self.head.serialise(wait=False)
+                return self.head
+            except StaleSnapshot:
+                pass
+        if self.current is not None:
+            return self.current
+        base = self.base_document()
+        if self.num_diff_sets == 0:
+            return base
+
+        if base.html is None:
+            return None
+        diffs, encoded_diffs = self.flat_diffs_from(self.start)
+        try:
+            document = mirror.DocumentMirror(base.html)
+            document.apply_diffs(base.props)
+            document.apply_diffs(diffs)
+        except MIRROR_ERRORS, e:
+            logger.warn("Couldn't apply diffs to init_html: %s", e)
+            return None
+        current = MirrorDocument(document.tostring())
+        current.props = document.get_prop_diffs()
+        current.encoded_props = [json.dumps(d) for d in current.props]
+        self.current = current
+        return current
+
+    def base_document(self):
+        """
+        The base document (init_html), serialised. The writer serialises it
+        before folding more diffs into its mirror (see Changelog.compact), so
+        the mirror is only busy while someone is serialising this very
+        document. Rather than wait, this raises StaleSnapshot, and by the time
+        the caller has taken a new snapshot and tried again it's ready.
+        """
+        self.base.serialise(wait=False)
+        return self.base
+
+    def add_hash(self, changes):
+        """
+        Viewers can check their copy of the document against this (see
+        merkle.py)
+        """
+        if self.hash is not None:
+            changes["hash"] = self.hash
+
+def conflate_diffs(diffs, encoded_diffs):
+    """
+    Returns (diffs, JSON encoded diffs) for coalesce.conflate_diffs
+    """
+    conflated = coalesce.conflate_diffs(diffs)
+    if len(conflated) == len(diffs):
+        return diffs, encoded_diffs
+    return conflated, [json.dumps(d) for d in conflated]
+
+def encode_changes(changes, encoded_diffs, encoded_init_html=None):
+    """
+    JSON encode a changes dictionary, splicing in the already encoded diffs
+    (and init_html) rather than encoding them again.
+    """
+    parts = ['{"diffs": [', ",".join(encoded_diffs), ']']
+    if encoded_init_html is not None:
+        parts.extend([', "init_html": ', encoded_init_html])
+    parts.extend([', ', json.dumps(changes)[1:]])
+    return "".join(parts)
+
+class SessionManager(object):
+    """
+    Registry of sessions keyed by session id, for servers hosting more than
+    one broadcaster.
+
+    Sessions are kept in least recently used order. evict() throws out:
+
+    - Sessions nobody has touched for idle_timeout seconds
+    - Sessions whose broadcaster hasn't sent anything for heartbeat_timeout
+      seconds (e.g. the browser was closed without saying goodbye)
+    - Sessions bigger than max_session_bytes
+    - Least recently used sessions, until everything fits in max_bytes
+
+    Sizes are approximate (see ChangelogSnapshot.approx_size).
+
+    :param check_interval:      Minimum number of seconds between automatic
+                                evict() calls made while fetching sessions.
+
+    Remaining keyword arguments are passed through to Session.
+    """
+
+    def __init__(self, max_bytes=None, max_session_bytes=None,
+            idle_timeout=None, heartbeat_timeout=None, check_interval=1.0,
+            **session_options):
+        self.max_bytes = max_bytes
+        self.max_session_bytes = max_session_bytes
+        self.idle_timeout = idle_timeout
+        self.heartbeat_timeout = heartbeat_timeout
+        self.check_interval = check_interval
+        self.session_options = session_options
+
+        # session id -> SessionEntry, least recently used first
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.clock = time.time
+        self.last_check = self.clock()
+
+    def __repr__(self):
+        return pprint.pformat(dict(self.sessions))
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create_session(self, session_id=None):
+        """
+        Returns (session id, session). A random id is made up if one isn't
+        provided.
+
+        Raises SessionExists if there's already a session with that id (use
+        get_session with create=True to share it).
+        """
+        if session_id is None:
+            session_id = uuid.uuid4().hex
+        with self.lock:
+            if session_id in self.sessions:
+                raise SessionExists(session_id)
+            entry = SessionEntry(create_storage(**self.session_options),
+                    self.clock())
+            self.sessions[session_id] = entry
+        self.maybe_evict()
+        return session_id, entry.session
+
+    def get_session(self, session_id, create=False, broadcaster=False):
+        """
+        Fetch a session, marking it as recently used.
+
+        :param create:          Create the session if it doesn't exist.
+        :param broadcaster:     The caller is the session's broadcaster, which
+                                counts as a heartbeat.
+        """
+        with self.lock:
+            try:
+                entry = self.sessions.pop(session_id)
+            except KeyError:
+                if not create:
+                    raise SessionNotFound(session_id)
+                entry = SessionEntry(create_storage(**self.session_options),
+                        self.clock())
+            now = self.clock()
+            entry.last_activity = now
+            if broadcaster:
+                entry.last_heartbeat = now
+            self.sessions[session_id] = entry
+        self.maybe_evict()
+        return entry.session
+
+    def heartbeat(self, session_id):
+        """
+        Broadcasters with nothing to send can call this to stay alive.
+        """
+        self.get_session(session_id, broadcaster=True)
+
+    def remove_session(self, session_id):
+        with self.lock:
+            try:
+                del self.sessions[session_id]
+            except KeyError:
+                raise SessionNotFound(session_id)
+
+    def maybe_evict(self):
+        """
+        Call evict() if it's been check_interval seconds since the last time.
+        Don't hold the lock when calling this, so sessions are sized without
+        it.
+        """
+        with self.lock:
+            now = self.clock()
+            if now - self.last_check < self.check_interval:
+                return
+            self.last_check = now
+        self.evict()
+
+    def evict(self):
+        """
+        Returns the list of evicted session ids.
+
+        Sessions are only sized if there's a limit on their size, and that's
+        done without the lock (sizes come from each session's snapshot, see
+        Session.approx_size). Sessions that arrive in the meantime count as
+        empty until the next call.
+        """
+        with self.lock:
+            self.last_check = self.clock()
+            entries = self.sessions.values()
+
+        # SessionEntry -> size
+        sizes = {}
+        if self.max_bytes is not None or self.max_session_bytes is not None:
+            for entry in entries:
+                sizes[entry] = entry.session.approx_size
+
+        with self.lock:
+            now = self.clock()
+            evicted = []
+            for session_id, entry in self.sessions.items():
+                reason = None
+                if self.idle_timeout is not None and \
+                        now - entry.last_activity > self.idle_timeout:
+                    reason = "idle"
+                elif self.heartbeat_timeout is not None and \
+                        now - entry.last_heartbeat > self.heartbeat_timeout:
+                    reason = "no broadcaster heartbeat"
+                elif self.max_session_bytes is not None and \
+                        sizes.get(entry, 0) > self.max_session_bytes:
+                    reason = "over size limit"
+                if reason is not None:
+                    evicted.append((session_id, reason))
+
+            for session_id, reason in evicted:
+                del self.sessions[session_id]
+
+            if self.max_bytes is not None:
+                total = sum(sizes.get(entry, 0) \
+                        for entry in self.sessions.itervalues())
+                for session_id, entry in self.sessions.items():
+                    if total <= self.max_bytes:
+                        break
+                    total -= sizes.get(entry, 0)
+                    del self.sessions[session_id]
+                    evicted.append((session_id, "over memory budget"))
+
+            for session_id, reason in evicted:
+                logger.info("Evicted session %s: %s", session_id, reason)
+            return [session_id for session_id, reason in evicted]
 
-def create_storage():
+class SessionEntry(object):
+    def __init__(self, session, now):
+        self.session = session
+        self.last_activity = now
+        self.last_heartbeat = now
+
+    def __repr__(self):
+        return pprint.pformat(vars(self))
+
+def create_storage(**kwargs):
     """
     Create a state storage object. Right now this is just a dictionary but
     this could always change...
 
-    This storage corresponds to one session only.
+    This storage corresponds to one session only. See Session.__init__ for
+    arguments.
     """
-    return Session()
+    return Session(**kwargs)
 
 
 def handle_send_update(storage, messages, iframes):
@@ -194,14 +1565,53 @@ def handle_send_update(storage, messages, iframes):
 
     Iframes: List of ALL iframes (needed to remove "expired" iframes)
     """
-    for frame_path, update_type, update_data in messages:
-        frame_id = tuple(frame_path)
-        #logger.debug("Got message %s:%s = %s", frame_id, update_type, update_data)
-        globals()['handle_send_' + update_type](storage, frame_id, **update_data)
+    with storage.batch():
+        for frame_path, update_type, update_data in messages:
+            frame_id = tuple(frame_path)
+            #logger.debug("Got message %s:%s = %s", frame_id, update_type, update_data)
+            globals()['handle_send_' + update_type](storage, frame_id, **update_data)
 
-    storage.update_frames(iframes)
+        storage.update_frames(iframes)
 
-def handle_send_new_instance(storage, frame_id, html, props, url=None, iframes=None):
+def commit_message(storage, frame_id, update_type, update_data):
+    """
+    Apply a message that's already been sanitised (see ingest.py)
+
+    :param update_data:     The message's data with the HTML or diffs
+                            sanitised, or with "error" set if they couldn't be
+    """
+    if "error" in update_data:
+        storage.set_bad_state(frame_id, ERROR_INVALID_HTML,
+                update_data["error"])
+        return
+    globals()['handle_send_' + update_type](storage, frame_id,
+            sanitised=True, **update_data)
+
+def handle_html_stream(storage, frame_id, update_type, chunks,
+        encoding=None, **update_data):
+    """
+    Handle a 'new_instance', 'new_page' or 'snapshot' message whose HTML is
+    still arriving, sanitising it as it comes in (see
+    sanitise.sanitise_stream). If it doesn't parse, the rest of the chunks
+    aren't read and the frame is marked bad. Broadcasters send these with the
+    stream_html option, see the demo's html_stream route for serving them.
+
+    :param chunks:          Iterable of pieces of the (unsanitised) HTML
+    :param encoding:        Encoding of the chunks, if they're bytes
+    :param update_data:     The rest of the message's data (props, url...)
+    """
+    frame_id = tuple(frame_id)
+    try:
+        html = sanitise.sanitise_stream(chunks, encoding=encoding)
+    except parser.HTMLParseError, e:
+        update_data = dict(update_data, error=str(e))
+    else:
+        update_data = dict(update_data, html=html)
+    with storage.batch():
+        commit_message(storage, frame_id, update_type, update_data)
+
+def handle_send_new_instance(storage, frame_id, html, props, url=None,
+        iframes=None, sanitised=False):
     """
     Handles a new page loading or starting a new session
 
@@ -209,9 +1619,11 @@ def handle_send_new_instance(storage, frame_id, html, props, url=None, iframes=N
     :@param props:       List of property diffs
     :@param url:         URL of the new page
     :@param iframes:     Paths to child iframes
+    :@param sanitised:   The HTML has already been sanitised
     """
     try:
-        html = sanitise.sanitise_html(html)
+        if not sanitised:
+            html = sanitise.sanitise_html(html)
     except parser.HTMLParseError, e:
         storage.set_bad_state(frame_id, ERROR_INVALID_HTML,
             str(e))
@@ -219,7 +1631,8 @@ def handle_send_new_instance(storage, frame_id, html, props, url=None, iframes=N
         storage.init_html(frame_id, html, props, url=url)
         storage.remove_frame_children(frame_id)
 
-def handle_send_new_page(storage, frame_id, html, props, url, iframes):
+def handle_send_new_page(storage, frame_id, html, props, url, iframes,
+        sanitised=False):
     """
     Handles a new page loading or starting a new session
 
@@ -227,9 +1640,11 @@ def handle_send_new_page(storage, frame_id, html, props, url, iframes):
     :param props:       List of property diffs
     :param url:         URL of the new page
     :param iframes:     Paths to child iframes
+    :param sanitised:   The HTML has already been sanitised
     """
     try:
-        html = sanitise.sanitise_html(html)
+        if not sanitised:
+            html = sanitise.sanitise_html(html)
     except parser.HTMLParseError, e:
         storage.set_bad_state(frame_id, ERROR_INVALID_HTML,
             str(e))
@@ -237,7 +1652,36 @@ def handle_send_new_page(storage, frame_id, html, props, url, iframes):
         storage.init_html(frame_id, html, props, url=url)
         storage.remove_frame_children(frame_id)
 
-def handle_send_diffs(storage, frame_id, diffs):
+def handle_send_snapshot(storage, frame_id, html, props, url=None,
+        iframes=None, sanitised=False):
+    """
+    Handles a broadcaster uploading the whole document instead of diffs. The
+    server works out the diffs itself (see differ.py), so viewers can't tell
+    the difference.
+
+    :param html:        HTML dump (unsanitised)
+    :param props:       List of property diffs
+    :param url:         URL of the page
+    :param iframes:     Paths to child iframes
+    :param sanitised:   The HTML has already been sanitised
+    """
+    try:
+        if not sanitised:
+            html = sanitise.sanitise_html(html)
+    except parser.HTMLParseError, e:
+        storage.set_bad_state(frame_id, ERROR_INVALID_HTML,
+            str(e))
+        return
+    try:
+        new_page = storage.add_snapshot(frame_id, html, props, url=url)
+    except MIRROR_ERRORS, e:
+        storage.set_bad_state(frame_id, ERROR_INVALID_HTML,
+            str(e))
+    else:
+        if new_page:
+            storage.remove_frame_children(frame_id)
+
+def handle_send_diffs(storage, frame_id, diffs, sanitised=False):
     """
     called from the client to add a change (i.e. something changed
     in the dom in that window)
@@ -246,7 +1690,8 @@ def handle_send_diffs(storage, frame_id, diffs):
     """
     logger.debug("add_diff: %s, %s", frame_id, pprint.pformat(diffs))
     try:
-        diffs = sanitise.sanitise_diffs(diffs)
+        if not sanitised:
+            diffs = sanitise.sanitise_diffs(diffs)
     except parser.HTMLParseError, e:
         storage.set_bad_state(frame_id, ERROR_INVALID_HTML,
             str(e))
@@ -257,36 +1702,218 @@ def handle_send_diffs(storage, frame_id, diffs):
             logger.warn("Couldn't find frame %s" % (frame_id))
     return storage.last_change_id
 
-def handle_get_update(storage, change_id=None, init_html_required=False):
+def handle_register_viewer(storage):
+    """
+    Returns {"viewer_id": <id>} for the viewer to send with get_update, so
+    the server knows which diffs it still needs (see
+    Session.collect_acknowledged).
+    """
+    return {"viewer_id": storage.register_viewer()}
+
+def handle_get_viewer_lag(storage):
+    """
+    See Session.viewer_lag
+    """
+    return {"viewers": storage.viewer_lag()}
+
+def handle_get_update(storage, change_id=None, init_html_required=False,
+        timeout=None, viewer_id=None, conflate=False):
     """
     :param init_html_required:      Only return a response if the main frame
                                     has been loaded with a new page
+
+    :param timeout:                 Long polling: if nothing has changed since
+                                    change_id, wait up to this many seconds
+                                    for something to change before responding.
+                                    Needs a threaded server.
+
+    :param viewer_id:               From handle_register_viewer. Asking for
+                                    change_id acknowledges everything before
+                                    it.
+
+    :param conflate:                For viewers on slow connections: collapse
+                                    the diffs since change_id so that only
+                                    the latest value of anything is sent,
+                                    rather than every state in between (see
+                                    coalesce.conflate_diffs).
+
+    Note: The response is shared with other viewers, don't modify it.
+    """
+    return get_cached_update(storage, change_id, init_html_required,
+            timeout, viewer_id, conflate)[0]
+
+def handle_get_update_encoded(storage, change_id=None,
+        init_html_required=False, timeout=None, viewer_id=None,
+        conflate=False):
+    """
+    Same as handle_get_update, but returns the response already JSON encoded.
+    """
+    return get_cached_update(storage, change_id, init_html_required,
+            timeout, viewer_id, conflate)[1]
+
+def handle_get_subtree(storage, frame_path, ipath, change_id,
+        include_html=False):
+    """
+    Called by viewers repairing their copy of a frame's document when its
+    hash doesn't match (see merkle.py). Needs Session(content_hashes=True).
+
+    :param frame_path:      Frame the subtree is in
+    :param ipath:           Path of the subtree's root element
+    :param change_id:       Last change id the viewer has applied
+    :param include_html:    Send the subtree's HTML, tail text and properties
+                            too
+
+    Returns a dict with the subtree's "hash", its "shallow" hash (the root
+    element on its own) and its "children"'s hashes. If the document has
+    changed since change_id, returns {"stale": True} instead: the viewer
+    should catch up and try again. If there's nothing at ipath or the server
+    has no replica of the document, returns {"unavailable": True}.
+    """
+    change_id = int(change_id)
+    c = storage.changelogs.get(tuple(frame_path))
+    head = c.head if c is not None else None
+    if head is None:
+        return {"unavailable": True}
+    try:
+        result = head.get_subtree(ipath, change_id, bool(include_html))
+    except mirror.PathError:
+        return {"unavailable": True}
+    if result is None:
+        return {"stale": True}
+    return result
+
+def handle_get_frame_snapshot(storage, frame_path, change_id=None,
+        viewer_id=None):
+    """
+    Called by viewers which couldn't apply a frame's diffs, to start that
+    frame again without waiting for a new page (which is what get_update with
+    init_html_required does).
+
+    Returns a get_update response (see handle_get_update) where the frame and
+    the frames inside it have their current document as init_html, and every
+    other frame has the diffs since change_id as usual, so the viewer can
+    carry on from last_change_id. viewer_id is the same as for
+    handle_get_update.
+
+    Note: The response is shared with other viewers, don't modify it.
+    """
+    return get_cached_frame_snapshot(storage, frame_path, change_id,
+            viewer_id)[0]
+
+def handle_get_frame_snapshot_encoded(storage, frame_path, change_id=None,
+        viewer_id=None):
     """
+    Same as handle_get_frame_snapshot, but returns the response already JSON
+    encoded.
+    """
+    return get_cached_frame_snapshot(storage, frame_path, change_id,
+            viewer_id)[1]
+
+def get_cached_frame_snapshot(storage, frame_path, change_id, viewer_id=None):
     if change_id:
         change_id = int(change_id)
+    if viewer_id is not None:
+        storage.acknowledge(viewer_id, change_id)
+    frame_path = tuple(frame_path)
+    key = ("frame", frame_path, change_id)
+    return storage.response_cache.get(key,
+            lambda: build_frame_snapshot(storage, frame_path, change_id))
+
+def build_frame_snapshot(storage, frame_path, change_id):
+    """
+    Builds the get_frame_snapshot response, see build_update.
+    """
+    while True:
+        snapshot = storage.snapshot
+        try:
+            changesets = []
+            for path, c in snapshot.frames.iteritems():
+                if path[:len(frame_path)] == frame_path:
+                    changes = c.current_changes()
+                else:
+                    changes = c.changes_since_change_id(change_id)
+                changesets.append((path, changes))
+            return encode_update(changesets, snapshot.last_change_id)
+        except StaleSnapshot:
+            logger.debug("Snapshot went stale, retrying")
 
+def get_cached_update(storage, change_id, init_html_required, timeout=None,
+        viewer_id=None, conflate=False):
+    if change_id:
+        change_id = int(change_id)
+    if viewer_id is not None:
+        storage.acknowledge(viewer_id, change_id)
+    if timeout and change_id is not None:
+        storage.wait_for_change(change_id, float(timeout))
+    init_html_required = bool(init_html_required)
+    conflate = bool(conflate)
+    key = (change_id, init_html_required, conflate)
+    return storage.response_cache.get(key,
+            lambda: build_update(storage, change_id, init_html_required,
+                conflate))
+
+def build_update(storage, change_id, init_html_required, conflate=False):
+    """
+    Builds the get_update response (see handle_get_update) from the session's
+    current snapshot, without taking the session's write lock.
+
+    Returns (response, JSON encoded response)
+    """
+    while True:
+        snapshot = storage.snapshot
+        try:
+            return build_snapshot_update(snapshot, change_id,
+                    init_html_required, conflate)
+        except StaleSnapshot:
+            logger.debug("Snapshot went stale, retrying")
+
+def build_snapshot_update(snapshot, change_id, init_html_required,
+        conflate=False):
     # Viewer is in error recovery mode - don't send any new changes unless
     # the main frame has been refreshed.
     if init_html_required:
         has_init_html = False
         try:
-            main_changeset = storage.changelogs[('m',)]
-        except ChangelogNotFound:
+            main_changeset = snapshot.frames[('m',)]
+        except KeyError:
             pass
         else:
             if main_changeset.first_change_id >= change_id:
                 has_init_html = True
         if not has_init_html:
-            return {"last_change_id": storage.last_change_id}
+            response = {"last_change_id": snapshot.last_change_id}
+            return response, json.dumps(response)
 
-    changesets = [(frame_path, c.diffs_since_change_id(change_id)) \
-            for frame_path, c in storage.changelogs.iteritems()]
+    # Only frames that have changed since change_id have anything to send
+    changes_by_path = {}
+    for frame_path, c in snapshot.changed_frames(change_id):
+        if frame_path in changes_by_path:
+            continue
+        changes = c.changes_since_change_id(change_id, conflate)
+        changes_by_path[frame_path] = changes
+        if change_id is not None and "init_html" in changes[0]:
+            # Their iframes are recreated along with this frame's document
+            for child_path, child in snapshot.descendants(frame_path):
+                changes_by_path[child_path] = child.current_changes()
 
     # Changesets MUST be applied in order of top frames to bottom frames since
-    # the top frames need to contain the lower frame elements.  We can sort by
-    # frame path length to work this out. We'll sort the changesets and then
-    # transmit.
-    changesets.sort(key = lambda x: len(x[0]))
-    return {"changesets": changesets,
-            "last_change_id": storage.last_change_id}
+    # the top frames need to contain the lower frame elements. Frame paths
+    # sort parents first.
+    changesets = sorted(changes_by_path.items())
+    return encode_update(changesets, snapshot.last_change_id)
 
+def encode_update(changesets, last_change_id):
+    """
+    Returns (response, JSON encoded response) for a list of
+    (frame path, (changes, JSON encoded changes))
+    """
+    response = {"changesets": [(frame_path, changes) \
+                    for frame_path, (changes, encoded) in changesets],
+                "last_change_id": last_change_id}
+    encoded = "".join([
+        '{"changesets": [',
+        ", ".join('[%s, %s]' % (json.dumps(frame_path), encoded) \
+                for frame_path, (changes, encoded) in changesets),
+        '], "last_change_id": %s}' % (json.dumps(last_change_id)),
+    ])
+    return response, encoded
@@ -0,0 +1,101 @@
+"""
+Test diff coalescing (no browser required)
+"""
+
+import sys
+
+import util
+
+try:
+    import mirrordom.coalesce
+except ImportError:
+    sys.path.append(util.get_mirrordom_path())
+    import mirrordom.coalesce
+
+from mirrordom.coalesce import coalesce_diffs, conflate_diffs
+from mirrordom.mirror import DocumentMirror
+
+TEST_PAGE = """<html><head></head><body><div id="a">one<b>two</b></div><ul><li>a</li><li>b</li><li>c</li></ul><input type="text"/></body></html>"""
+
+class TestCoalesceDirect(util.TestBase):
+    """ Coalesced diffs have the same effect as the originals """
+
+    def apply(self, diffs):
+        doc = DocumentMirror(TEST_PAGE)
+        doc.apply_diffs(diffs)
+        return doc.tostring(), doc.get_prop_diffs()
+
+    def coalesce_and_compare(self, diffs, expected_length):
+        coalesced = coalesce_diffs(diffs)
+        assert len(coalesced) == expected_length, coalesced
+        assert self.apply(coalesced) == self.apply(diffs)
+        return coalesced
+
+    def test_merge_same_path(self):
+        """ Updates to the same node are merged, latest value wins """
+        diffs = [
+            ['attribs', 'html', [1, 0], {'class': 'x', 'title': 't'}, []],
+            ['props', 'html', [1, 2], {'value': 'a'}],
+            ['text', 'html', [1, 0], 'after', None],
+            ['attribs', 'html', [1, 0], {'class': 'y'}, ['title']],
+            ['props', 'html', [1, 2], {'value': 'ab'}],
+            ['text', 'html', [1, 0], None, 'first'],
+            ['attribs', 'html', [1, 0], {'title': 'u'}, []],
+        ]
+        coalesced = self.coalesce_and_compare(diffs, 3)
+        assert coalesced[0] == ['attribs', 'html', [1, 0],
+                {'class': 'y', 'title': 'u'}, []]
+        assert coalesced[1] == ['props', 'html', [1, 2], {'value': 'ab'}]
+        assert coalesced[2] == ['text', 'html', [1, 0], 'after', 'first']
+        # The originals are left alone
+        assert diffs[0][3] == {'class': 'x', 'title': 't'}
+
+    def test_replaced_subtrees(self):
+        """ Updates to nodes a later node diff replaces are dropped """
+        diffs = [
+            ['attribs', 'html', [1, 1, 2], {'class': 'gone'}, []],
+            ['text', 'html', [1, 1, 1], None, 'gone'],
+            ['attribs', 'html', [1, 0], {'class': 'kept'}, []],
+            ['deleted', 'html', [1, 1, 1]],
+            ['node', 'html', [1, 1, 1], '<li>B</li>', '', []],
+            ['node', 'html', [1, 1, 2], '<li>C</li>', '', []],
+        ]
+        coalesced = self.coalesce_and_compare(diffs, 3)
+        assert [d[0] for d in coalesced] == ['attribs', 'node', 'node']
+
+    def test_no_merge_across_structure(self):
+        """ Structural diffs change what paths mean """
+        diffs = [
+            ['attribs', 'html', [1, 1, 0], {'class': 'x'}, []],
+            ['node', 'html', [1, 1, 0], '<li>A</li>', '', []],
+            ['attribs', 'html', [1, 1, 0], {'title': 'y'}, []],
+            ['node', 'html', [1, 1, 1], '<li>D</li>', '', []],
+            ['deleted', 'html', [1, 1, 1]],
+        ]
+        coalesced = self.coalesce_and_compare(diffs, 4)
+        assert coalesced[1][3] == {'title': 'y'}
+        # The node deleted at the end still has to be created first
+        assert [d[0] for d in coalesced[2:]] == ['node', 'deleted']
+
+    def test_conflate(self):
+        """ Conflating carries merges past structure elsewhere """
+        diffs = [
+            ['props', 'html', [1, 2], {'value': 'a'}],
+            ['attribs', 'html', [1, 0], {'class': 'x'}, []],
+            ['node', 'html', [1, 1, 3], '<li>d</li>', '', []],
+            ['props', 'html', [1, 2], {'value': 'ab'}],
+            ['deleted', 'html', [1, 1, 3]],
+            ['props', 'html', [1, 2], {'value': 'abc'}],
+            ['attribs', 'html', [1, 0], {'class': 'y'}, []],
+            ['node', 'html', [1, 3], '<p>new</p>', '', []],
+        ]
+        assert len(coalesce_diffs(diffs)) == 8
+        conflated = conflate_diffs(diffs)
+        assert self.apply(conflated) == self.apply(diffs)
+        assert conflated == [
+            ['props', 'html', [1, 2], {'value': 'abc'}],
+            ['attribs', 'html', [1, 0], {'class': 'y'}, []],
+            ['node', 'html', [1, 1, 3], '<li>d</li>', '', []],
+            ['deleted', 'html', [1, 1, 3]],
+            ['node', 'html', [1, 3], '<p>new</p>', '', []],
+        ]
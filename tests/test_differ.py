@@ -0,0 +1,110 @@
+"""
+Test the server side diff engine (no browser required)
+"""
+
+import sys
+
+import util
+
+try:
+    import mirrordom.differ
+except ImportError:
+    sys.path.append(util.get_mirrordom_path())
+    import mirrordom.differ
+
+from mirrordom.differ import diff_documents
+from mirrordom.mirror import DocumentMirror
+from mirrordom.sanitise import sanitise_html
+from mirrordom.server import create_storage, handle_send_update, \
+        handle_get_update
+
+TEST_PAGE = """<html><head><title>t</title></head><body><div id="a" class="x">one<b>two</b>three</div><ul><li>a</li><li>b</li><li>c</li></ul><input type="text"><p>end</p></body></html>"""
+
+class TestDifferDirect(util.TestBase):
+    """ Applying the computed diffs turns one document into the other """
+
+    def make_document(self, html, props=None):
+        document = DocumentMirror(sanitise_html(html))
+        document.apply_diffs(props or [])
+        return document
+
+    def diff_and_compare(self, old_html, new_html, old_props=None,
+            new_props=None):
+        old = self.make_document(old_html, old_props)
+        new = self.make_document(new_html, new_props)
+        diffs = diff_documents(old, new)
+        old.apply_diffs(diffs)
+        assert old.tostring() == new.tostring(), diffs
+        assert sorted(old.get_prop_diffs()) == sorted(new.get_prop_diffs())
+        return diffs
+
+    def test_no_changes(self):
+        assert self.diff_and_compare(TEST_PAGE, TEST_PAGE) == []
+
+    def test_attribs_and_text(self):
+        """ Changes to existing nodes don't touch their siblings """
+        new_page = TEST_PAGE.replace('class="x"', 'title="t"') \
+                .replace('three', '3').replace('<li>b</li>', '<li>B</li>')
+        diffs = self.diff_and_compare(TEST_PAGE, new_page)
+        assert ['attribs', 'html', [1, 0], {'title': 't'}, ['class']] in diffs
+        assert ['text', 'html', [1, 0, 0], '3', None] in diffs
+        assert ['text', 'html', [1, 1, 1], None, 'B'] in diffs
+        assert not [d for d in diffs if d[0] in ('node', 'deleted')]
+
+    def test_structure(self):
+        """ Inserted and removed nodes rebuild their right siblings """
+        inserted = TEST_PAGE.replace('<ul>', '<ol><li>new</li></ol><ul>')
+        diffs = self.diff_and_compare(TEST_PAGE, inserted)
+        assert [d[0] for d in diffs] == ['deleted', 'node', 'node', 'node',
+                'node']
+        assert diffs[1][2:5] == [[1, 1], '<ol><li>new</li></ol>', '']
+
+        # Like diff_dom, only tag names are compared when lining nodes up
+        inserted = TEST_PAGE.replace('<li>a</li>', '<li>a</li><li>new</li>')
+        diffs = self.diff_and_compare(TEST_PAGE, inserted)
+        assert [d[0] for d in diffs] == ['text', 'text', 'node']
+
+        removed = TEST_PAGE.replace('<ul><li>a</li><li>b</li><li>c</li></ul>',
+                '')
+        diffs = self.diff_and_compare(TEST_PAGE, removed)
+        assert diffs[0] == ['deleted', 'html', [1, 1]]
+
+        truncated = TEST_PAGE.replace('<li>b</li><li>c</li>', '')
+        diffs = self.diff_and_compare(TEST_PAGE, truncated)
+        assert diffs == [['deleted', 'html', [1, 1, 1]]]
+
+    def test_props(self):
+        """ Properties are diffed and carried by new nodes """
+        old_props = [['props', 'html', [1, 2], {'value': 'a'}]]
+        new_props = [['props', 'html', [1, 2], {'value': 'ab'}],
+                ['props', 'html', [1, 3], {'value': 'new'}]]
+        new_page = TEST_PAGE.replace('<p>end</p>',
+                '<input type="text"><p>end</p>')
+        diffs = self.diff_and_compare(TEST_PAGE, new_page, old_props,
+                new_props)
+        assert ['props', 'html', [1, 2], {'value': 'ab'}, []] in diffs
+        node_diffs = [d for d in diffs if d[0] == 'node']
+        assert node_diffs[0][5] == [['html', [], {'value': 'new'}]]
+
+    def test_snapshot_upload(self):
+        """ Viewers get diffs when the broadcaster uploads snapshots """
+        storage = create_storage()
+        def send_snapshot(html, props=[], url='http://test/'):
+            data = {'html': html, 'props': props, 'url': url}
+            handle_send_update(storage, [[['m'], 'snapshot', data]], [['m']])
+
+        send_snapshot(TEST_PAGE)
+        start = handle_get_update(storage)
+        assert 'init_html' in start['changesets'][0][1]
+
+        send_snapshot(TEST_PAGE.replace('<li>c</li>', '<li>c</li><li>d</li>'))
+        send_snapshot(TEST_PAGE.replace('<li>c</li>', '<li>c</li><li>d</li>'))
+        update = handle_get_update(storage, start['last_change_id'] + 1)
+        diffs = update['changesets'][0][1]['diffs']
+        assert [d[0] for d in diffs] == ['node']
+        assert diffs[0][2:4] == [[1, 1, 3], '<li>d</li>']
+
+        # A new URL starts again
+        send_snapshot(TEST_PAGE, url='http://test/other')
+        update = handle_get_update(storage, update['last_change_id'] + 1)
+        assert 'init_html' in update['changesets'][0][1]
@@ -319,6 +319,44 @@ class TestFirefox(util.TestBrowserBase):
 
         assert any(x.endswith("test_iframe2.css") for x in stylesheet_hrefs)
 
+    def test_error_recovery_long_poll(self):
+        """
+        In error recovery mode, a response without changesets still moves the
+        viewer on, so its next long poll waits instead of returning at once.
+        Only long polls are followed straight away by another poll.
+        """
+        self.init_webdriver()
+        self.execute_script("""
+            window.polls = [];
+            viewer.pull_method = function(method, params, callback) {
+                window.polls.push(params);
+                if (window.polls.length < 5) {
+                    callback({"last_change_id": 20});
+                }
+            };
+            viewer.long_poll_timeout = 10;
+            viewer.error_status = MirrorDom.VIEWER_LOCAL_HTML_ERROR;
+            viewer.next_change_id = 10;
+            viewer.poll();
+        """)
+        time.sleep(0.5)
+        polls = self.execute_script("return window.polls;")
+        assert [p['change_id'] for p in polls[:2]] == [10, 21]
+        assert all(p['init_html_required'] == 'true' for p in polls)
+
+        # Without a change id the server doesn't wait, so neither do we
+        self.execute_script("""
+            window.polls = [];
+            viewer.receiving = false;
+            viewer.error_status = MirrorDom.VIEWER_OK;
+            viewer.next_change_id = null;
+            viewer.poll();
+        """)
+        time.sleep(0.5)
+        polls = self.execute_script("return window.polls;")
+        assert len(polls) == 1
+        assert 'timeout' not in polls[0]
+
 class TestIE(TestFirefox):
     @classmethod
     def _create_webdriver(cls):
@@ -0,0 +1,77 @@
+"""
+Test handling broadcaster updates on worker threads (no browser required)
+"""
+
+import sys
+import json
+
+import util
+
+try:
+    import mirrordom.ingest
+except ImportError:
+    sys.path.append(util.get_mirrordom_path())
+    import mirrordom.ingest
+
+import mirrordom.sanitise
+from mirrordom.ingest import IngestPipeline
+from mirrordom.server import create_storage, handle_send_update, \
+        handle_get_update
+
+BIG_PAGE = """<html><head><script>alert(1)</script></head><body>%s</body></html>""" % \
+        ("".join('<p onclick="x()">paragraph %s</p>' % (i) for i in range(2000)))
+SMALL_PAGE = """<html><head></head><body><ul><li>a</li></ul></body></html>"""
+
+class TestIngestDirect(util.TestBase):
+    """ Updates handled by the pipeline end up the same as synchronous ones """
+
+    def make_updates(self):
+        frames = [['m'], ['m', 0, 'i']]
+        def new_page(frame_path, html):
+            data = {'html': html, 'props': [], 'url': 'http://test/',
+                    'iframes': []}
+            return [[frame_path, 'new_page', data]]
+        return frames, [
+            new_page(['m'], BIG_PAGE),
+            new_page(['m', 0, 'i'], SMALL_PAGE),
+            [[['m', 0, 'i'], 'diffs', {'diffs': [
+                ['node', 'html', [1, 0, 1], '<li onclick="x()">b</li>', '',
+                    []]]}]],
+            [[['m', 0, 'i'], 'diffs', {'diffs': [
+                ['node', 'html', [1, 0, 2], '<li><b>c</i></li>', '', []]]}]],
+        ]
+
+    def test_same_as_synchronous(self):
+        """ Commits happen in the order updates were submitted """
+        frames, updates = self.make_updates()
+        expected = create_storage()
+        for messages in updates:
+            handle_send_update(expected, messages, frames)
+
+        # So the pipeline's parsing isn't all cache hits
+        mirrordom.sanitise.cache.clear()
+        pipeline = IngestPipeline(workers=4)
+        try:
+            storage = create_storage()
+            for i, messages in enumerate(updates):
+                if i % 2:
+                    # Still encoded, as they'd arrive over HTTP
+                    pipeline.submit(storage, json.dumps(messages),
+                            json.dumps(frames))
+                else:
+                    pipeline.submit(storage, messages, frames)
+            assert pipeline.flush(storage, timeout=30)
+        finally:
+            pipeline.stop()
+
+        assert handle_get_update(storage) == handle_get_update(expected)
+        main = storage.changelogs[('m',)]
+        child = storage.changelogs[('m', 0, 'i')]
+        assert main.first_change_id < child.first_change_id
+        assert child.bad_state is not None
+
+        timings = pipeline.timings.summary()
+        assert timings['commit']['count'] == 4
+        # The last diff doesn't parse
+        assert timings['parse']['count'] == 3
+        assert timings['parse']['total'] > 0
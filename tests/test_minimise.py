@@ -0,0 +1,110 @@
+"""
+Test rewriting sibling re-adds into inserts and moves (no browser required)
+"""
+
+import sys
+import copy
+
+import util
+
+try:
+    import mirrordom.minimise
+except ImportError:
+    sys.path.append(util.get_mirrordom_path())
+    import mirrordom.minimise
+
+from mirrordom.minimise import minimise_diffs
+from mirrordom.differ import diff_documents
+from mirrordom.mirror import DocumentMirror
+from mirrordom.sanitise import sanitise_html
+from mirrordom.server import create_storage, handle_send_update, \
+        handle_get_update
+
+MESSAGES = "".join('<div class="msg">message %s</div>' % (i) \
+        for i in range(50))
+FEED_PAGE = """<html><head></head><body><div id="feed">%s</div></body></html>"""
+
+class TestMinimiseDirect(util.TestBase):
+    """ Minimised diffs have the same effect as the originals """
+
+    def apply(self, html, diffs):
+        doc = DocumentMirror(sanitise_html(html))
+        doc.apply_diffs(diffs)
+        return doc.tostring(), doc.get_prop_diffs()
+
+    def minimise_and_compare(self, old_html, diffs):
+        doc = DocumentMirror(sanitise_html(old_html))
+        minimised = minimise_diffs(doc, copy.deepcopy(diffs))
+        expected = self.apply(old_html, diffs)
+        assert (doc.tostring(), doc.get_prop_diffs()) == expected
+        assert self.apply(old_html, minimised) == expected
+        return minimised
+
+    def diff_pages(self, old_html, new_html):
+        old = DocumentMirror(sanitise_html(old_html))
+        new = DocumentMirror(sanitise_html(new_html))
+        return diff_documents(old, new)
+
+    def test_prepend(self):
+        """ Prepending to a feed only sends the new node """
+        old_html = FEED_PAGE % (MESSAGES)
+        new_html = FEED_PAGE % ('<h2>Today</h2>' + MESSAGES)
+        diffs = self.diff_pages(old_html, new_html)
+        assert len(diffs) == 52
+        minimised = self.minimise_and_compare(old_html, diffs)
+        assert minimised == [['insert', 'html', [1, 0, 0], '<h2>Today</h2>',
+            '', []]]
+
+    def test_remove_and_reorder(self):
+        """ Unwanted nodes are dropped and the rest put in order """
+        old_html = FEED_PAGE % ('<div>a</div><p>x</p><div>b</div>'
+                '<div>c</div><p>y</p>')
+        new_nodes = ['<div>c</div>', '<div>a</div>', '<span>new</span>',
+                '<div>b</div>']
+        diffs = [['deleted', 'html', [1, 0, 0]]] + \
+                [['node', 'html', [1, 0, i], html, '', []] \
+                for i, html in enumerate(new_nodes)]
+        minimised = self.minimise_and_compare(old_html, diffs)
+        assert set(d[0] for d in minimised) == set(['move', 'deleted',
+            'insert'])
+
+    def test_props_must_match(self):
+        """ Nodes with different properties aren't reused """
+        old_html = FEED_PAGE % ('<input type="text"/>' * 20)
+        props = [['props', 'html', [1, 0, 0], {'value': 'old'}]]
+        diffs = props + [['deleted', 'html', [1, 0, 0]]] + \
+                [['node', 'html', [1, 0, i], '<input type="text"/>', '',
+                    [['html', [], {'value': 'new'}]] if i == 0 else []] \
+                for i in range(20)]
+        minimised = self.minimise_and_compare(old_html, diffs)
+        assert [d[0] for d in minimised] == ['props', 'move', 'deleted',
+                'insert']
+
+    def test_no_match(self):
+        """ Runs with nothing in common are left alone """
+        old_html = FEED_PAGE % ('<div>a</div><div>b</div>')
+        diffs = [['deleted', 'html', [1, 0, 0]],
+                ['node', 'html', [1, 0, 0], '<p>c</p>', '', []]]
+        assert self.minimise_and_compare(old_html, diffs) == diffs
+
+    def test_session(self):
+        """ Sessions store minimised diffs """
+        storage = create_storage(minimise_diffs=True)
+        old_html = FEED_PAGE % (MESSAGES)
+        data = {'html': old_html, 'props': [], 'url': 'http://test/',
+                'iframes': []}
+        handle_send_update(storage, [[['m'], 'new_page', data]], [['m']])
+        start = handle_get_update(storage)
+
+        diffs = self.diff_pages(old_html,
+                FEED_PAGE % ('<h2>Today</h2>' + MESSAGES))
+        handle_send_update(storage, [[['m'], 'diffs', {'diffs': diffs}]],
+                [['m']])
+        update = handle_get_update(storage, start['last_change_id'] + 1)
+        stored = update['changesets'][0][1]['diffs']
+        assert [d[0] for d in stored] == ['insert']
+
+        # New viewers get the current document
+        init = handle_get_update(storage)['changesets'][0][1]['init_html']
+        assert init.count('class="msg"') == 50
+        assert '<h2>Today</h2>' in init
@@ -3,7 +3,10 @@ Test parsing of innerHTML constructs
 """
 
 import sys
+import os
+import glob
 import lxml.etree
+import lxml.html
 
 from nose.tools import nottest
 
@@ -15,7 +18,31 @@ except ImportError:
     sys.path.append(util.get_mirrordom_path())
     import mirrordom.server
 
-from mirrordom.parser import parse_html
+from mirrordom.parser import parse_html, parse_html_fast, FastPathRejected
+from mirrordom.parser import OuterHTMLParser, HTMLParseError
+
+# Things the fast path has to either get right or reject
+FAST_PATH_EXTRAS = [
+    '<div>a &amp; b &#65;</div>',
+    '<a href="x?a=1&amp;b=2" title="&lt;">link</a>',
+    '<a href="hello" ?>IE</a>',
+    '<a href="hello" "="">Chrome</a>',
+    '<div><input type="checkbox" checked><input disabled=""></div>',
+    '<div><p>one<p>two<ul><li>a<li>b</ul></div>',
+    '<table><tbody><tr><td>a<td>b</tr></tbody></table>',
+    '<div><span>x</div>',
+    '<div><svg viewBox="0 0 1 1"><linearGradient/></svg></div>',
+    '<p>a<div>b</div></p>',
+    '<td>cell</td>',
+    '<div><wbr>a<source src="x">b<br></br>c</div>',
+    ' <div>x</div> trailing',
+    '<div><!-- <b>x</b> --><script>if (a<b) {}</script></div>',
+    '<div>\x00</div>',
+    '<a title=a&amp;b>x</a>',
+    '<a href=a?b=c>x</a>',
+    '<a title=a`b>x</a>',
+    '<a title="a\x01b">x\x1f</a>',
+]
 
 def setupModule():
     util.start_webserver()
@@ -134,6 +161,89 @@ class TestParseDirect(util.TestBase):
         assert self.parse_and_compare(svg, desired, ignore_tag_case=False,
                 ignore_attr_case=False)
 
+    def test_fast_path_matches(self):
+        """
+        Parse everything in tests/html, and every element in it as a fragment,
+        with both parsers. Whenever the fast path doesn't reject the HTML, the
+        trees have to be the same.
+        """
+        corpus = list(FAST_PATH_EXTRAS)
+        html_dir = util.get_relative_path("html")
+        for f in sorted(glob.glob(os.path.join(html_dir, "*.html"))):
+            html = open(f).read()
+            corpus.append(html)
+            try:
+                tree = parse_html(html, fast_path=False)
+            except Exception:
+                continue
+            corpus.extend(lxml.html.tostring(e, with_tail=False) \
+                    for e in tree.iter() if isinstance(e.tag, basestring))
+
+        used = 0
+        for html in corpus:
+            try:
+                fast = parse_html_fast(html)
+            except FastPathRejected:
+                continue
+            used += 1
+            expected = lxml.etree.tostring(parse_html(html, fast_path=False))
+            assert lxml.etree.tostring(fast) == expected, html
+        assert used > len(corpus) / 2
+
+    def test_attribute_hacks(self):
+        """ IE's ? and Chrome's "="" are dropped, real junk is still an error
+        """
+        raw = """<div><a href="hello" ? title='t' "="" target=_top>Hi</a></div>"""
+        desired = """<div><a href="hello" title="t" target="_top">Hi</a></div>"""
+        parsed = lxml.etree.tostring(parse_html(raw, fast_path=False))
+        assert self.compare_html(desired, parsed)
+
+        for bad in ["""<div a=b=c></div>""", """<div a="b" !></div>"""]:
+            try:
+                parse_html(bad, fast_path=False)
+            except HTMLParseError:
+                pass
+            else:
+                assert False, "Expected HTMLParseError for %s" % (bad)
+
+    def test_starttag_single_pass(self):
+        """
+        Start tags that used to make the regexes backtrack (lots of
+        attributes, long values, and an unterminated tag) are scanned in one
+        pass: each attribute is matched once, starting where the last one
+        ended.
+        """
+        class CountingPattern(object):
+            def __init__(self, pattern):
+                self.pattern = pattern
+                self.calls = []
+
+            def match(self, string, pos=0):
+                m = self.pattern.match(string, pos)
+                self.calls.append((pos, m.end() if m is not None else None))
+                return m
+
+        n = 1000
+        pathological = [
+            ("<b%s>" % ("".join(" a%d=b" % i for i in range(n))), n),
+            ('<img src="data:image/png;base64,%s">' % ("A" * n * 50), 1),
+            ("<a %s" % ("x=\"y\" " * n), n),
+            ("<a %s!>" % (" x" * n), n),
+        ]
+        for html, num_attribs in pathological:
+            parser = OuterHTMLParser()
+            parser.ATTRIBUTE = CountingPattern(OuterHTMLParser.ATTRIBUTE)
+            parser.rawdata = html
+            try:
+                parser.scan_starttag(0)
+            except HTMLParseError:
+                pass
+            calls = parser.ATTRIBUTE.calls
+            # One match per attribute, plus the one that finds the end
+            assert len(calls) == num_attribs + 1, html[:20]
+            for (pos, end), (next_pos, next_end) in zip(calls, calls[1:]):
+                assert end > pos and next_pos == end, html[:20]
+
 class TestFirefox(util.TestBrowserBase):
     """
     Test applying HTML fragments to the browser, reading them back, sanitising
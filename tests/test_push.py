@@ -0,0 +1,137 @@
+"""
+Test pushing updates to viewers (no browser required)
+"""
+
+import sys
+import json
+import socket
+import base64
+import threading
+
+import util
+
+try:
+    import mirrordom.push
+except ImportError:
+    sys.path.append(util.get_mirrordom_path())
+    import mirrordom.push
+
+from mirrordom.server import create_storage, SessionManager
+from mirrordom.push import PushHub, PushServer, read_frame, \
+        websocket_accept_key, OPCODE_TEXT
+
+class TestPushDirect(util.ServerTestBase):
+    """ Test the push server's fan-out """
+
+    def test_fan_out(self):
+        """ Subscribers at the same change id share one encoded update """
+        storage = create_storage()
+        self.send_new_page(storage)
+        hub = PushHub(storage)
+        hub.start()
+        subscribers = [hub.subscribe(storage.last_change_id + 1) \
+                for i in range(3)]
+        self.add_list_item(storage, 1)
+
+        updates = [s.get(5) for s in subscribers]
+        assert updates[0] is not None
+        assert all(u is updates[0] for u in updates)
+        update = json.loads(updates[0])
+        assert update['last_change_id'] == storage.last_change_id
+        assert 'init_html' not in update['changesets'][0][1]
+
+        hub.stop()
+        assert all(s.closed for s in subscribers)
+        assert storage.listeners == []
+
+    def test_slow_subscriber(self):
+        """ Subscribers with full queues catch up with one update """
+        storage = create_storage()
+        self.send_new_page(storage)
+        # Not started, so updates are sent when we say
+        hub = PushHub(storage, max_queue=2)
+        s = hub.subscribe(None)
+        for pos in range(1, 6):
+            self.add_list_item(storage, pos)
+            hub.send_updates()
+        assert len(s.queue) == 2
+
+        first = json.loads(s.get(0))
+        assert 'init_html' in first['changesets'][0][1]
+        second = json.loads(s.get(0))
+        assert second['last_change_id'] == first['last_change_id'] + 1
+
+        # The catch up covers everything that was skipped
+        third = json.loads(s.get(0))
+        assert third['last_change_id'] == storage.last_change_id
+        diffs = third['changesets'][0][1]['diffs']
+        assert [d[3] for d in diffs if d[0] == 'node'] == \
+                ['<li>%s</li>' % (pos) for pos in range(2, 6)]
+        assert s.get(0) is None
+
+    def test_publish_off_broadcaster_thread(self):
+        """
+        The broadcaster only wakes the hub, updates are built by its sender
+        thread
+        """
+        storage = create_storage()
+        self.send_new_page(storage)
+        hub = PushHub(storage)
+        hub.start()
+        s = hub.subscribe(storage.last_change_id + 1)
+        threads = []
+        send_updates = hub.send_updates
+        def record_send_updates():
+            threads.append(threading.current_thread())
+            send_updates()
+        hub.send_updates = record_send_updates
+
+        self.add_list_item(storage, 1)
+        update = json.loads(s.get(5))
+        assert update['last_change_id'] == storage.last_change_id
+        assert threads and all(t is hub.sender for t in threads)
+        hub.stop()
+        assert not hub.sender.is_alive()
+
+    def test_websocket(self):
+        """ Viewers get pushed updates over a WebSocket and can resume """
+        sessions = SessionManager()
+        session = sessions.get_session("test", create=True)
+        self.send_new_page(session)
+        change_id = session.last_change_id + 1
+
+        server = PushServer(("127.0.0.1", 0), sessions,
+                default_session_id="test")
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        try:
+            key = base64.b64encode("0123456789abcdef")
+            sock = socket.create_connection(server.server_address, 5)
+            sock.sendall("GET /?change_id=%s HTTP/1.1\r\n"
+                    "Host: localhost\r\n"
+                    "Upgrade: websocket\r\n"
+                    "Connection: Upgrade\r\n"
+                    "Sec-WebSocket-Key: %s\r\n"
+                    "Sec-WebSocket-Version: 13\r\n\r\n" % (change_id, key))
+            rfile = sock.makefile("rb")
+            assert rfile.readline().startswith("HTTP/1.1 101")
+            headers = []
+            while True:
+                line = rfile.readline().strip()
+                if not line:
+                    break
+                headers.append(line)
+            assert "Sec-WebSocket-Accept: %s" % (websocket_accept_key(key)) \
+                    in headers
+
+            self.add_list_item(session, 1)
+            opcode, payload = read_frame(rfile)
+            assert opcode == OPCODE_TEXT
+            update = json.loads(payload)
+            assert update['last_change_id'] == change_id
+            assert update['changesets'][0][1]['diffs'][0][2] == [1, 0, 1]
+            sock.close()
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -1,5 +1,10 @@
 import sys
+import os
+import glob
 import lxml
+import lxml.etree
+import lxml.html
+import lxml.html.clean
 
 from nose.tools import nottest
 
@@ -11,7 +16,46 @@ except ImportError:
     sys.path.append(util.get_mirrordom_path())
     import mirrordom.server
 
-from mirrordom.sanitise import sanitise_html
+from mirrordom.sanitise import sanitise_html, SanitiseCache, \
+        CACHE_ENTRY_OVERHEAD
+from mirrordom.sanitise import parse_sanitised, force_insert_tbody
+from mirrordom.sanitise import sanitise_stream
+from mirrordom.parser import parse_html, HTMLParseError
+
+# Things parse_sanitised has to sanitise the same way as sanitise_tree used to
+SANITISE_EXTRAS = [
+    '<div onclick="a()" onmouseover="b()" title="t">x<!-- c -->y</div>',
+    '<div><a href="http://x/" onclick="go()">a</a><a name="n">b</a></div>',
+    '<div><iframe src="http://x/" name="f"></iframe>tail</div>',
+    '<div>a<script>if (a<b) {}</script>b<title>t</title>c<meta name="m">d</div>',
+    '<div>a<blink>b<i>c</i>d</blink>e<marquee>f</marquee>g</div>',
+    '<blink class="x"><b>bold</b></blink>',
+    '<title class="x">gone<b>too</b></title>',
+    '<div><image src="x.png">a</image></div>',
+    '<table><colgroup><col></colgroup><tr><td>a</td></tr><tfoot></tfoot><tr><td>b</td></tr></table>',
+    '<table><blink><tr><td>a</td></tr></blink><script></script><tr><td>b</td></tr></table>',
+    '<table><tr><td><table><tr><td>inner</td></tr></table></td></tr></table>',
+    '<div><p>unclosed<table><tr><td>x<a href="y">',
+    '<div><svg viewBox="0 0 1 1"><linearGradient onload="x()"/><image/></svg></div>',
+]
+
+def old_sanitise_tree(tree):
+    """ sanitise.sanitise_tree, before it was done in one pass """
+    cleaner = lxml.html.clean.Cleaner(frames=False, links=False, forms=False,
+            style=False, page_structure=False, scripts=True, embedded=False,
+            safe_attrs_only=False, kill_tags=['title'],
+            remove_unknown_tags=False, javascript=False)
+    cleaner(tree)
+    force_insert_tbody(tree)
+    for iframe in tree.iter('iframe'):
+        iframe.attrib.pop("src", None)
+    for anchor in tree.iter('a'):
+        if "href" in anchor.attrib:
+            anchor.attrib["href"] = "#"
+    for el in tree.iter():
+        for aname in el.attrib.keys():
+            if aname.startswith('on'):
+                del el.attrib[aname]
 
 def setupModule():
     util.start_webserver()
@@ -224,6 +268,127 @@ class TestSanitiseDirect(util.TestBase):
         """
         assert self.sanitise_and_compare(raw, sanitised)
 
+    def test_cache(self):
+        """ Repeated HTML comes from the cache, least recently used first out
+        """
+        cache = SanitiseCache(max_bytes=4 * CACHE_ENTRY_OVERHEAD)
+        calls = []
+        def build(html):
+            def do_build():
+                calls.append(html)
+                return sanitise_html(html, use_cache=False)
+            return do_build
+
+        widget = '<div onclick="go()"><a href="http://x/">x</a></div>'
+        expected = sanitise_html(widget, use_cache=False)
+        assert cache.get(widget, build(widget)) == expected
+        assert cache.get(widget, build(widget)) == expected
+        assert cache.get(widget, build(widget), retain_case=True) == expected
+        assert len(calls) == 2
+        assert cache.stats()['hits'] == 1
+        # Only the sanitised HTML is kept, so that's all that's charged
+        assert cache.stats()['bytes'] == 2 * (CACHE_ENTRY_OVERHEAD +
+                len(expected))
+
+        # Parse errors are remembered
+        bad = '<div><b>x</i></div>'
+        for i in range(2):
+            try:
+                cache.get(bad, build(bad))
+            except HTMLParseError:
+                pass
+            else:
+                assert False, "Expected HTMLParseError"
+        assert calls.count(bad) == 1
+
+        # Over budget, the oldest entries go
+        for i in range(3):
+            html = '<p>%s</p>' % (str(i) * 80)
+            cache.get(html, build(html))
+        stats = cache.stats()
+        assert stats['evictions'] > 0
+        assert stats['bytes'] <= 4 * CACHE_ENTRY_OVERHEAD
+        assert calls.count(widget) == 2
+        cache.get(widget, build(widget))
+        assert calls.count(widget) == 3
+
+    def test_single_pass_matches(self):
+        """
+        Sanitise everything in tests/html, and every element in it as a
+        fragment, with and without the fast path. Has to come out the same
+        as parsing and then sanitising in several passes.
+        """
+        corpus = list(SANITISE_EXTRAS)
+        html_dir = util.get_relative_path("html")
+        for f in sorted(glob.glob(os.path.join(html_dir, "*.html"))):
+            html = open(f).read()
+            corpus.append(html)
+            try:
+                tree = parse_html(html, fast_path=False)
+            except Exception:
+                continue
+            corpus.extend(lxml.html.tostring(e, with_tail=False) \
+                    for e in tree.iter() if isinstance(e.tag, basestring))
+
+        for html in corpus:
+            for retain_case, fast_path in [(False, True), (False, False),
+                    (True, False)]:
+                try:
+                    expected = parse_html(html, retain_case=retain_case,
+                            fast_path=fast_path)
+                except Exception:
+                    continue
+                actual = parse_sanitised(html, retain_case=retain_case,
+                        fast_path=fast_path)
+                if expected is None:
+                    assert actual is None, html
+                    continue
+                old_sanitise_tree(expected)
+                assert lxml.etree.tostring(actual) == \
+                        lxml.etree.tostring(expected), (html, fast_path)
+
+    def test_stream_matches(self):
+        """
+        Sanitising HTML a chunk at a time comes out the same as all at once,
+        wherever the chunks are split
+        """
+        corpus = list(SANITISE_EXTRAS)
+        corpus.append(u'<div title="caf\xe9 > bar">\u2603<script>'
+                u'if (a </b) {}</script>\xe9</div>')
+        html_dir = util.get_relative_path("html")
+        for f in sorted(glob.glob(os.path.join(html_dir, "*.html"))):
+            corpus.append(open(f).read())
+
+        for html in corpus:
+            try:
+                expected = sanitise_html(html, use_cache=False)
+            except Exception:
+                continue
+            raw = html.encode("utf-8") if isinstance(html, unicode) else html
+            for size in [1, 2, 7, 64, 4096]:
+                chunks = [raw[i:i + size] for i in range(0, len(raw), size)]
+                actual = sanitise_stream(chunks, encoding="utf-8")
+                assert actual == expected, (html, size)
+
+    def test_stream_aborts(self):
+        """ Chunks stop being read once the HTML doesn't parse """
+        read = []
+        def chunks():
+            yield '<div><span>ok</span>'
+            read.append(1)
+            yield '<b>bad</i>'
+            read.append(2)
+            for i in range(1000):
+                read.append(i)
+                yield '<p>more</p>'
+        try:
+            sanitise_stream(chunks())
+        except HTMLParseError:
+            pass
+        else:
+            assert False, "Expected HTMLParseError"
+        assert read == [1]
+
 class TestFirefox(util.TestBrowserBase):
     """
     Test applying HTML fragments to the browser, reading them back, sanitising
@@ -0,0 +1,772 @@
+"""
+Test the mirrordom server storage directly (no browser required)
+"""
+
+import sys
+import json
+import time
+import threading
+
+import lxml.etree
+
+import util
+
+try:
+    import mirrordom.server
+except ImportError:
+    sys.path.append(util.get_mirrordom_path())
+    import mirrordom.server
+
+from mirrordom.server import create_storage, handle_send_update, \
+        handle_get_update, handle_get_update_encoded, ResponseCache, \
+        SessionManager, SessionNotFound, SessionExists, handle_get_subtree, \
+        handle_get_frame_snapshot, handle_get_frame_snapshot_encoded, \
+        handle_register_viewer, handle_get_viewer_lag, ChangeIndex, \
+        handle_html_stream
+from mirrordom.frames import FrameTrie
+from mirrordom.mirror import DocumentMirror
+from mirrordom import merkle
+
+TEST_PAGE = util.SERVER_TEST_PAGE
+
+class TestServerDirect(util.ServerTestBase):
+    """ Test changelog handling on the server """
+
+    # -----------------------------------------------------------------------------
+    # Tests
+    # -----------------------------------------------------------------------------
+    def test_compaction(self):
+        """ Compaction folds old diff sets into init_html """
+        storage = create_storage(compact_threshold=3)
+        self.send_new_page(storage)
+        for pos in range(2, 5):
+            self.add_list_item(storage, pos)
+
+        changelog = storage.changelogs[('m',)]
+        assert changelog.num_diff_sets == 1
+
+        # New viewers get the folded document plus the remaining diffs
+        changes = self.get_main_changes(storage)
+        desired = """<html><head></head><body><ul><li>a</li><li>b</li>
+                <li>2</li><li>3</li></ul><input type="text"/>
+                </body></html>"""
+        assert self.compare_html(desired, changes['init_html'],
+                ignore_all_whitespace=True)
+        assert changes['diffs'][0] == \
+                ['props', 'html', [1, 1], {'value': 'v3'}]
+        assert changes['diffs'][1][:3] == ['node', 'html', [1, 0, 4]]
+
+    def test_compaction_keeps_tail(self):
+        """ Viewers that are up to date only get the unfolded diffs """
+        storage = create_storage(compact_threshold=3)
+        self.send_new_page(storage)
+        for pos in range(2, 4):
+            self.add_list_item(storage, pos)
+        change_id = storage.last_change_id + 1
+        # This one triggers the compaction
+        self.add_list_item(storage, 4)
+        assert storage.changelogs[('m',)].num_diff_sets == 1
+
+        changes = self.get_main_changes(storage, change_id)
+        assert 'init_html' not in changes
+        assert [d[0] for d in changes['diffs']] == ['node', 'props']
+
+    def test_compaction_busy(self):
+        """ Viewers don't wait for the writer to fold diffs into init_html """
+        storage = create_storage(compact_threshold=3)
+        self.send_new_page(storage)
+        for pos in range(2, 7):
+            self.add_list_item(storage, pos)
+
+        # Hold up the next compaction part way through
+        base_live = storage.changelogs[('m',)].base_live
+        apply_diffs = base_live.mirror.apply_diffs
+        folding = threading.Event()
+        release = threading.Event()
+        def slow_apply_diffs(diffs):
+            folding.set()
+            release.wait()
+            apply_diffs(diffs)
+        base_live.mirror.apply_diffs = slow_apply_diffs
+        t = threading.Thread(target=self.add_list_item, args=(storage, 7))
+        t.start()
+        try:
+            assert folding.wait(5)
+            assert base_live.lock.locked()
+            changes = self.get_main_changes(storage)
+        finally:
+            release.set()
+            t.join()
+        desired = """<html><head></head><body><ul><li>a</li><li>b</li>
+                <li>2</li><li>3</li></ul><input type="text"/>
+                </body></html>"""
+        assert self.compare_html(desired, changes['init_html'],
+                ignore_all_whitespace=True)
+        assert [d[3] for d in changes['diffs'] if d[0] == 'node'] == \
+                ['<li>4</li>', '<li>5</li>', '<li>6</li>']
+
+    def test_ring_buffer(self):
+        """ Evicted change ids are served with a snapshot """
+        storage = create_storage(capacity=4)
+        self.send_new_page(storage)
+        first_change_id = storage.last_change_id
+        for pos in range(2, 102):
+            self.add_list_item(storage, pos)
+
+        changelog = storage.changelogs[('m',)]
+        assert changelog.num_diff_sets == 4
+        assert changelog.first_change_id == storage.last_change_id - 4
+
+        changes = self.get_main_changes(storage, first_change_id)
+        assert 'init_html' in changes
+        assert changes['diffs'][0] == \
+                ['props', 'html', [1, 1], {'value': 'v97'}]
+        assert len(changes['diffs']) == 9
+
+        # Anything still in the buffer is a straight slice
+        for i in range(4):
+            change_id = storage.last_change_id - i
+            changes = self.get_main_changes(storage, change_id)
+            assert 'init_html' not in changes
+            assert len(changes['diffs']) == (i + 1) * 2
+            assert changes['diffs'][0][2] == [1, 0, 101 - i]
+
+    def test_live_mirror(self):
+        """ New viewers get a snapshot of the current document """
+        storage = create_storage(live_mirror=True)
+        self.send_new_page(storage)
+        change_id = storage.last_change_id
+        for pos in range(2, 6):
+            self.add_list_item(storage, pos)
+
+        changes = self.get_main_changes(storage)
+        desired = """<html><head></head><body><ul><li>a</li><li>b</li>
+                <li>2</li><li>3</li><li>4</li><li>5</li></ul>
+                <input type="text"/></body></html>"""
+        assert self.compare_html(desired, changes['init_html'],
+                ignore_all_whitespace=True)
+        assert changes['diffs'] == [['props', 'html', [1, 1], {'value': 'v5'}]]
+        assert changes['last_change_id'] == storage.last_change_id
+
+        # Viewers that are partway through still get diffs
+        changes = self.get_main_changes(storage, change_id + 1)
+        assert 'init_html' not in changes
+        assert len(changes['diffs']) == 8
+
+        # Incremental serialisation matches serialising from scratch
+        doc = storage.changelogs[('m',)].head.mirror
+        assert doc.tostring() == lxml.etree.tostring(doc.root)
+
+        # Diffs that don't fit the document turn the mirror off
+        self.send_diffs(storage, [['deleted', 'html', [1, 5]]])
+        assert storage.changelogs[('m',)].head is None
+        changes = self.get_main_changes(storage)
+        assert changes['diffs'][-1] == ['deleted', 'html', [1, 5]]
+
+    def test_live_mirror_busy(self):
+        """
+        Viewers don't wait for a live mirror someone else is using, they
+        build the document from init_html and the diffs
+        """
+        storage = create_storage(live_mirror=True, content_hashes=True)
+        self.send_new_page(storage)
+        for pos in range(2, 4):
+            self.add_list_item(storage, pos)
+        head = storage.changelogs[('m',)].head
+        with head.lock:
+            changes = self.get_main_changes(storage)
+            assert not storage.snapshot.frames[('m',)].head.ready
+            assert handle_get_subtree(storage, ['m'], [1],
+                    storage.last_change_id) == {"stale": True}
+        desired = """<html><head></head><body><ul><li>a</li><li>b</li></ul>
+                <input type="text"/></body></html>"""
+        assert self.compare_html(desired, changes['init_html'],
+                ignore_all_whitespace=True)
+        assert [d[3] for d in changes['diffs'] if d[0] == 'node'] == \
+                ['<li>2</li>', '<li>3</li>']
+
+        # Once it's free, the current document is served again (after the
+        # response cached above goes)
+        storage.response_cache.invalidate()
+        changes = self.get_main_changes(storage)
+        assert '<li>3</li>' in changes['init_html']
+
+    def test_content_hashes(self):
+        """ Changesets carry a hash of the document the diffs lead to """
+        storage = create_storage(content_hashes=True)
+        self.send_new_page(storage)
+        changes = self.get_main_changes(storage)
+        start_id = changes['last_change_id']
+        start_hash = changes['hash']
+        head = storage.changelogs[('m',)].head
+        assert start_hash == head.root_hash()
+
+        self.send_diffs(storage, [
+            ['text', 'html', [1, 0, 1], 'after', 'B'],
+            ['attribs', 'html', [1, 0], {'class': 'list'}, []],
+            ['insert', 'html', [1, 0, 0], '<li>new</li>', '', []],
+            ['move', 'html', [1, 0, 2], 0],
+        ])
+        changes = self.get_main_changes(storage, start_id + 1)
+        assert changes['hash'] == head.root_hash()
+        assert changes['hash'] != start_hash
+
+        # Updating hashes as diffs arrive gives the same answer as hashing
+        # the resulting document from scratch
+        fresh = DocumentMirror(head.mirror.tostring())
+        assert merkle.subtree_hash(fresh.root, {}) == changes['hash']
+
+    def test_content_hashes_skip_prefixed_attributes(self):
+        """
+        Namespaced attributes aren't hashed, however they were parsed (the
+        viewer skips them too)
+        """
+        plain = DocumentMirror('<div><svg><use x="1"/></svg></div>')
+        expected = merkle.subtree_hash(plain.root, {})
+        for html in ['<div><svg><use xlink:href="#a" x="1"/></svg></div>',
+                '<div><svg xmlns:xlink="http://www.w3.org/1999/xlink">'
+                '<use xlink:href="#a" x="1"/></svg></div>']:
+            doc = DocumentMirror(html)
+            assert merkle.subtree_hash(doc.root, {}) == expected, html
+
+    def test_get_subtree(self):
+        """ Viewers can fetch hashes and HTML for part of a document """
+        storage = create_storage(content_hashes=True)
+        self.send_new_page(storage)
+        change_id = storage.last_change_id
+
+        result = handle_get_subtree(storage, ['m'], [1, 0], change_id)
+        ul = storage.changelogs[('m',)].head.mirror.root[1][0]
+        assert result['hash'] == merkle.subtree_hash(ul, {})
+        assert result['children'] == merkle.child_hashes(ul, {})
+        assert 'html' not in result
+
+        result = handle_get_subtree(storage, ['m'], [1, 1], change_id, True)
+        assert result['html'] == '<input type="text"/>'
+        assert result['props'] == [['html', [], {'value': 'hello'}]]
+
+        # Viewers that are behind need to catch up first
+        assert handle_get_subtree(storage, ['m'], [], change_id - 1) == \
+                {'stale': True}
+        assert handle_get_subtree(storage, ['m'], [1, 5], change_id) == \
+                {'unavailable': True}
+        assert handle_get_subtree(create_storage(), ['m'], [], 0) == \
+                {'unavailable': True}
+
+    def test_catch_up_planner(self):
+        """ Viewers far behind get the document rather than every diff """
+        for ratio in [4, None]:
+            storage = create_storage(live_mirror=True, snapshot_ratio=ratio)
+            self.send_new_page(storage)
+            change_id = storage.last_change_id + 1
+            for i in range(50):
+                self.send_diffs(storage,
+                        [['text', 'html', [1, 0, 0], None, 'item %s' % (i)]])
+                # Someone's looking at the current document
+                self.get_main_changes(storage)
+
+            changes = self.get_main_changes(storage, change_id)
+            if ratio is None:
+                assert 'init_html' not in changes
+                assert len(changes['diffs']) == 50
+            else:
+                assert '<li>item 49</li>' in changes['init_html']
+                assert changes['diffs'] == \
+                        [['props', 'html', [1, 1], {'value': 'hello'}]]
+
+            # Viewers only a little behind still get diffs
+            changes = self.get_main_changes(storage,
+                    storage.last_change_id - 1)
+            assert 'init_html' not in changes
+
+    def test_conflate(self):
+        """ Slow viewers can get just the latest state of everything """
+        storage = create_storage()
+        self.send_new_page(storage)
+        change_id = storage.last_change_id + 1
+        for pos in range(2, 6):
+            self.add_list_item(storage, pos)
+
+        update = handle_get_update(storage, change_id, conflate=True)
+        diffs = update['changesets'][0][1]['diffs']
+        assert [d[0] for d in diffs] == ['node', 'props', 'node', 'node',
+                'node']
+        assert diffs[1] == ['props', 'html', [1, 1], {'value': 'v5'}, []]
+        encoded = handle_get_update_encoded(storage, change_id, conflate=True)
+        assert json.loads(encoded)['changesets'][0][1]['diffs'] == diffs
+        update = handle_get_update(storage, change_id)
+        assert len(update['changesets'][0][1]['diffs']) == 8
+
+    def test_response_cache(self):
+        """ Viewers polling with the same change id share a response """
+        storage = create_storage()
+        self.send_new_page(storage)
+        change_id = storage.last_change_id
+        first = handle_get_update(storage, change_id=change_id)
+        assert handle_get_update(storage, change_id=change_id) is first
+        encoded = handle_get_update_encoded(storage, change_id=change_id)
+        assert json.loads(encoded)['last_change_id'] == change_id
+
+        # Any change to the session throws the cached responses away
+        self.add_list_item(storage, 2)
+        second = handle_get_update(storage, change_id=change_id)
+        assert second is not first
+        assert second['last_change_id'] == change_id + 1
+
+    def test_response_cache_single_flight(self):
+        """ Concurrent requests for the same response only build it once """
+        cache = ResponseCache()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def build():
+            calls.append(1)
+            release.wait()
+            return {"last_change_id": 1}, '{"last_change_id": 1}'
+
+        def fetch():
+            results.append(cache.get((1, False), build))
+
+        threads = [threading.Thread(target=fetch) for i in range(10)]
+        for t in threads:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+        assert len(calls) == 1
+        assert len(results) == 10
+        assert all(r[0] is results[0][0] for r in results)
+
+    def test_encoded_update(self):
+        """ Pre-encoded responses match encoding the response from scratch """
+        storage = create_storage(capacity=3)
+        self.send_new_page(storage)
+        for pos in range(2, 8):
+            self.add_list_item(storage, pos)
+        for change_id in [None] + range(storage.last_change_id + 2):
+            response = handle_get_update(storage, change_id=change_id)
+            encoded = handle_get_update_encoded(storage, change_id=change_id)
+            expected = json.loads(json.dumps(response))
+            assert json.loads(encoded) == expected
+
+    def test_long_poll(self):
+        """ Long polls return as soon as a change arrives """
+        storage = create_storage()
+        self.send_new_page(storage)
+        change_id = storage.last_change_id + 1
+        results = []
+
+        def poll():
+            results.append(handle_get_update(storage, change_id=change_id,
+                timeout=10))
+
+        t = threading.Thread(target=poll)
+        t.start()
+        self.add_list_item(storage, 2)
+        t.join(5)
+        assert not t.is_alive()
+        assert results[0]['last_change_id'] == change_id
+
+        # Nothing new: times out with no changes
+        result = handle_get_update(storage, change_id=change_id + 1,
+                timeout=0.1)
+        assert result['last_change_id'] == change_id
+        assert not self.get_main_changes(storage, change_id + 1).get('diffs')
+
+    def test_change_ids_are_unique(self):
+        """ Change ids handed out concurrently are never duplicated """
+        storage = create_storage()
+        ids = []
+
+        def allocate():
+            for i in range(1000):
+                ids.append(storage.get_next_change_id())
+
+        threads = [threading.Thread(target=allocate) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(ids)) == 8000
+
+    def test_concurrent_reads(self):
+        """ Viewers reading while the broadcaster writes see consistent updates """
+        storage = create_storage(capacity=4)
+        self.send_new_page(storage)
+        errors = []
+        done = threading.Event()
+
+        def read():
+            try:
+                last = -1
+                while not done.is_set():
+                    response = handle_get_update(storage,
+                            change_id=max(last, 0) or None)
+                    assert response['last_change_id'] >= last
+                    changes = response['changesets'][0][1]
+                    if 'init_html' in changes:
+                        assert changes['diffs'][0][0] == 'props'
+                    last = response['last_change_id']
+            except Exception, e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for t in readers:
+            t.start()
+        for pos in range(2, 202):
+            self.add_list_item(storage, pos)
+        done.set()
+        for t in readers:
+            t.join()
+        assert errors == []
+
+        changes = self.get_main_changes(storage)
+        assert changes['init_html'].count('<li>') == 198
+
+    def test_old_snapshot(self):
+        """
+        Snapshots keep their base document after it's been compacted further
+        """
+        storage = create_storage(capacity=1)
+        self.send_new_page(storage)
+        self.add_list_item(storage, 2)
+        snapshot = storage.snapshot
+        assert not snapshot.frames[('m',)].base.ready
+        self.add_list_item(storage, 3)
+        changes = snapshot.frames[('m',)].changes_since_change_id(None)[0]
+        assert changes['init_html'].count('<li>') == 2
+
+        # Fresh snapshots are fine
+        changes = self.get_main_changes(storage)
+        assert changes['init_html'].count('<li>') == 3
+
+    def test_frame_trie(self):
+        """ Frame tries list parents first and share untouched branches """
+        frames = FrameTrie()
+        for path in [('m', 1, 'i', 0, 'i'), ('m', 1, 'i'), ('m',),
+                ('m', 0, 'i'), ('m', 0, 'i', 2, 'i')]:
+            frames = frames.set(path, "/".join(map(str, path)))
+        assert len(frames) == 5
+        assert frames.keys() == [('m',), ('m', 0, 'i'), ('m', 0, 'i', 2, 'i'),
+                ('m', 1, 'i'), ('m', 1, 'i', 0, 'i')]
+
+        removed = frames.remove_children(('m', 1, 'i'))
+        assert removed.keys() == [('m',), ('m', 0, 'i'), ('m', 0, 'i', 2, 'i'),
+                ('m', 1, 'i')]
+        assert removed.find(('m', 0)) is frames.find(('m', 0))
+        assert len(frames) == 5
+
+        removed = removed.remove(('m', 0, 'i'))
+        assert ('m', 0, 'i') not in removed
+        assert removed[('m', 0, 'i', 2, 'i')] == "m/0/i/2/i"
+        assert len(removed) == 3
+
+    def test_frame_removal(self):
+        """ Restarting a frame drops its child frames """
+        storage = create_storage()
+        data = {'html': TEST_PAGE, 'props': [], 'url': 'http://test/',
+                'iframes': []}
+        frames = [['m'], ['m', 1, 'i'], ['m', 1, 'i', 0, 'i'], ['m', 2, 'i']]
+        handle_send_update(storage, [[f, 'new_page', data] for f in frames],
+                frames)
+        response = handle_get_update(storage)
+        assert [c[0] for c in response['changesets']] == \
+                [tuple(f) for f in frames]
+
+        handle_send_update(storage, [[['m', 1, 'i'], 'new_page', data]],
+                frames)
+        assert storage.changelogs.keys() == [('m',), ('m', 1, 'i'),
+                ('m', 2, 'i')]
+
+        # Frames the broadcaster no longer has are dropped
+        handle_send_update(storage, [], [['m'], ['m', 1, 'i']])
+        assert storage.snapshot.frames.keys() == [('m',), ('m', 1, 'i')]
+
+    def test_frame_snapshot(self):
+        """ Viewers can start a broken frame again straight away """
+        storage = create_storage()
+        data = {'html': TEST_PAGE, 'props': [], 'url': 'http://test/',
+                'iframes': []}
+        frames = [['m'], ['m', 1, 'i'], ['m', 1, 'i', 0, 'i'], ['m', 2, 'i']]
+        handle_send_update(storage, [[f, 'new_page', data] for f in frames],
+                frames)
+        change_id = storage.last_change_id + 1
+        for pos in range(2, 4):
+            handle_send_update(storage, [[['m'], 'diffs', {'diffs': [
+                ['node', 'html', [1, 0, pos], '<li>%s</li>' % (pos), '', []],
+                ['props', 'html', [1, 1], {'value': 'v%s' % (pos)}, []],
+            ]}]], frames)
+        handle_send_update(storage, [[['m', 2, 'i'], 'diffs',
+            {'diffs': [['text', 'html', [1, 0, 0], None, 'x']]}]], frames)
+
+        response = handle_get_frame_snapshot(storage, ['m', 1, 'i'],
+                change_id)
+        assert response['last_change_id'] == storage.last_change_id
+        changesets = dict(response['changesets'])
+        for frame_path in [('m', 1, 'i'), ('m', 1, 'i', 0, 'i')]:
+            assert 'init_html' in changesets[frame_path]
+            assert changesets[frame_path]['diffs'] == []
+        assert 'init_html' not in changesets[('m', 2, 'i')]
+        assert len(changesets[('m', 2, 'i')]['diffs']) == 1
+
+        # The main frame's diffs are folded into its document
+        main = handle_get_frame_snapshot(storage, ['m'], change_id)
+        changes = dict(main['changesets'])[('m',)]
+        desired = """<html><head></head><body><ul><li>a</li><li>b</li>
+                <li>2</li><li>3</li></ul><input type="text"/></body></html>"""
+        assert self.compare_html(desired, changes['init_html'],
+                ignore_all_whitespace=True)
+        assert changes['diffs'] == [['props', 'html', [1, 1], {'value': 'v3'}]]
+        assert all('init_html' in c for f, c in main['changesets'])
+        assert json.loads(handle_get_frame_snapshot_encoded(storage, ['m'],
+                change_id)) == json.loads(json.dumps(main))
+
+    def test_html_stream(self):
+        """ A page sent in chunks ends up the same as one sent all at once """
+        expected = create_storage()
+        self.send_new_page(expected)
+        storage = create_storage()
+        chunks = [TEST_PAGE[i:i + 10] for i in range(0, len(TEST_PAGE), 10)]
+        handle_html_stream(storage, ('m',), 'new_page', iter(chunks),
+                props=[['props', 'html', [1, 1], {'value': 'hello'}]],
+                url='http://test/', iframes=[])
+        assert handle_get_update(storage) == handle_get_update(expected)
+
+        handle_html_stream(storage, ('m',), 'new_page',
+                iter(['<html><body><b>', 'x</i></body></html>']), props=[],
+                url='http://test/', iframes=[])
+        assert storage.changelogs[('m',)].bad_state is not None
+
+    def test_acknowledged_diffs_collected(self):
+        """ Diffs every viewer has acknowledged are dropped """
+        storage = create_storage(collect_acknowledged=True, viewer_timeout=10)
+        now = [1000.0]
+        storage.clock = lambda: now[0]
+        self.send_new_page(storage)
+        fast = handle_register_viewer(storage)['viewer_id']
+        slow = handle_register_viewer(storage)['viewer_id']
+        start = handle_get_update(storage, viewer_id=fast)['last_change_id']
+        handle_get_update(storage, change_id=start + 1, viewer_id=slow)
+
+        for pos in range(2, 6):
+            self.add_list_item(storage, pos)
+            handle_get_update(storage, change_id=storage.last_change_id,
+                    viewer_id=fast)
+        c = storage.changelogs[('m',)]
+        assert c.num_diff_sets == 4
+
+        lag = handle_get_viewer_lag(storage)['viewers']
+        assert [v['viewer_id'] for v in lag] == [slow, fast]
+        assert lag[0]['lag'] == 4
+        assert lag[0]['lag_bytes'] == c.bytes_from(c.start)
+        assert lag[1]['lag'] == 1
+
+        # The slow viewer catching up releases everything it's seen
+        handle_get_update(storage, change_id=storage.last_change_id,
+                viewer_id=slow)
+        self.add_list_item(storage, 6)
+        assert c.num_diff_sets == 2
+        assert c.first_change_id == storage.last_change_id - 2
+
+        # Viewers that go quiet stop holding diffs back, and start again if
+        # they come back
+        quiet_id = storage.last_change_id + 1
+        now[0] += 5
+        handle_get_update(storage, change_id=quiet_id, viewer_id=fast)
+        now[0] += 6
+        for pos in range(7, 10):
+            self.add_list_item(storage, pos)
+        assert storage.viewers.keys() == [fast]
+        assert c.num_diff_sets == 3
+        changes = self.get_main_changes(storage, quiet_id - 1)
+        assert 'init_html' in changes
+
+    def test_change_index(self):
+        """ Updates only look at the frames that changed """
+        storage = create_storage()
+        data = {'html': TEST_PAGE, 'props': [], 'url': 'http://test/',
+                'iframes': []}
+        frames = [['m']] + [['m', i, 'i'] for i in range(50)] + \
+                [['m', 7, 'i', 0, 'i']]
+        handle_send_update(storage, [[f, 'new_page', data] for f in frames],
+                frames)
+        change_id = storage.last_change_id + 1
+        assert len(handle_get_update(storage)['changesets']) == 52
+
+        def send(frame_path, message_type, data):
+            handle_send_update(storage, [[frame_path, message_type, data]],
+                    frames)
+        diff = ['text', 'html', [1, 0, 0], None, 'x']
+        send(['m', 30, 'i'], 'diffs', {'diffs': [diff]})
+        send(['m', 7, 'i', 0, 'i'], 'diffs', {'diffs': [diff]})
+        response = handle_get_update(storage, change_id)
+        assert [c[0] for c in response['changesets']] == \
+                [('m',), ('m', 7, 'i', 0, 'i'), ('m', 30, 'i')]
+        assert 'diffs' not in response['changesets'][0][1]
+
+        # Frames inside a frame that's compacted start again too
+        storage.capacity = 1
+        send(['m', 7, 'i'], 'new_page', data)
+        send(['m', 7, 'i', 0, 'i'], 'new_page', data)
+        change_id = storage.last_change_id + 1
+        send(['m', 7, 'i'], 'diffs', {'diffs': [diff]})
+        send(['m', 7, 'i'], 'diffs', {'diffs': [diff]})
+        response = handle_get_update(storage, change_id)
+        assert [c[0] for c in response['changesets']] == \
+                [('m',), ('m', 7, 'i'), ('m', 7, 'i', 0, 'i')]
+        assert all('init_html' in c for f, c in response['changesets'][1:])
+
+        # Viewers from before the oldest entry look at everything
+        storage.index.capacity = 4
+        for i in range(5):
+            send(['m', 1, 'i'], 'diffs', {'diffs': [diff]})
+        assert storage.index.first_change_id > change_id
+        response = handle_get_update(storage, change_id)
+        assert len(response['changesets']) == 52
+        response = handle_get_update(storage, storage.last_change_id)
+        assert [c[0] for c in response['changesets']] == [('m',), ('m', 1, 'i')]
+
+    def test_long_poll_error_recovery(self):
+        """
+        Viewers waiting for a new page get last_change_id back, and polling
+        after it waits for the new page
+        """
+        storage = create_storage()
+        self.send_new_page(storage)
+        self.add_list_item(storage, 2)
+        change_id = storage.last_change_id
+        result = handle_get_update(storage, change_id=change_id,
+                init_html_required=True, timeout=10)
+        assert 'changesets' not in result
+        next_change_id = result['last_change_id'] + 1
+
+        start = time.time()
+        result = handle_get_update(storage, change_id=next_change_id,
+                init_html_required=True, timeout=0.2)
+        assert time.time() - start >= 0.2
+        assert 'changesets' not in result
+
+        results = []
+        def poll():
+            results.append(handle_get_update(storage,
+                change_id=next_change_id, init_html_required=True,
+                timeout=10))
+        t = threading.Thread(target=poll)
+        t.start()
+        self.send_new_page(storage)
+        t.join(5)
+        assert not t.is_alive()
+        assert 'init_html' in dict(results[0]['changesets'])[('m',)]
+
+    def test_bad_frame_reaches_current_viewers(self):
+        """
+        A viewer that's up to date hears about an iframe going bad, and long
+        polls are woken for it
+        """
+        storage = create_storage()
+        data = {'html': TEST_PAGE, 'props': [], 'url': 'http://test/',
+                'iframes': []}
+        frames = [['m'], ['m', 1, 'i']]
+        handle_send_update(storage, [[f, 'new_page', data] for f in frames],
+                frames)
+        change_id = storage.last_change_id + 1
+
+        results = []
+        def poll():
+            results.append(handle_get_update(storage, change_id=change_id,
+                timeout=10))
+        t = threading.Thread(target=poll)
+        t.start()
+        handle_send_update(storage, [[['m', 1, 'i'], 'diffs', {'diffs': [
+            ['node', 'html', [1, 0, 0], '<b>x</i>', '', []]]}]], frames)
+        t.join(5)
+        assert not t.is_alive()
+        changesets = dict(results[0]['changesets'])
+        assert changesets[('m', 1, 'i')]['error'] == 'invalid_html'
+        assert results[0]['last_change_id'] == change_id
+
+    def test_session_manager_idle(self):
+        """ Idle sessions and sessions without a broadcaster are evicted """
+        now = [0]
+        manager = SessionManager(idle_timeout=60, heartbeat_timeout=30)
+        manager.clock = lambda: now[0]
+        manager.get_session("viewed", create=True)
+        manager.get_session("broadcast", create=True, broadcaster=True)
+
+        now[0] = 20
+        manager.get_session("viewed")
+        manager.heartbeat("broadcast")
+
+        # Viewed session's broadcaster has gone quiet
+        now[0] = 40
+        assert manager.evict() == ["viewed"]
+        # Broadcast session is still being updated but nobody's viewing
+        now[0] = 45
+        manager.heartbeat("broadcast")
+        assert manager.evict() == []
+        try:
+            manager.get_session("viewed")
+        except SessionNotFound:
+            pass
+        else:
+            assert False, "Expected session to be evicted"
+
+    def test_session_manager_create(self):
+        """ Creating a session never replaces one that's in use """
+        manager = SessionManager()
+        session_id, session = manager.create_session("a")
+        assert session_id == "a"
+        try:
+            manager.create_session("a")
+        except SessionExists:
+            pass
+        else:
+            assert False, "Expected SessionExists"
+        assert manager.get_session("a") is session
+
+        session_id, other = manager.create_session()
+        assert other is not session
+        assert len(manager) == 2
+
+    def test_session_manager_memory_budget(self):
+        """ Least recently used sessions are evicted first """
+        manager = SessionManager(max_bytes=2500, check_interval=3600)
+        for session_id in ["a", "b", "c"]:
+            session = manager.get_session(session_id, create=True)
+            self.send_new_page(session, html="<html><body>%s</body></html>" % \
+                    ("x" * 1000))
+        manager.get_session("a")
+        assert manager.evict() == ["b"]
+        assert manager.sessions.keys() == ["c", "a"]
+
+    def test_session_manager_sizing(self):
+        """
+        Sessions are only sized when there's a size limit, and never while
+        the manager is locked
+        """
+        manager = SessionManager(idle_timeout=60, check_interval=0)
+        measured = []
+        def try_lock(result):
+            result.append(manager.lock.acquire(False))
+            if result[0]:
+                manager.lock.release()
+        def lock_free():
+            result = []
+            t = threading.Thread(target=try_lock, args=(result,))
+            t.start()
+            t.join()
+            return result[0]
+        class MeasuredSession(mirrordom.server.Session):
+            @property
+            def approx_size(self):
+                measured.append(lock_free())
+                return 0
+        session_id, session = manager.create_session()
+        manager.sessions[session_id].session = MeasuredSession()
+        manager.get_session(session_id)
+        assert measured == []
+
+        manager.max_bytes = 1000
+        manager.get_session(session_id)
+        assert measured == [True]
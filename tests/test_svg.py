@@ -22,6 +22,9 @@ except ImportError:
     import mirrordom.server
 
 from mirrordom.parser import parse_html    
+from mirrordom.sanitise import sanitise_html
+from mirrordom.mirror import DocumentMirror
+from mirrordom import merkle
 
 def setupModule():
     util.start_webserver()
@@ -251,6 +254,27 @@ class TestFirefox(util.TestBrowserBase):
         viewer_html = self.get_viewer_html()
         assert target_text in viewer_html
 
+    def test_hash_prefixed_attributes(self):
+        """
+        The viewer's hash of SVG with xlink attributes matches the server's
+        """
+        self.init_webdriver()
+        for html in [
+                '<div><svg><use xlink:href="#a" x="1"></use></svg></div>',
+                '<div><svg xmlns="http://www.w3.org/2000/svg" '
+                'xmlns:xlink="http://www.w3.org/1999/xlink">'
+                '<use xlink:href="#a" x="1"></use></svg></div>']:
+            viewer_hash = self.execute_script("""
+                var div = document.createElement('div');
+                document.body.appendChild(div);
+                div.innerHTML = arguments[0];
+                var result = MirrorDom.subtree_hash(div.firstChild);
+                document.body.removeChild(div);
+                return result;
+            """, html)
+            doc = DocumentMirror(sanitise_html(html, is_fragment=True))
+            assert viewer_hash == merkle.subtree_hash(doc.root, {}), html
+
 class TestIE(TestFirefox):
     @classmethod
     def _create_webdriver(cls):
@@ -509,6 +509,40 @@ class TestBase(object):
         comparator = HTMLComparator(**options)
         return comparator.run(desired, got)
 
+SERVER_TEST_PAGE = """<html><head><title>RemoveMe</title></head><body><ul><li>a</li><li>b</li></ul><input type="text"></body></html>"""
+
+class ServerTestBase(TestBase):
+    """
+    Helpers for tests that drive a session directly (no browser). The
+    mirrordom package has to be importable already (see the tests' imports).
+    """
+
+    def send_new_page(self, storage, html=SERVER_TEST_PAGE, props=None):
+        from mirrordom.server import handle_send_update
+        props = props if props is not None else \
+                [['props', 'html', [1, 1], {'value': 'hello'}]]
+        data = {'html': html, 'props': props, 'url': 'http://test/',
+                'iframes': []}
+        handle_send_update(storage, [[['m'], 'new_page', data]], [['m']])
+
+    def send_diffs(self, storage, diffs, frame_path=('m',)):
+        from mirrordom.server import handle_send_update
+        message = [list(frame_path), 'diffs', {'diffs': diffs}]
+        handle_send_update(storage, [message], [['m']])
+
+    def get_main_changes(self, storage, change_id=None):
+        from mirrordom.server import handle_get_update
+        result = handle_get_update(storage, change_id=change_id)
+        frame_path, changes = result['changesets'][0]
+        assert frame_path == ('m',)
+        return changes
+
+    def add_list_item(self, storage, pos):
+        self.send_diffs(storage, [
+            ['node', 'html', [1, 0, pos], '<li>%s</li>' % (pos), '', []],
+            ['props', 'html', [1, 1], {'value': 'v%s' % (pos)}, []],
+        ])
+
 class JavascriptFailed(Exception):
     pass
 